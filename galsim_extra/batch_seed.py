@@ -0,0 +1,128 @@
+#
+# This module lets the random seeds of all the objects in an image be calculated at once.
+#
+# MixedScene's batch_obj_types needs the seed of every object in the image before any of them
+# are built.  Parsing image.random_seed once per object goes through the config machinery for
+# each one, so for the seed types registered here, the seeds of all the objects are calculated
+# at once with numpy.  Other types fall back to parsing the seed of each object.
+#
+#     Sequence      The normal GalSim seed sequence, which an integer random_seed turns into.
+#     ExposureSeed  The seeds that FocalPlane uses to get the same objects on every chip of an
+#                   exposure (or of every exposure).
+#     CounterSeed   The counter-based seeds of FocalPlane's seed_mode = counter.  This one is
+#                   registered in counter_seed.py.
+
+import galsim
+import numpy as np
+
+# The functions that calculate a batch of seeds, keyed by type name.
+valid_batch_seeds = {}
+
+def RegisterBatchSeed(type_name, batch_func):
+    """Register a random_seed type that can calculate the seeds of all the objects at once.
+
+    The batch_func should have the signature
+
+        seeds = batch_func(config, base, nobj)
+
+    where config is the random_seed item, nobj is the number of seeds to calculate, and seeds
+    is a numpy integer array.  The first seed should be for base['obj_num'].
+
+    @param type_name    The name of the 'type' specification in the config dict.
+    @param batch_func   The function to calculate the seeds.
+    """
+    valid_batch_seeds[type_name] = batch_func
+
+def BuildBatchSeeds(config, key, base, obj_num, nobj):
+    """Calculate the seeds given by config[key] for nobj objects starting at obj_num.
+
+    @param config       The dict holding the random_seed item.
+    @param key          The key of the random_seed item in config.
+    @param base         The base configuration dict.
+    @param obj_num      The obj_num of the first object.
+    @param nobj         The number of objects.
+
+    @returns a numpy array of the seeds
+    """
+    save_obj_num = base.get('obj_num', None)
+    save_index_key = base.get('index_key', None)
+    base['index_key'] = 'obj_num'
+    base['obj_num'] = obj_num
+    try:
+        value = config[key]
+        if isinstance(value, dict) and value.get('type', None) in valid_batch_seeds:
+            seeds = valid_batch_seeds[value['type']](value, base, nobj)
+        else:
+            seeds = np.empty(nobj, dtype=np.int64)
+            for k in range(nobj):
+                base['obj_num'] = obj_num + k
+                seeds[k] = galsim.config.ParseValue(config, key, base, int)[0]
+    finally:
+        base['obj_num'] = save_obj_num
+        base['index_key'] = save_index_key
+    return np.asarray(seeds, dtype=np.int64)
+
+def BatchSequence(config, base, nobj):
+    """Calculate nobj values of an integer Sequence, the same way as GalSim's Sequence type.
+    """
+    opt = { 'first' : int, 'last' : int, 'step' : int, 'repeat' : int, 'nitems' : int,
+            'index_key' : str }
+    kwargs = galsim.config.GetAllParams(config, base, opt=opt, ignore=['default'])[0]
+    step = kwargs.get('step', 1)
+    first = kwargs.get('first', 0)
+    repeat = kwargs.get('repeat', 1)
+    nitems = kwargs.get('nitems', None)
+    if repeat <= 0:
+        raise galsim.GalSimConfigValueError(
+            "Invalid repeat for type = Sequence (must be > 0)", repeat)
+    if 'last' in kwargs:
+        if nitems is not None:
+            raise galsim.GalSimConfigError(
+                "At most one of the attributes last and nitems is allowed for type = Sequence")
+        nitems = (kwargs['last'] - first) // step + 1
+
+    index, index_key = galsim.config.GetIndex(kwargs, base, is_sequence=True)
+    if index_key == 'obj_num':
+        index = index + np.arange(nobj)
+    else:
+        # Then the index is the same for all the objects in the image.
+        index = np.full(nobj, index)
+    index = index // repeat
+    if nitems is not None and nitems > 0:
+        index = index % nitems
+    return first + index * step
+
+def _ExposureSeedParams(config, base):
+    req = { 'first' : int }
+    opt = { 'all_exposures' : bool }
+    params, safe = galsim.config.GetAllParams(config, base, req=req, opt=opt)
+    nobjects = galsim.config.ParseValue(base['image'], 'nobjects', base, int)[0]
+    first = params['first']
+    if not params.get('all_exposures', False):
+        first += base['exp_start_obj_num']
+    return first, nobjects
+
+def GenExposureSeed(config, base, value_type):
+    """Generate a seed that repeats for each chip of an exposure.
+
+    Every chip in a FocalPlane exposure has the same objects, so the seed only depends on the
+    index of the object within the exposure:
+
+        first + exp_start_obj_num + (obj_num - exp_start_obj_num) % nobjects
+
+    With all_exposures = True, the exp_start_obj_num term is left out, so the seeds also repeat
+    for every exposure.  (This only works correctly if nobjects is constant.)
+    """
+    first, nobjects = _ExposureSeedParams(config, base)
+    return first + (base['obj_num'] - base['exp_start_obj_num']) % nobjects, False
+
+def BatchExposureSeed(config, base, nobj):
+    """Calculate nobj values of an ExposureSeed.
+    """
+    first, nobjects = _ExposureSeedParams(config, base)
+    obj_num = base['obj_num'] + np.arange(nobj)
+    return first + (obj_num - base['exp_start_obj_num']) % nobjects
+
+galsim.config.RegisterValueType('ExposureSeed', GenExposureSeed, [ int ])
+RegisterBatchSeed('Sequence', BatchSequence)
+RegisterBatchSeed('ExposureSeed', BatchExposureSeed)
@@ -0,0 +1,121 @@
+#
+# This module defines some world_pos value types that can generate the positions of all the
+# objects in an image at once.
+#
+# WideScattered needs the world_pos of every object in the image before it can decide which ones
+# are worth building stamps for.  Going through the config machinery once per object is slow
+# when there are many objects, so for these types, it generates all the positions at once with
+# numpy.  They can also be used as normal value types with any other image type, in which case
+# they generate one position at a time.
+#
+#     UniformRADec  positions uniformly distributed on the sky within a range of ra and dec.
+#                   The range defaults to fov_minra..fov_maxra, fov_mindec..fov_maxdec from
+#                   FocalPlane, so this is equivalent to the RADec world_pos in
+#                   examples/focal.yaml.
+#     CatalogRADec  positions read from ra, dec columns of an input catalog.
+
+import galsim
+import numpy as np
+
+# The functions that generate a batch of positions, keyed by type name.
+valid_batch_world_pos = {}
+
+def RegisterBatchWorldPos(type_name, batch_func):
+    """Register a world_pos type that can generate all the positions for an image at once.
+
+    The batch_func should have the signature
+
+        ra, dec = batch_func(config, base, nobj)
+
+    where config is the world_pos field, nobj is the number of positions to generate, and ra,
+    dec are numpy arrays in radians.  The first position should be for base['obj_num'].
+
+    @param type_name    The name of the 'type' specification in the config dict.
+    @param batch_func   The function to generate the positions.
+    """
+    valid_batch_world_pos[type_name] = batch_func
+
+def BuildBatchWorldPos(config, base, nobj):
+    """Generate the world positions for nobj objects, starting at base['obj_num'].
+
+    @param config       The world_pos field.
+    @param base         The base configuration dict.
+    @param nobj         The number of positions to generate.
+
+    @returns ra, dec as numpy arrays in radians
+    """
+    return valid_batch_world_pos[config['type']](config, base, nobj)
+
+def _GetUniformRADecParams(config, base):
+    opt = { 'min_ra' : galsim.Angle, 'max_ra' : galsim.Angle,
+            'min_dec' : galsim.Angle, 'max_dec' : galsim.Angle }
+    params, safe = galsim.config.GetAllParams(config, base, opt=opt)
+    # Default to the full field of view calculated by FocalPlane.
+    defaults = { 'min_ra' : '$fov_minra', 'max_ra' : '$fov_maxra',
+                 'min_dec' : '$fov_mindec', 'max_dec' : '$fov_maxdec' }
+    for key in defaults:
+        if key not in params:
+            params[key] = galsim.config.ParseValue(defaults, key, base, galsim.Angle)[0]
+    return params
+
+def BatchUniformRADec(config, base, nobj):
+    """Generate nobj positions uniformly distributed on the sky within the given range.
+    """
+    params = _GetUniformRADecParams(config, base)
+    rng = galsim.config.GetRNG(config, base)
+    ud = galsim.UniformDeviate(rng)
+    u = np.empty(2*nobj)
+    ud.generate(u)
+    min_ra = params['min_ra'].rad
+    max_ra = params['max_ra'].rad
+    sin_min_dec = np.sin(params['min_dec'].rad)
+    sin_max_dec = np.sin(params['max_dec'].rad)
+    # Uniform on the sky means uniform in ra and sin(dec).
+    ra = min_ra + u[0::2] * (max_ra - min_ra)
+    dec = np.arcsin(sin_min_dec + u[1::2] * (sin_max_dec - sin_min_dec))
+    return ra, dec
+
+def GenUniformRADec(config, base, value_type):
+    """Generate a single position uniformly distributed on the sky within the given range.
+    """
+    ra, dec = BatchUniformRADec(config, base, 1)
+    return galsim.CelestialCoord(ra[0] * galsim.radians, dec[0] * galsim.radians), False
+
+def _GetCatalogRADecParams(config, base):
+    req = { 'ra_col' : str, 'dec_col' : str }
+    opt = { 'num' : int, 'units' : str }
+    params, safe = galsim.config.GetAllParams(config, base, req=req, opt=opt)
+    units = galsim.AngleUnit.from_name(params.get('units', 'deg'))
+    return params, units
+
+def _GetCatalogColumn(cat, col, rows):
+    if cat.isFits():
+        return np.asarray(cat.data[col][rows], dtype=float)
+    else:
+        return np.asarray(cat.data[rows, int(col)], dtype=float)
+
+def BatchCatalogRADec(config, base, nobj):
+    """Read nobj positions from the ra, dec columns of an input catalog.
+
+    The catalog row is obj_num - start_obj_num (wrapping around at the end of the catalog),
+    so all the chips in a FocalPlane exposure get the same positions.
+    """
+    params, units = _GetCatalogRADecParams(config, base)
+    cat = galsim.config.GetInputObj('catalog', config, base, 'CatalogRADec', params.get('num',0))
+    first = base['obj_num'] - base.get('start_obj_num', 0)
+    rows = (first + np.arange(nobj)) % cat.nobjects
+    ra = _GetCatalogColumn(cat, params['ra_col'], rows) * units.value
+    dec = _GetCatalogColumn(cat, params['dec_col'], rows) * units.value
+    return ra, dec
+
+def GenCatalogRADec(config, base, value_type):
+    """Read a single position from the ra, dec columns of an input catalog.
+    """
+    ra, dec = BatchCatalogRADec(config, base, 1)
+    return galsim.CelestialCoord(ra[0] * galsim.radians, dec[0] * galsim.radians), False
+
+galsim.config.RegisterValueType('UniformRADec', GenUniformRADec, [ galsim.CelestialCoord ])
+galsim.config.RegisterValueType('CatalogRADec', GenCatalogRADec, [ galsim.CelestialCoord ],
+                                input_type='catalog')
+RegisterBatchWorldPos('UniformRADec', BatchUniformRADec)
+RegisterBatchWorldPos('CatalogRADec', BatchCatalogRADec)
@@ -0,0 +1,247 @@
+#
+# This module defines the geometry of the chips in a focal plane, and a cache of the per-chip
+# wcs and corner geometry used by FocalPlane.
+#
+# Building the wcs for a chip can be fairly expensive (e.g. reading and parsing the header of a
+# Fits file).  The FocalPlane output type needs the wcs of every chip in an exposure to figure out
+# the focal plane geometry, and then needs the wcs of the current chip again when building the
+# image.  The ChipGeometryCache keeps the most recently used ones, so each one is only built once
+# per process.
+#
+# The FocalPlaneGeometry combines the ChipGeometry of all the chips in an exposure to calculate
+# the pointing, the extent of the field of view, and the bounds of the focal plane and each chip
+# in the tangent plane.  Everything is done with numpy arrays, so it is fast even when sampling
+# many points along the edges of each chip.  It is available in Eval items as focal_plane.
+# It also keeps the outline of each chip as a polygon in the tangent plane, along with a grid
+# index of which chips are near each part of the focal plane, so it can quickly find which chip
+# (if any) each of a large number of positions lands on.  e.g. $focal_plane.chip_num(world_pos).
+
+import galsim
+import numpy as np
+from collections import OrderedDict
+
+class ChipGeometry(object):
+    """The wcs, size and outline of a single chip.
+
+    The outline is sampled at edge_samples points along each edge of the chip, including the
+    corners.  The default, 2, means just use the 4 corners.
+
+    @param wcs          The wcs of the chip.  Must be a CelestialWCS.
+    @param xsize        The size of the chip in the x direction (in pixels).
+    @param ysize        The size of the chip in the y direction (in pixels).
+    @param edge_samples The number of points to sample along each edge. [default: 2]
+    """
+    def __init__(self, wcs, xsize, ysize, edge_samples=2):
+        if not wcs.isCelestial():
+            raise ValueError("FocalPlane requires a CelestialWCS")
+        if edge_samples < 2:
+            raise ValueError("edge_samples must be at least 2")
+        self.wcs = wcs
+        self.xsize = xsize
+        self.ysize = ysize
+
+        # The corners come first, then any additional points along the edges.
+        x = [0., 0., xsize, xsize]
+        y = [0., ysize, 0., ysize]
+        t = np.linspace(0., 1., edge_samples)[1:-1]
+        x = np.concatenate([x, t * xsize, t * xsize, np.zeros_like(t), np.full_like(t, xsize)])
+        y = np.concatenate([y, np.zeros_like(t), np.full_like(t, ysize), t * ysize, t * ysize])
+        self.ra, self.dec = wcs.toWorld(x, y, units=galsim.radians)
+
+        # The indices of the above points in order going around the edge of the chip.
+        m = len(t)
+        bottom = list(range(4, 4+m))
+        top = list(range(4+m, 4+2*m))
+        left = list(range(4+2*m, 4+3*m))
+        right = list(range(4+3*m, 4+4*m))
+        self.perimeter = np.array([0] + bottom + [2] + right + [3] + top[::-1] + [1] + left[::-1])
+
+    @property
+    def corners(self):
+        """The world coordinates of the 4 corners as a list of CelestialCoord.
+        """
+        return [ galsim.CelestialCoord(ra * galsim.radians, dec * galsim.radians)
+                 for ra, dec in zip(self.ra[:4], self.dec[:4]) ]
+
+class FocalPlaneGeometry(object):
+    """The geometry of the full focal plane, calculated from the outlines of all the chips.
+
+    The pointing is the mean position of all the chip corners.  The other quantities use all
+    the sampled points along the chip edges.  Tangent plane coordinates use a gnomonic
+    projection around the pointing, with units of arcsec.
+
+    Attributes:
+        pointing        The center of the focal plane as a CelestialCoord.
+        fov_minra, fov_maxra, fov_mindec, fov_maxdec
+                        The range of ra and dec covered by the chips (in degrees).
+        bounds          The bounds of the focal plane in the tangent plane as a BoundsD.
+        chip_bounds     A numpy array of shape (nchips, 4) with the (xmin, xmax, ymin, ymax)
+                        bounds of each chip in the tangent plane.
+        chip_polygons   A list of numpy arrays of shape (npoints, 2) with the outline of each
+                        chip in the tangent plane.
+        rmax            The maximum distance of any chip from the pointing in the tangent plane.
+
+    @param chips        A list of ChipGeometry instances, one for each chip.
+    """
+    def __init__(self, chips):
+        self.nchips = len(chips)
+
+        corner_ra = np.concatenate([ c.ra[:4] for c in chips ])
+        corner_dec = np.concatenate([ c.dec[:4] for c in chips ])
+        x, y, z = galsim.CelestialCoord.radec_to_xyz(corner_ra, corner_dec)
+        self.pointing = galsim.CelestialCoord.from_xyz(np.mean(x), np.mean(y), np.mean(z))
+
+        # Wrap the ra values to be within pi of the pointing.
+        start = self.pointing.ra.rad - np.pi
+        all_ra = np.concatenate([ c.ra for c in chips ])
+        all_ra = all_ra - ((all_ra - start) // (2.*np.pi)) * 2.*np.pi
+        all_dec = np.concatenate([ c.dec for c in chips ])
+        self.fov_minra = np.min(all_ra) / galsim.degrees.value
+        self.fov_maxra = np.max(all_ra) / galsim.degrees.value
+        self.fov_mindec = np.min(all_dec) / galsim.degrees.value
+        self.fov_maxdec = np.max(all_dec) / galsim.degrees.value
+
+        u, v = self.project(all_ra, all_dec)
+        self.bounds = galsim.BoundsD(np.min(u), np.max(u), np.min(v), np.max(v))
+        self.rmax = np.max(u**2 + v**2)**0.5
+
+        # All chips have the same number of points, so we can reshape to get each chip's values.
+        u = u.reshape(self.nchips, -1)
+        v = v.reshape(self.nchips, -1)
+        self.chip_bounds = np.column_stack(
+                (u.min(axis=1), u.max(axis=1), v.min(axis=1), v.max(axis=1)))
+        self.chip_polygons = [ np.column_stack((u[k][c.perimeter], v[k][c.perimeter]))
+                               for k, c in enumerate(chips) ]
+        self._buildIndex()
+
+    def _buildIndex(self):
+        # A grid over the focal plane, where each cell lists the chips whose bounds overlap it.
+        # The cells are about the size of a chip, so each one only has a few chips to check.
+        b = self.bounds
+        size = np.median(np.maximum(self.chip_bounds[:,1] - self.chip_bounds[:,0],
+                                    self.chip_bounds[:,3] - self.chip_bounds[:,2]))
+        self._nx = max(int(np.ceil((b.xmax - b.xmin) / size)), 1)
+        self._ny = max(int(np.ceil((b.ymax - b.ymin) / size)), 1)
+        self._cell_size = size
+        i1, j1 = self._cell(self.chip_bounds[:,0], self.chip_bounds[:,2])
+        i2, j2 = self._cell(self.chip_bounds[:,1], self.chip_bounds[:,3])
+        self._cell_chips = np.zeros((self.nchips, self._ny, self._nx), dtype=bool)
+        for k in range(self.nchips):
+            self._cell_chips[k, j1[k]:j2[k]+1, i1[k]:i2[k]+1] = True
+
+    def _cell(self, u, v):
+        # The grid cell for each position, clipped to the grid.
+        i = np.floor((np.asarray(u) - self.bounds.xmin) / self._cell_size).astype(int)
+        j = np.floor((np.asarray(v) - self.bounds.ymin) / self._cell_size).astype(int)
+        return np.clip(i, 0, self._nx-1), np.clip(j, 0, self._ny-1)
+
+    def project(self, ra, dec):
+        """Project the given ra, dec values (in radians) onto the tangent plane.
+
+        @param ra           A numpy array of ra values (in radians).
+        @param dec          A numpy array of dec values (in radians).
+
+        @returns u, v as numpy arrays (in arcsec)
+        """
+        u, v = self.pointing.project_rad(ra, dec, projection='gnomonic')
+        return np.asarray(u) / galsim.arcsec.value, np.asarray(v) / galsim.arcsec.value
+
+    def find_chip(self, u, v):
+        """Find which chip each of the given tangent plane positions is on.
+
+        @param u            A numpy array of u values (in arcsec).
+        @param v            A numpy array of v values (in arcsec).
+
+        @returns a numpy array of the chip_num for each position, or -1 for positions that are
+                 not on any chip.  If chips overlap, this gives the lowest chip_num.
+        """
+        u = np.atleast_1d(np.asarray(u, dtype=float))
+        v = np.atleast_1d(np.asarray(v, dtype=float))
+        chip_num = np.full(u.shape, -1, dtype=int)
+        b = self.bounds
+        use = (u >= b.xmin) & (u <= b.xmax) & (v >= b.ymin) & (v <= b.ymax)
+        index = np.where(use)[0]
+        i, j = self._cell(u[index], v[index])
+        for k in range(self.nchips):
+            cand = index[self._cell_chips[k, j, i]]
+            xmin, xmax, ymin, ymax = self.chip_bounds[k]
+            cand = cand[(u[cand] >= xmin) & (u[cand] <= xmax) &
+                        (v[cand] >= ymin) & (v[cand] <= ymax)]
+            cand = cand[chip_num[cand] < 0]
+            inside = _inside_polygon(u[cand], v[cand], self.chip_polygons[k])
+            chip_num[cand[inside]] = k
+        return chip_num
+
+    def find_chip_radec(self, ra, dec):
+        """Find which chip each of the given ra, dec positions is on.
+
+        @param ra           A numpy array of ra values (in radians).
+        @param dec          A numpy array of dec values (in radians).
+
+        @returns a numpy array of the chip_num for each position, or -1 for positions that are
+                 not on any chip
+        """
+        u, v = self.project(ra, dec)
+        return self.find_chip(u, v)
+
+    def chip_num(self, world_pos):
+        """Return the chip that a CelestialCoord is on, or -1 if it is not on any chip.
+        """
+        return int(self.find_chip_radec(world_pos.ra.rad, world_pos.dec.rad)[0])
+
+    def focal_pos(self, world_pos):
+        """Return the position of a CelestialCoord in the tangent plane as a PositionD in arcsec.
+        """
+        u, v = self.project(world_pos.ra.rad, world_pos.dec.rad)
+        return galsim.PositionD(float(u), float(v))
+
+    def focal_r(self, world_pos):
+        """Return the distance of a CelestialCoord from the pointing in the tangent plane (arcsec).
+        """
+        pos = self.focal_pos(world_pos)
+        return (pos.x**2 + pos.y**2)**0.5
+
+def _inside_polygon(x, y, polygon):
+    # The standard crossing number test, done for all the points at once.  Count how many edges
+    # of the polygon a ray going in the +x direction from each point crosses.
+    inside = np.zeros(len(x), dtype=bool)
+    x1, y1 = polygon[:,0], polygon[:,1]
+    x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+    for k in range(len(polygon)):
+        cross = (y1[k] > y) != (y2[k] > y)
+        if y1[k] != y2[k]:
+            xcross = x1[k] + (y - y1[k]) * (x2[k] - x1[k]) / (y2[k] - y1[k])
+            cross &= x < xcross
+        inside ^= cross
+    return inside
+
+class ChipGeometryCache(object):
+    """A least recently used cache of ChipGeometry objects.
+
+    @param maxsize      The maximum number of chips to keep.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def __contains__(self, key):
+        return key in self._cache
+
+    def get(self, key):
+        """Get the ChipGeometry for the given key, or None if it is not in the cache.
+        """
+        geom = self._cache.get(key, None)
+        if geom is not None:
+            self._cache.move_to_end(key)
+        return geom
+
+    def put(self, key, geom):
+        """Add a ChipGeometry to the cache, removing the least recently used one if necessary.
+        """
+        self._cache[key] = geom
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
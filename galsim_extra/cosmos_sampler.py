@@ -1,32 +1,83 @@
 import galsim
+import hashlib
+import multiprocessing
 import numpy
 import os
+import time
+from collections import OrderedDict
+from .counter_seed import CounterSeed, counter_keys
+from .mixed_scene import AliasTable
+
+# The KDE arrays of the CosmosSampler objects that have been put in shared memory, keyed by
+# their share keys.  cf. CosmosSampler.share
+_cosmos_share = {}
+
+def InitWorkerArgs():
+    """Get the arguments for InitWorker, which is run at the start of each worker process.
+    """
+    return (_cosmos_share,)
+
+def InitWorker(share):
+    """Make the shared KDE arrays available in a worker process.
+    """
+    _cosmos_share.update(share)
 
 class CosmosSampler(object):
     _req_params = {}
     _opt_params = { 'min_r50' : float, 'max_r50': float,
                    'min_flux' : float, 'max_flux': float,
-                   'kde_factor' : float }
+                   'kde_factor' : float, 'block_size' : int, 'cache_dir' : str,
+                   'truncate' : bool, 'engine' : str, 'grid_size' : int }
     _single_params = []
-    _takes_rng = True # It doesn't actually need an rng, but this marks it as "unsafe"
-                      # to the ProcessInput function, which avoids some multiprocessing
-                      # pickle problems.
+
+    # The number of blocks to keep when using block_size > 0.
+    _max_blocks = 8
+
+    # Update this if the contents of the cache files change.
+    _cache_version = 1
+
+    # The number of Gauss-Legendre points used to integrate each kernel over the allowed ranges.
+    _nquad = 20
+
+    _valid_engines = ('kde', 'grid')
 
     def __init__(self, min_r50=0.05, max_r50=2.0, min_flux=0.5, max_flux=100,
-                 kde_factor=0.01, rng=None):
-        # Make sure required dependencies are checked right away, so the user gets timely
-        # feedback of what this code requires.
-        import scipy
-        import fitsio
+                 kde_factor=0.01, block_size=0, cache_dir=None, truncate=False, engine='kde',
+                 grid_size=256, rng=None):
         self.r50_range = (min_r50, max_r50)
         self.flux_range = (min_flux, max_flux)
 
         self.r50_sanity_range=0.05,2.0
         self.flux_sanity_range=0.5,100.0
         self.kde_factor=kde_factor
+        if block_size < 0:
+            raise galsim.GalSimRangeError("block_size must be >= 0", block_size, 0)
+        self.block_size=block_size
+        self._blocks=OrderedDict()
+        self._share_key=None
+        self.truncate=truncate
+        self.acceptance_rate=None
+        if engine not in self._valid_engines:
+            raise galsim.GalSimValueError("Invalid engine for CosmosSampler", engine,
+                                          self._valid_engines)
+        if grid_size < 2:
+            raise galsim.GalSimRangeError("grid_size must be >= 2", grid_size, 2)
+        self.engine=engine
+        self.grid_size=grid_size
 
-        self._load_data()
-        self._make_kde()
+        if cache_dir is None:
+            # Make sure required dependencies are checked right away, so the user gets timely
+            # feedback of what this code requires.
+            import scipy
+            import fitsio
+            self._load_data()
+            self._make_kde()
+        else:
+            self._load_cache(cache_dir)
+        # The Cholesky factor of the kernel covariance, for sample_block.
+        self.chol=numpy.linalg.cholesky(self.kde.covariance)
+        self._setup_truncation()
+        self._setup_grid()
 
     def resample(self, size, rand):
         # Equivalent to this line:
@@ -57,11 +108,18 @@ class CosmosSampler(object):
         r50min,r50max=self.r50_range
         fmin,fmax=self.flux_range
 
+        rand = numpy.random.RandomState(rng.raw())
+        if self.engine == 'grid':
+            data = self.sample_grid(size, rand)
+            return data[0,:] if is_scalar else data
+        if self.truncate:
+            data = self.sample_truncated(size, rand)
+            return data[0,:] if is_scalar else data
+
         data=numpy.zeros( (size,2) )
 
         ngood=0
         nleft=data.shape[0]
-        rand = numpy.random.RandomState(rng.raw())
         while nleft > 0:
             r = self.resample(nleft, rand).T
 
@@ -81,8 +139,282 @@ class CosmosSampler(object):
 
         return data
 
-    def _load_data(self):
-        import fitsio
+    def _setup_truncation(self):
+        """
+        Calculate the probability mass of each kernel within the allowed ranges, for truncate.
+
+        In terms of the Cholesky factor L of the covariance, a kernel at (m0, m1) is
+            r50 = m0 + L00 z0
+            flux = m1 + L10 z0 + L11 z1
+        where z0, z1 are unit normal deviates.  So the mass within the ranges is the integral
+        over the allowed z0 of phi(z0) times the probability that z1 gives an allowed flux,
+        which is done with Gauss-Legendre quadrature for all the kernels at once.
+
+        The total mass divided by the number of kernels is the fraction of the draws that
+        would be accepted without truncate, which is saved as acceptance_rate.
+        """
+        if not self.truncate:
+            self._kernel_cdf=None
+            return
+        from scipy.special import ndtr
+
+        z0min, z0max = self._z0_range(self.kde.dataset[0])
+        # Past 9 sigma, there is no mass to speak of.
+        z0min=numpy.clip(z0min, -9, 9)
+        z0max=numpy.clip(z0max, -9, 9)
+        x, w = numpy.polynomial.legendre.leggauss(self._nquad)
+        half=0.5 * (z0max - z0min)
+        z0=(z0min + half)[:,numpy.newaxis] + half[:,numpy.newaxis] * x
+        z1min, z1max = self._z1_range(self.kde.dataset[1][:,numpy.newaxis], z0)
+        integrand=numpy.exp(-0.5 * z0**2) / numpy.sqrt(2.*numpy.pi) * (ndtr(z1max) - ndtr(z1min))
+        mass=half * integrand.dot(w)
+
+        self.acceptance_rate=numpy.sum(mass) / self.kde.n
+        if self.acceptance_rate <= 0.:
+            raise galsim.GalSimValueError(
+                "No COSMOS galaxies are within the given r50 and flux ranges",
+                (self.r50_range, self.flux_range))
+        self._kernel_cdf=numpy.cumsum(mass)
+        self._kernel_cdf/=self._kernel_cdf[-1]
+
+    def _z0_range(self, m0):
+        r50min,r50max=self.r50_range
+        return (r50min - m0) / self.chol[0,0], (r50max - m0) / self.chol[0,0]
+
+    def _z1_range(self, m1, z0):
+        fmin,fmax=self.flux_range
+        m=m1 + self.chol[1,0] * z0
+        return (fmin - m) / self.chol[1,1], (fmax - m) / self.chol[1,1]
+
+    def sample_truncated(self, size, rand):
+        """
+        get [:, r50_flux] for size objects, drawing from the kernels truncated to the allowed
+        ranges, rather than rejecting the draws outside the ranges.
+
+        Each kernel is chosen with probability proportional to its mass within the ranges, and
+        then r50 is drawn from the kernel's truncated normal distribution in r50 and flux from
+        its truncated normal distribution in flux given that r50.  This takes exactly one pass,
+        however narrow the ranges are.  (Within the kernels that straddle an edge of the flux
+        range, r50 is not weighted by how much of the flux range it allows, which is a very
+        small effect for the narrow kernels used here.)
+
+        @param size     The number of objects to draw.
+        @param rand     A numpy.random.RandomState to use for the random numbers.
+        """
+        u=rand.random_sample(size=(3,size))
+        indices=numpy.searchsorted(self._kernel_cdf, u[0], side='right')
+        indices=numpy.minimum(indices, self.kde.n-1)
+        m0=self.kde.dataset[0][indices]
+        m1=self.kde.dataset[1][indices]
+        z0=_TruncatedNormal(u[1], *self._z0_range(m0))
+        z1=_TruncatedNormal(u[2], *self._z1_range(m1, z0))
+        data=numpy.empty( (size,2) )
+        data[:,0] = m0 + self.chol[0,0] * z0
+        data[:,1] = m1 + self.chol[1,0] * z0 + self.chol[1,1] * z1
+        return data
+
+    def _setup_grid(self):
+        """
+        Tabulate the probability of the KDE in a grid_size x grid_size grid of cells covering
+        the allowed ranges, for engine = 'grid'.
+
+        The kernel centers are binned onto a grid that extends a few kernel widths past the
+        ranges, convolved with the kernel, and then cut down to the ranges.  An alias table of
+        the probability of the cells (in row-major order) is saved for sample_grid.
+        """
+        if self.engine != 'grid':
+            self._grid_alias=None
+            return
+        from scipy.signal import fftconvolve
+
+        n=self.grid_size
+        r50min,r50max=self.r50_range
+        fmin,fmax=self.flux_range
+        self._grid_dx=(r50max - r50min) / n
+        self._grid_dy=(fmax - fmin) / n
+
+        # Pad by 6 sigma of the kernel on each side.
+        sigma=numpy.sqrt(numpy.diag(self.kde.covariance))
+        px=int(numpy.ceil(6 * sigma[0] / self._grid_dx))
+        py=int(numpy.ceil(6 * sigma[1] / self._grid_dy))
+        xedges=r50min + self._grid_dx * numpy.arange(-px, n+px+1)
+        yedges=fmin + self._grid_dy * numpy.arange(-py, n+py+1)
+        hist=numpy.histogram2d(self.kde.dataset[0], self.kde.dataset[1],
+                               bins=[xedges, yedges])[0]
+
+        # The kernel, sampled at the cell centers.
+        x=self._grid_dx * numpy.arange(-px, px+1)
+        y=self._grid_dy * numpy.arange(-py, py+1)
+        xy=numpy.stack(numpy.meshgrid(x, y, indexing='ij'), axis=-1)
+        z=numpy.linalg.solve(self.chol, xy.reshape(-1,2).T)
+        kernel=numpy.exp(-0.5 * numpy.sum(z**2, axis=0)).reshape(xy.shape[:2])
+        kernel/=numpy.sum(kernel)
+
+        mass=fftconvolve(hist, kernel, mode='same')[px:px+n, py:py+n]
+        # The fft can give slightly negative values where there is nothing.
+        mass=numpy.clip(mass, 0., None)
+
+        self.acceptance_rate=numpy.sum(mass) / self.kde.n
+        if self.acceptance_rate <= 0.:
+            raise galsim.GalSimValueError(
+                "No COSMOS galaxies are within the given r50 and flux ranges",
+                (self.r50_range, self.flux_range))
+        self._grid_alias=AliasTable(mass.ravel() / numpy.sum(mass))
+
+    def sample_grid(self, size, rand):
+        """
+        get [:, r50_flux] for size objects from the tabulated grid, for engine = 'grid'.
+
+        A cell is picked with an alias table, which takes the same time for any number of cells.
+        The leftover fraction of the deviate within the probability of the cell (or of its
+        alias) is uniform, so it gives the flux within the cell, and another uniform deviate
+        gives r50 within the cell.  So the cost per object doesn't depend on the number of
+        galaxies in the KDE or on grid_size.
+
+        @param size     The number of objects to draw.
+        @param rand     A numpy.random.RandomState to use for the random numbers.
+        """
+        u=rand.random_sample(size=(2,size))
+        alias_prob, alias=self._grid_alias
+        n=len(alias)
+        nu=u[0] * n
+        k=numpy.minimum(nu.astype(int), n-1)
+        r=nu - k
+        p=alias_prob[k]
+        use_alias=r >= p
+        frac=numpy.where(use_alias, r - p, r) / numpy.where(use_alias, 1. - p, p)
+        frac=numpy.clip(frac, 0., 1.)
+        k=numpy.where(use_alias, alias[k], k)
+        i, j = numpy.divmod(k, self.grid_size)
+        data=numpy.empty( (size,2) )
+        data[:,0] = self.r50_range[0] + (i + u[1]) * self._grid_dx
+        data[:,1] = self.flux_range[0] + (j + frac) * self._grid_dy
+        return data
+
+    def sample_block(self, seed, size):
+        """
+        get [:, r50_flux] for a block of size objects, all at once.
+
+        This uses the Cholesky factor of the kernel covariance, rather than having
+        multivariate_normal calculate an SVD for every call, and numpy.random.RandomState(seed)
+        for the random numbers.  The values are not the same as the ones from sample.
+        With truncate, this just uses sample_truncated, and with engine = 'grid', it uses
+        sample_grid.
+        """
+        r50min,r50max=self.r50_range
+        fmin,fmax=self.flux_range
+
+        data=numpy.zeros( (size,2) )
+
+        ngood=0
+        rand = numpy.random.RandomState(seed)
+        if self.engine == 'grid':
+            return self.sample_grid(size, rand)
+        if self.truncate:
+            return self.sample_truncated(size, rand)
+        while ngood < size:
+            # Draw a few more than we need, since some will be outside the allowed ranges.
+            n = size - ngood + 16
+            norm = rand.standard_normal(size=(n,self.kde.d)).dot(self.chol.T)
+            indices = rand.randint(0, self.kde.n, size=n)
+            r = self.kde.dataset[:, indices].T + norm
+
+            w,=numpy.where( (r[:,0] > r50min) &
+                            (r[:,0] < r50max) &
+                            (r[:,1] > fmin) &
+                            (r[:,1] < fmax)
+            )
+            w = w[:size-ngood]
+            data[ngood:ngood+w.size,:] = r[w,:]
+            ngood += w.size
+
+        return data
+
+    def get_sample(self, counter, key=()):
+        """
+        get [r50, flux] for the object with the given counter, using block_size > 0.
+
+        The counters are grouped into blocks of block_size consecutive values, and all the
+        objects in a block are drawn at once with sample_block.  The most recent blocks are kept,
+        so objects with nearby counters (normally the next objects) are then just looked up.  The
+        value for each object only depends on the counter, the key (and block_size).
+
+        The counter is normally the object's seed, which is consecutive for consecutive objects.
+        But seeds that are hashes (e.g. FocalPlane with seed_mode = counter) would need a new
+        block for every object, so then the counter is the last counter of the hash (e.g.
+        obj_index) and the key is a tuple of the other values it depends on (e.g. exp_num).
+
+        @param counter      The counter for this object.
+        @param key          A tuple of other integers that identify the sequence of counters.
+                            [default: ()]
+        """
+        block, k = divmod(counter, self.block_size)
+        block_key = tuple(key) + (block,)
+        data = self._blocks.get(block_key, None)
+        if data is None:
+            data = self.sample_block(CounterSeed(*(block_key + (self.block_size,))),
+                                     self.block_size)
+            self._blocks[block_key] = data
+            while len(self._blocks) > self._max_blocks:
+                self._blocks.popitem(last=False)
+        else:
+            self._blocks.move_to_end(block_key)
+        return data[k,:]
+
+    def share(self):
+        """
+        Move the KDE dataset and covariance into shared memory.
+
+        After this, pickling the sampler (e.g. to send it to another process) only sends a
+        key to the shared arrays, not the arrays themselves.  The shared arrays are available
+        in any process forked after this is called, which includes the galsim.config worker
+        processes.
+        """
+        if self._share_key is not None:
+            return
+        ctx=multiprocessing.get_context('fork')
+        arrays={}
+        for name, array in [ ('dataset', self.kde.dataset), ('covariance', self.kde.covariance) ]:
+            raw=ctx.RawArray('d', array.size)
+            numpy.frombuffer(raw, dtype=float)[:] = numpy.ravel(array)
+            arrays[name]=(raw, array.shape)
+        self._share_key='%d_%d'%(os.getpid(), id(self))
+        _cosmos_share[self._share_key]=arrays
+        self._use_share()
+        # This is only needed to make the KDE, so don't keep a separate copy of it.
+        self.alldata=None
+
+    def _use_share(self):
+        arrays=_cosmos_share[self._share_key]
+        dataset, covariance=[ numpy.frombuffer(raw, dtype=float).reshape(shape)
+                              for raw, shape in [ arrays['dataset'], arrays['covariance'] ] ]
+        self.kde=CachedKDE(dataset, covariance)
+        self.chol=numpy.linalg.cholesky(self.kde.covariance)
+
+    def __getstate__(self):
+        state=self.__dict__.copy()
+        state['_blocks']=OrderedDict()
+        state['_kernel_cdf']=None
+        state['_grid_alias']=None
+        if self._share_key is not None:
+            del state['kde']
+            del state['chol']
+        else:
+            # gaussian_kde can't be pickled, but we only need its arrays.
+            state['kde']=CachedKDE(self.kde.dataset, self.kde.covariance)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._share_key is not None:
+            if self._share_key not in _cosmos_share:
+                raise galsim.GalSimError(
+                    "The shared memory for this CosmosSampler isn't available in this process.")
+            self._use_share()
+        self._setup_truncation()
+        self._setup_grid()
+
+    def _catalog_file_name(self):
         fname='real_galaxy_catalog_25.2_fits.fits'
         fname=os.path.join(
             #sys.exec_prefix,
@@ -92,6 +424,11 @@ class CosmosSampler(object):
             'COSMOS_25.2_training_sample',
             fname,
         )
+        return fname
+
+    def _load_data(self):
+        import fitsio
+        fname=self._catalog_file_name()
 
         r50min,r50max=self.r50_sanity_range
         fmin,fmax=self.flux_sanity_range
@@ -119,6 +456,96 @@ class CosmosSampler(object):
             bw_method=self.kde_factor,
         )
 
+    def _cache_key(self):
+        """
+        A hash of everything that goes into the KDE: the cache version, the sanity cuts,
+        kde_factor and the catalog file.  The catalog is identified by its path, size and
+        modification time, so this doesn't need to read the whole file in every process.
+        """
+        file_name=os.path.abspath(self._catalog_file_name())
+        stat=os.stat(file_name)
+        h=hashlib.sha1()
+        h.update(repr((self._cache_version, self.r50_sanity_range, self.flux_sanity_range,
+                       self.kde_factor, file_name, stat.st_size, stat.st_mtime_ns)).encode())
+        return h.hexdigest()[:16]
+
+    def _load_cache(self, cache_dir):
+        """
+        Load the KDE data from the cache in cache_dir, making it first if necessary.
+
+        The KDE dataset is saved in a .npy file, which is memory mapped, so all the processes
+        using the same cache share the same memory.  The covariance is saved in a separate
+        small .npy file.
+        """
+        base_name=os.path.join(cache_dir, 'cosmos_sampler_v%d_%s'%(self._cache_version,
+                                                                   self._cache_key()))
+        data_file=base_name + '.npy'
+        cov_file=base_name + '_cov.npy'
+        if not os.path.isfile(data_file) or not os.path.isfile(cov_file):
+            import scipy
+            import fitsio
+            self._load_data()
+            self._make_kde()
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir, exist_ok=True)
+            # Write to temporary files and then move them into place, so other processes
+            # never see a partially written file.  The data file is moved last, since other
+            # processes will only load the cache once both files are there.
+            for fname, array in [ (cov_file, self.kde.covariance),
+                                  (data_file, self.kde.dataset) ]:
+                tmp_file_name=fname + '.%d.tmp'%os.getpid()
+                with open(tmp_file_name, 'wb') as f:
+                    numpy.save(f, array)
+                os.replace(tmp_file_name, fname)
+
+        self.kde=CachedKDE(numpy.load(data_file, mmap_mode='r'), numpy.load(cov_file))
+
+def _TruncatedNormal(u, a, b):
+    # Convert uniform deviates u into unit normal deviates truncated to a < z < b, using the
+    # inverse of the cumulative distribution.  For ranges above the mean, use the symmetry
+    # to work in the lower tail, where ndtr doesn't lose precision.
+    from scipy.special import ndtr, ndtri
+    flip=a > 0
+    lo=numpy.where(flip, -b, a)
+    hi=numpy.where(flip, -a, b)
+    plo=ndtr(lo)
+    phi=ndtr(hi)
+    z=numpy.clip(ndtri(plo + u * (phi - plo)), lo, hi)
+    return numpy.where(flip, -z, z)
+
+class CachedKDE(object):
+    """
+    The parts of a scipy.stats.gaussian_kde that CosmosSampler uses, read from the cache
+    or from shared memory.
+
+    @param dataset      The (d, n) array of data points.
+    @param covariance   The (d, d) covariance matrix of the kernel.
+    """
+    def __init__(self, dataset, covariance):
+        self.dataset=dataset
+        self.covariance=covariance
+        self.d, self.n=dataset.shape
+
+def _ObjCounter(config, base):
+    # The counter and key to use with get_sample for this object.  Normally, the counter is the
+    # seed of the rng that GetRNG would use.  These are consecutive integers for consecutive
+    # objects (or consecutive objects in an exposure with FocalPlane).  But CounterSeed seeds are
+    # hashes, so then use its last counter (e.g. obj_index) and key on the rest.
+    random_seed = base['image']['random_seed']
+    if isinstance(random_seed, list):
+        rng_num = config.get('rng_num',0)
+        spec = random_seed[rng_num]
+        if isinstance(spec, dict) and spec.get('type',None) == 'CounterSeed' and spec.get('keys'):
+            params = galsim.config.GetAllParams(spec, base, req={ 'first' : int },
+                                                opt={ 'stream' : int }, ignore=['keys'])[0]
+            first = params['first']
+            stream = params.get('stream', 0)
+            counters = [ counter_keys[key](base) for key in spec['keys'] ]
+            return counters[-1], tuple([first, stream] + counters[:-1])
+        return galsim.config.ParseValue(random_seed, rng_num, base, int)[0], ()
+    else:
+        return galsim.config.ParseValue(base['image'], 'random_seed', base, int)[0], ()
+
 def CosmosR50Flux(config, base, name):
 
     index, index_key = galsim.config.GetIndex(config, base)
@@ -126,7 +553,10 @@ def CosmosR50Flux(config, base, name):
 
     if base.get('_cosmos_sampler_index',None) != index:
         cosmos_sampler = galsim.config.GetInputObj('cosmos_sampler', config, base, name)
-        r50, flux = cosmos_sampler.sample(rng)
+        if cosmos_sampler.block_size > 0 and index_key == 'obj_num':
+            r50, flux = cosmos_sampler.get_sample(*_ObjCounter(config, base))
+        else:
+            r50, flux = cosmos_sampler.sample(rng)
         base['_cosmos_sampler_r50'] = r50
         base['_cosmos_sampler_flux'] = flux
         base['_cosmos_sampler_index'] = index
@@ -145,8 +575,78 @@ def CosmosFlux(config, base, value_type):
     r50, flux = CosmosR50Flux(config,base,'CosmosFlux')
     return flux, False
 
-galsim.config.RegisterInputType('cosmos_sampler', galsim.config.InputLoader(CosmosSampler))
-galsim.config.RegisterValueType('CosmosR50', CosmosR50, [float], input_type='cosmos_sampler')
-galsim.config.RegisterValueType('CosmosFlux', CosmosFlux, [float], input_type='cosmos_sampler')
+def BenchmarkGrid(nsample=100000, seed=1234, **kwargs):
+    """
+    Compare the speed and accuracy of engine = 'grid' with exact draws from the KDE (rejecting
+    the values outside the ranges).
+
+    @param nsample      The number of values to draw with each engine. [default: 100000]
+    @param seed         The seed to use for the random numbers. [default: 1234]
+    @param kwargs       Any other CosmosSampler parameters, e.g. min_r50, grid_size.
+
+    @returns a dict with
+        kde_time, grid_time         The time in seconds to draw nsample values.
+        grid_setup_time             The time in seconds to tabulate the grid.
+        mean_error, std_error       The relative differences of the means and standard
+                                    deviations of [r50, flux] from the KDE values.
+        corr_error                  The difference of the r50, flux correlation coefficient.
+        ks_r50, ks_flux             The Kolmogorov-Smirnov distances between the r50 and flux
+                                    distributions, i.e. the maximum difference of the
+                                    cumulative distributions.
+    """
+    kde_sampler=CosmosSampler(truncate=False, engine='kde', **kwargs)
+    grid_sampler=CosmosSampler(engine='grid', **kwargs)
+    # Time the tabulation on its own, without the KDE setup, which both engines need.
+    t0=time.time()
+    grid_sampler._setup_grid()
+    grid_setup_time=time.time() - t0
 
+    t0=time.time()
+    data1=kde_sampler.sample_block(seed, nsample)
+    t1=time.time()
+    data2=grid_sampler.sample_block(seed + 1, nsample)
+    t2=time.time()
 
+    def ks(x1, x2):
+        x=numpy.sort(numpy.concatenate([x1, x2]))
+        cdf1=numpy.searchsorted(numpy.sort(x1), x, side='right') / len(x1)
+        cdf2=numpy.searchsorted(numpy.sort(x2), x, side='right') / len(x2)
+        return numpy.max(numpy.abs(cdf1 - cdf2))
+
+    mean1=numpy.mean(data1, axis=0)
+    std1=numpy.std(data1, axis=0)
+    return {
+        'kde_time' : t1 - t0,
+        'grid_time' : t2 - t1,
+        'grid_setup_time' : grid_setup_time,
+        'mean_error' : (numpy.mean(data2, axis=0) - mean1) / mean1,
+        'std_error' : (numpy.std(data2, axis=0) - std1) / std1,
+        'corr_error' : numpy.corrcoef(data2.T)[0,1] - numpy.corrcoef(data1.T)[0,1],
+        'ks_r50' : ks(data1[:,0], data2[:,0]),
+        'ks_flux' : ks(data1[:,1], data2[:,1]),
+    }
+
+class CosmosSamplerLoader(galsim.config.InputLoader):
+    """
+    The loader for the cosmos_sampler input type.
+
+    When the parameters are the same for all files, the sampler is built once in the main
+    process and its arrays are put in shared memory, so the worker processes can all use it
+    without building their own or going through a proxy.
+    """
+    def initialize(self, input_objs, num, base, logger):
+        # GalSim only makes an _input_manager when it is going to use multiple processes.
+        # current_nproc is set in the worker processes.
+        if '_input_manager' in base and 'current_nproc' not in base:
+            logger.debug('Putting cosmos_sampler %d in shared memory', num)
+            input_objs[num].share()
+        if input_objs[num].acceptance_rate is not None:
+            logger.info('cosmos_sampler %d: Fraction of the KDE within the ranges = %f',
+                        num, input_objs[num].acceptance_rate)
+
+galsim.config.RegisterInputType('cosmos_sampler',
+                                CosmosSamplerLoader(CosmosSampler, use_proxy=False,
+                                                    worker_init=InitWorker,
+                                                    worker_initargs=InitWorkerArgs))
+galsim.config.RegisterValueType('CosmosR50', CosmosR50, [float], input_type='cosmos_sampler')
+galsim.config.RegisterValueType('CosmosFlux', CosmosFlux, [float], input_type='cosmos_sampler')
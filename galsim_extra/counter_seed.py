@@ -0,0 +1,121 @@
+#
+# This file defines a counter-based random seed, which is used by the FocalPlane output type when
+# output.seed_mode = counter.
+#
+# The normal FocalPlane seeds are based on obj_num, which means that to build some chip, you need
+# to know how many objects were in all the previous exposures.  Counter-based seeds instead
+# calculate the seed directly from a hash of the first seed and a few counters (e.g. exp_num,
+# chip_num and the index of the object within the exposure), so the seeds for any chip can be
+# calculated without knowing anything about the other exposures or chips.
+
+import galsim
+import numpy as np
+from .batch_seed import RegisterBatchSeed
+
+_mask64 = (1 << 64) - 1
+
+def _mix64(x):
+    # The splitmix64 finalizer.  This is a bijection on 64 bit integers with good avalanche
+    # properties, so nearby counters give unrelated outputs.
+    x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & _mask64
+    x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & _mask64
+    return x ^ (x >> 31)
+
+def _mix64_array(x):
+    # The same as _mix64 for a numpy uint64 array.
+    # Note: numpy's uint64 arithmetic wraps around on overflow, which is what we want here.
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+def CounterSeed(first, stream, *counters):
+    """Calculate a random seed from the first seed, a stream number and any number of counters.
+
+    The same inputs always give the same seed.  Different streams give unrelated seeds for the
+    same counters, so they can be used for different purposes (e.g. noise vs galaxies).
+
+    @param first        The first random seed (usually image.random_seed).
+    @param stream       An integer identifying what the seed is used for.
+    @param counters     Any number of non-negative integer counters, e.g. exp_num, chip_num.
+
+    @returns a seed in the range [1, 2**31]
+    """
+    h = _mix64((first & _mask64) ^ 0x9e3779b97f4a7c15)
+    for c in (stream,) + counters:
+        h = _mix64((h + (int(c) & _mask64) + 0x9e3779b97f4a7c15) & _mask64)
+    return int(h >> 33) + 1
+
+def HashUniform(seeds):
+    """Calculate a uniform deviate in [0,1) from a hash of each of the given seeds.
+
+    This is a vectorized version of the same splitmix64 hash used by CounterSeed, so it can be
+    used to get one random number for each of many objects at once from their seeds.
+
+    @param seeds        A numpy array of non-negative integer seeds.
+
+    @returns a numpy array of uniform deviates
+    """
+    x = _mix64_array(np.asarray(seeds).astype(np.uint64) + np.uint64(0x9e3779b97f4a7c15))
+    # Use the top 53 bits, which is all a double can hold.
+    return (x >> np.uint64(11)).astype(float) / 2.**53
+
+def _obj_index(base):
+    # The index of the object within the exposure.  Every chip in an exposure has the same
+    # objects, so this repeats for each chip.
+    nobjects = galsim.config.ParseValue(base['image'], 'nobjects', base, int)[0]
+    return (base['obj_num'] - base['exp_start_obj_num']) % nobjects
+
+def _batch_obj_index(base, nobj):
+    # The index within the exposure of nobj objects starting at base['obj_num'].
+    nobjects = galsim.config.ParseValue(base['image'], 'nobjects', base, int)[0]
+    return (base['obj_num'] + np.arange(nobj) - base['exp_start_obj_num']) % nobjects
+
+# The counters that may be used in the keys parameter of the CounterSeed type.
+counter_keys = {
+    'exp_num' : lambda base: base['exp_num'],
+    'chip_num' : lambda base: base['chip_num'],
+    'obj_index' : _obj_index,
+}
+
+# The same counters for nobj objects at once.
+batch_counter_keys = {
+    'exp_num' : lambda base, nobj: base['exp_num'],
+    'chip_num' : lambda base, nobj: base['chip_num'],
+    'obj_index' : _batch_obj_index,
+}
+
+def _CounterSeedParams(config, base):
+    req = { 'first' : int }
+    opt = { 'stream' : int }
+    ignore = [ 'keys' ]  # This is a list, which we handle separately.
+    params, safe = galsim.config.GetAllParams(config, base, req=req, opt=opt, ignore=ignore)
+
+    keys = config.get('keys', [])
+    for key in keys:
+        if key not in counter_keys:
+            raise galsim.GalSimConfigValueError("Invalid key for type = CounterSeed", key,
+                                                list(counter_keys))
+    return params['first'], params.get('stream', 0), keys
+
+def GenCounterSeed(config, base, value_type):
+    """Generate a random seed from a hash of the first seed and the given counters.
+    """
+    first, stream, keys = _CounterSeedParams(config, base)
+    counters = [ counter_keys[key](base) for key in keys ]
+    return CounterSeed(first, stream, *counters), False
+
+def BatchCounterSeed(config, base, nobj):
+    """Calculate the CounterSeed values for nobj objects starting at base['obj_num'].
+
+    This is the same hash as CounterSeed, done for all the objects at once with numpy.
+    """
+    first, stream, keys = _CounterSeedParams(config, base)
+    counters = [ batch_counter_keys[key](base, nobj) for key in keys ]
+    golden = np.uint64(0x9e3779b97f4a7c15)
+    h = np.full(nobj, _mix64((first & _mask64) ^ 0x9e3779b97f4a7c15), dtype=np.uint64)
+    for c in [stream] + counters:
+        h = _mix64_array(h + np.asarray(c).astype(np.uint64) + golden)
+    return (h >> np.uint64(33)).astype(np.int64) + 1
+
+galsim.config.RegisterValueType('CounterSeed', GenCounterSeed, [ int ])
+RegisterBatchSeed('CounterSeed', BatchCounterSeed)
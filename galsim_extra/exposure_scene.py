@@ -0,0 +1,136 @@
+#
+# This module defines an exposure-level cache of the objects in a FocalPlane exposure.
+#
+# The FocalPlane output type sets the random seeds for the objects to repeat for each chip in an
+# exposure, so every chip nominally regenerates the full scene, only to skip the vast majority of
+# the objects as being off the chip.  The ExposureScene generates the positions (and object types
+# for MixedScene) once per exposure using exactly the same seeds, so each chip can trivially
+# skip the objects that are nowhere near it.  The objects that are near the chip are built the
+# normal way, so the output is identical to not using the cache.
+
+import galsim
+import numpy as np
+
+class ExposureScene(object):
+    """The positions and object types of all the objects in a single exposure.
+
+    @param exp_num          The exposure number.
+    @param start_obj_num    The obj_num of the first object on the first chip of the exposure.
+    @param ra               A numpy array of the ra values (in radians).
+    @param dec              A numpy array of the dec values (in radians).
+    @param obj_type_index   A numpy array of the object type indices, or -1 if the stamp type
+                            doesn't choose an object type.  [default: None, which means all -1]
+    @param obj_types        A list of the object type names. [default: None]
+    """
+    def __init__(self, exp_num, start_obj_num, ra, dec, obj_type_index=None, obj_types=None):
+        self.exp_num = exp_num
+        self.start_obj_num = start_obj_num
+        self.ra = np.ascontiguousarray(ra, dtype=float)
+        self.dec = np.ascontiguousarray(dec, dtype=float)
+        if obj_type_index is None:
+            obj_type_index = np.full(len(self.ra), -1, dtype=np.int16)
+        self.obj_type_index = np.ascontiguousarray(obj_type_index, dtype=np.int16)
+        self.obj_types = list(obj_types) if obj_types is not None else []
+        self.buckets = None
+
+    @property
+    def nobjects(self):
+        return len(self.ra)
+
+    def assignChips(self, pointing, chip_bounds, border):
+        """Assign each object to the chip(s) that it might overlap.
+
+        The objects are projected onto the tangent plane of the focal plane in a single
+        vectorized pass, and then compared to the bounds of each chip in that plane, extended
+        by the given border.  Objects near the edge of a chip may be assigned to more than
+        one chip.  The results are saved as self.buckets.
+
+        @param pointing     The center of the focal plane as a CelestialCoord.
+        @param chip_bounds  A numpy array of shape (nchips, 4) with the (xmin, xmax, ymin, ymax)
+                            bounds of each chip in the tangent plane (in arcsec).
+        @param border       The border in arcsec around each chip within which objects are kept.
+        """
+        u, v = pointing.project_rad(self.ra, self.dec, projection='gnomonic')
+        u = np.asarray(u) * (galsim.radians / galsim.arcsec)
+        v = np.asarray(v) * (galsim.radians / galsim.arcsec)
+
+        self.buckets = []
+        for xmin, xmax, ymin, ymax in np.asarray(chip_bounds):
+            keep = ((u > xmin - border) & (u < xmax + border) &
+                    (v > ymin - border) & (v < ymax + border))
+            self.buckets.append(np.flatnonzero(keep))
+
+    def getChipSkip(self, chip_num):
+        """Return a bool array indicating which objects can be trivially skipped for a chip.
+
+        This requires that assignChips has already been called.
+
+        @param chip_num     The chip number.
+
+        @returns skip, a numpy bool array with one value per object.
+        """
+        skip = np.ones(self.nobjects, dtype=bool)
+        skip[self.buckets[chip_num]] = False
+        return skip
+
+def BuildExposureScene(base, exp_num, nobjects, logger):
+    """Generate the positions and object types of all the objects in the current exposure.
+
+    This runs the normal stamp setup for each object using the same obj_num (and therefore the
+    same random number seeds) as the objects on the first chip of the exposure.  Since the
+    FocalPlane seeds repeat for every chip, the results apply to all chips in the exposure.
+
+    @param base         The base configuration dict.
+    @param exp_num      The current exposure number.
+    @param nobjects     The number of objects in the exposure.
+    @param logger       A logger object to log progress.
+
+    @returns an ExposureScene instance
+    """
+    if 'image_pos' in base['image'] or 'image_pos' in base.get('stamp',{}):
+        raise galsim.GalSimConfigValueError(
+            "FocalPlane scene_cache requires positions to be given by world_pos", 'image_pos')
+
+    start_obj_num = base['exp_start_obj_num']
+    orig_start_obj_num = base['start_obj_num']
+    orig_obj_num = base.get('obj_num', None)
+    orig_index_key = base.get('index_key', None)
+
+    # Sequences over obj_num_in_file should see the same index as on the first chip.
+    base['start_obj_num'] = start_obj_num
+
+    ra = np.empty(nobjects, dtype=float)
+    dec = np.empty(nobjects, dtype=float)
+    obj_type_index = np.full(nobjects, -1, dtype=np.int16)
+
+    for k in range(nobjects):
+        galsim.config.SetupConfigObjNum(base, start_obj_num + k, logger)
+        stamp = base['stamp']
+        builder = galsim.config.stamp.valid_stamp_types[stamp['type']]
+        builder.setupRNG(stamp, base, logger)
+        base.pop('current_obj_type_index', None)
+        xsize, ysize, image_pos, world_pos = builder.setup(
+                stamp, base, 0, 0, galsim.config.stamp.stamp_ignore, logger)
+        if not isinstance(world_pos, galsim.CelestialCoord):
+            raise galsim.GalSimConfigValueError(
+                "FocalPlane scene_cache requires celestial world_pos values", world_pos)
+        ra[k] = world_pos.ra.rad
+        dec[k] = world_pos.dec.rad
+        obj_type_index[k] = base.get('current_obj_type_index', -1)
+
+    if 'objects' in base['stamp']:
+        obj_types = list(base['stamp']['objects'].keys())
+    else:
+        obj_types = None
+
+    # Don't let any of the values we just calculated be reused as "current" values by the
+    # real objects, since that would skip the random number draws for them.
+    galsim.config.RemoveCurrent(base, keep_safe=True, index_key='obj_num')
+    base['start_obj_num'] = orig_start_obj_num
+    if orig_obj_num is not None:
+        base['obj_num'] = orig_obj_num
+    if orig_index_key is not None:
+        base['index_key'] = orig_index_key
+
+    logger.info('Built exposure scene for exp_num %d with %d objects', exp_num, nobjects)
+    return ExposureScene(exp_num, start_obj_num, ra, dec, obj_type_index, obj_types)
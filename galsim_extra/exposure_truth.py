@@ -0,0 +1,164 @@
+#
+# This module defines an extra output type called exposure_truth, which writes a single truth
+# catalog for each exposure of a FocalPlane run, rather than one per chip.
+#
+# The columns are specified the same way as for the normal truth output type, and a chip_num
+# column is added automatically.  The file_name should only depend on exp_num.  e.g.
+#
+#     output:
+#         exposure_truth:
+#             file_name:
+#                 type: FormattedStr
+#                 format: "truth_%s.fits"
+#                 items:
+#                 - { type: Catalog, col: 1, index_key: exp_num }
+#             columns:
+#                 num: obj_num
+#                 x: "$image_pos.x"
+#                 ...
+#
+# The output is a FITS binary table.  Each chip's rows are added to the table for its exposure,
+# replacing any rows from a previous run of that chip.  With galsim.config.Process, this happens
+# as each chip is finished, and a lock file next to the truth file makes sure that multiple
+# processes don't try to update it at the same time.  This rewrites the whole file for each
+# chip, so it takes O(nchips^2) I/O per exposure.  With ProcessFocalPlane, the chip tables are
+# collected in the main process, and each exposure's file is written once, after all of its
+# chips are done.
+
+import galsim
+import numpy as np
+import os
+
+class ExposureTruthBuilder(galsim.config.extra_truth.TruthBuilder):
+    """Build a truth catalog for the full exposure, with a chip_num column.
+    """
+    def initialize(self, data, scratch, config, base, logger):
+        if 'chip_num' not in base:
+            raise galsim.GalSimConfigError(
+                "exposure_truth requires output.type = FocalPlane")
+        super(ExposureTruthBuilder, self).initialize(data, scratch, config, base, logger)
+
+    def finalize(self, config, base, main_data, logger):
+        cat = super(ExposureTruthBuilder, self).finalize(config, base, main_data, logger)
+        if cat.nobjects > 0:
+            data = cat.makeData()
+        else:
+            data = np.empty(0, dtype=[ (str(name), float) for name in cat.names ])
+        self.table = MakeChipTable(data, base['chip_num'])
+        return self.table
+
+    def writeFile(self, file_name, config, base, logger):
+        if '_focalplane_exposure_truth' in base:
+            # ProcessFocalPlane will write all the chips in the exposure at once.
+            base['_focalplane_exposure_truth'].append( (file_name, base['chip_num'], self.table) )
+        else:
+            AddChipTables(file_name, { base['chip_num'] : self.table })
+
+    def writeHdu(self, config, base, logger):
+        raise galsim.GalSimConfigError("exposure_truth can only be written to a file.")
+
+def MakeChipTable(data, chip_num):
+    """Add a chip_num column to the start of the truth data for a chip.
+
+    Any string columns are converted to bytes, which is what fitsio requires.
+
+    @param data         A numpy structured array with the truth data for the chip.
+    @param chip_num     The chip number.
+
+    @returns a new numpy structured array with chip_num as the first column
+    """
+    dtype = [ ('chip_num', np.int32) ]
+    for name in data.dtype.names:
+        dt = data.dtype[name]
+        if dt.kind == 'U':
+            dt = np.dtype('S%d'%_StrLen(dt))
+        dtype.append( (name, dt) )
+    table = np.empty(len(data), dtype=dtype)
+    table['chip_num'] = chip_num
+    for name in data.dtype.names:
+        table[name] = data[name]
+    return table
+
+def _StrLen(dt):
+    # The number of characters in a string dtype.
+    return max(dt.itemsize//4, 1) if dt.kind == 'U' else dt.itemsize
+
+def MergeChipTables(tables):
+    """Concatenate the truth tables of several chips.
+
+    The string columns may have different lengths in each table, so this uses the longest one.
+    Chips with no objects don't know the types of the columns (they are all float), so the
+    column types are taken from the tables that have some rows.
+
+    @param tables       A list of numpy structured arrays with the same columns.
+
+    @returns the combined numpy structured array
+    """
+    typed = [ t for t in tables if len(t) > 0 ] or tables
+    dtype = []
+    for name in typed[0].dtype.names:
+        dt = typed[0].dtype[name]
+        if dt.kind in 'SU':
+            # fitsio may read back the string columns as unicode, which uses 4 bytes per char.
+            dt = np.dtype('S%d'%max([ _StrLen(t.dtype[name]) for t in typed ]))
+        dtype.append( (name, dt) )
+    return np.concatenate([ t.astype(dtype) for t in tables ])
+
+def AddChipTables(file_name, tables):
+    """Add the truth tables for some chips to the exposure truth file.
+
+    Any rows that are already in the file for these chips are replaced.  The rows are kept
+    sorted by chip_num.
+
+    @param file_name    The name of the exposure truth file.
+    @param tables       A dict of numpy structured arrays with the truth data for each chip,
+                        keyed by chip_num.
+    """
+    import fitsio
+    chip_nums = list(tables.keys())
+    tables = [ tables[chip_num] for chip_num in sorted(chip_nums) ]
+    with TruthFileLock(file_name):
+        if os.path.isfile(file_name):
+            old = fitsio.read(file_name, ext=1)
+            if old.dtype.names != tables[0].dtype.names:
+                raise galsim.GalSimConfigError(
+                    "The columns in %s don't match the exposure_truth columns"%file_name)
+            tables = [ old[~np.isin(old['chip_num'], chip_nums)] ] + tables
+        table = MergeChipTables(tables)
+        table = table[np.argsort(table['chip_num'], kind='stable')]
+        # Write to a temporary file and then move it into place, so there is never a partially
+        # written file, even if the job is killed.
+        tmp_file_name = file_name + '.tmp'
+        fitsio.write(tmp_file_name, table, clobber=True)
+        os.rename(tmp_file_name, file_name)
+
+class TruthFileLock(object):
+    """A lock on an exposure truth file, so only one process updates it at a time.
+
+    The lock is held on a separate file next to the truth file, since the truth file itself is
+    replaced each time it is written.  The lock file is removed when the lock is released.
+    Another process may have opened the lock file just before it was removed, so after getting
+    the lock, check that the file we locked is still the one at that path.
+
+    @param file_name    The name of the exposure truth file.
+    """
+    def __init__(self, file_name):
+        self.lock_file_name = file_name + '.lock'
+
+    def __enter__(self):
+        import fcntl
+        while True:
+            self.lock = open(self.lock_file_name, 'a')
+            fcntl.flock(self.lock, fcntl.LOCK_EX)
+            try:
+                if os.fstat(self.lock.fileno()).st_ino == os.stat(self.lock_file_name).st_ino:
+                    return self
+            except FileNotFoundError:
+                pass
+            self.lock.close()
+
+    def __exit__(self, *args):
+        os.remove(self.lock_file_name)
+        self.lock.close()
+
+galsim.config.RegisterExtraOutput('exposure_truth', ExposureTruthBuilder())
@@ -5,6 +5,11 @@ import numpy as np
 import copy
 
 from galsim.config.output import OutputBuilder
+from .exposure_scene import BuildExposureScene
+from .chip_geometry import ChipGeometry, ChipGeometryCache, FocalPlaneGeometry
+from .focal_plane_manifest import ChipManifest, ConfigHash
+from .counter_seed import CounterSeed
+from .profiling import ProfileStage
 
 class FocalPlaneBuilder(OutputBuilder):
     """Implements the FocalPlane custom output type.
@@ -22,6 +27,14 @@ class FocalPlaneBuilder(OutputBuilder):
             galsim.config.valid_index_keys += ['exp_num', 'chip_num']
             galsim.config.eval_base_variables += ['exp_num', 'chip_num', 'exp_start_obj_num']
 
+        # If using a manifest, get the config hash before we start modifying things below.
+        if 'manifest' in config and '_focalplane_config_hash' not in base:
+            base['_focalplane_config_hash'] = ConfigHash(base)
+
+        # Save the wcs specification, since image.wcs is replaced by the wcs of each chip below.
+        if '_focalplane_wcs' not in base:
+            base['_focalplane_wcs'] = base['image'].get('wcs', None)
+
         if 'nexp' in config:
             # Sometimes this will be called prior to ProcessInput being called, so if there is an
             # error, try loading the inputs and then try again.
@@ -40,10 +53,22 @@ class FocalPlaneBuilder(OutputBuilder):
         # save those values to a list, which is then fully deterministic for all other uses.
         if 'nobjects' not in base['image']:
             raise ValueError("image.nobjects is required for output type 'FocalPlane'")
+        seed_mode = config.get('seed_mode', 'sequence')
+        if seed_mode not in ('sequence', 'exposure', 'counter'):
+            raise galsim.GalSimConfigValueError("Invalid output.seed_mode.", seed_mode,
+                                                ('sequence', 'exposure', 'counter'))
+        if '_focalplane_first_seed' not in base:
+            base['_focalplane_first_seed'] = galsim.config.ParseValue(
+                    base['image'], 'random_seed', base, int)[0]
+        first = base['_focalplane_first_seed']
         nobj = base['image']['nobjects']
-        if not isinstance(nobj, dict) or not nobj.get('_setup_as_list', False):
-            seed = galsim.config.ParseValue(base['image'], 'random_seed', base, int)[0]
-            base['exp_num_rng'] = base['rng'] = galsim.BaseDeviate(seed)
+        if seed_mode == 'counter':
+            # In counter mode, each exposure gets its own rng seeded from exp_num, so we can
+            # get nobjects for any exposure without going through the previous ones.
+            if '_focalplane_nobjects' not in base:
+                base['_focalplane_nobjects'] = nobj
+        elif not isinstance(nobj, dict) or not nobj.get('_setup_as_list', False):
+            base['exp_num_rng'] = base['rng'] = galsim.BaseDeviate(first)
             nobj_list = []
             for exp_num in range(nexp):
                 base['exp_num'] = exp_num
@@ -55,13 +80,38 @@ class FocalPlaneBuilder(OutputBuilder):
                 'index_key' : 'exp_num',
                 '_setup_as_list' : True,
             }
+            if seed_mode == 'exposure':
+                # Likewise, draw a seed for each exposure to use for the exp_num rng.  This gets
+                # reset for each chip, so all chips in an exposure see the same random values
+                # for things with index_key = exp_num (e.g. the power spectrum), regardless of
+                # which chips were built before in this process.
+                ud = galsim.UniformDeviate(base['exp_num_rng'])
+                base['_focalplane_exp_seeds'] = [ int(ud() * 2**30) + 1
+                                                  for exp_num in range(nexp) ]
         logger.debug('nobjects = %s', galsim.config.CleanConfig(base['image']['nobjects']))
 
         # Set the random numbers to repeat for the objects so we get the same objects in the field
         # each time.
         rs = base['image']['random_seed']
-        if not isinstance(rs,list):
-            first = galsim.config.ParseValue(base['image'], 'random_seed', base, int)[0]
+        if not isinstance(rs,list) and seed_mode == 'counter':
+            # In counter mode, the seeds are hashes of the first seed and the exp_num, chip_num
+            # and index of the object within the exposure, so they don't depend on obj_num at all.
+            # The three seeds are used the same way as in the default sequence mode below.
+            base['image']['random_seed'] = []
+            if isinstance(rs,int):
+                base['image']['random_seed'].append(
+                    { 'type' : 'CounterSeed', 'first' : first, 'stream' : 0,
+                      'keys' : ['exp_num', 'chip_num', 'obj_index'] } )
+            else:
+                base['image']['random_seed'].append(rs)
+            base['image']['random_seed'].append(
+                { 'type' : 'CounterSeed', 'first' : first, 'stream' : 1,
+                  'keys' : ['exp_num', 'obj_index'] } )
+            base['image']['random_seed'].append(
+                { 'type' : 'CounterSeed', 'first' : first, 'stream' : 2,
+                  'keys' : ['obj_index'] } )
+
+        elif not isinstance(rs,list):
             base['image']['random_seed'] = []
             # The first one is the original random_seed specification, used for noise, since
             # that should be different on each chip, and probably most things in input, output,
@@ -75,26 +125,15 @@ class FocalPlaneBuilder(OutputBuilder):
             # The second one is used for the galaxies and repeats through the same set of seed
             # values for each chip in an expousre.
             base['image']['random_seed'].append(
-                {
-                    'type' : 'Eval',
-                    'str' : 'first + exp_start_obj_num + (obj_num - exp_start_obj_num) % nobjects',
-                    'ifirst' : first,
-                    'inobjects' : { 'type' : 'Current', 'key' : 'image.nobjects' }
-                }
-            )
+                { 'type' : 'ExposureSeed', 'first' : first } )
 
             # We also add a third one that will repeat for all exposures.  So could be used
             # for making galaxy properties the same in all exposures in a multi-exposure context.
             # Note: this would only work correctly if nobjects is constant.
             base['image']['random_seed'].append(
-                {
-                    'type' : 'Eval',
-                    'str' : 'first + (obj_num - exp_start_obj_num) % nobjects',
-                    'ifirst' : first,
-                    'inobjects' : { 'type' : 'Current', 'key' : 'image.nobjects' }
-                }
-            )
+                { 'type' : 'ExposureSeed', 'first' : first, 'all_exposures' : True } )
 
+        if not isinstance(rs,list):
             if 'gal' in base:
                 base['gal']['rng_num'] = 1
             if 'stamp' in base:
@@ -118,14 +157,101 @@ class FocalPlaneBuilder(OutputBuilder):
         chip_num = file_num % nchips
         base['exp_num'] = exp_num
         base['chip_num'] = chip_num
+        if seed_mode == 'counter':
+            base['image']['nobjects'] = self.getCounterNObjects(base, exp_num)
+            base['exp_num_rng'] = galsim.BaseDeviate(CounterSeed(first, 3, exp_num))
+        elif seed_mode == 'exposure':
+            base['exp_num_rng'] = galsim.BaseDeviate(base['_focalplane_exp_seeds'][exp_num])
         nobjects = galsim.config.ParseValue(base['image'], 'nobjects', base, int)[0]
         base['exp_start_obj_num'] = base['start_obj_num'] - chip_num * nobjects
+
+        # Keep the wcs of the most recently used chips, so we don't need to rebuild them.
+        if '_focalplane_wcs_cache' not in base:
+            if 'wcs_cache_size' in config:
+                cache_size = galsim.config.ParseValue(config, 'wcs_cache_size', base, int)[0]
+            else:
+                cache_size = 2 * nchips
+            base['_focalplane_wcs_cache'] = ChipGeometryCache(cache_size)
         logger.debug('file_num, nexp, nchips = %d, %d, %d', file_num, nexp, nchips)
         logger.debug('exp_num, chip_num = %d, %d', exp_num, chip_num)
 
+        # Skip any chips that were already finished according to the manifest.
+        if 'manifest' in config:
+            if '_focalplane_manifest' not in base:
+                file_name = galsim.config.ParseValue(config, 'manifest', base, str)[0]
+                if 'dir' in config:
+                    dir = galsim.config.ParseValue(config, 'dir', base, str)[0]
+                    file_name = os.path.join(dir, file_name)
+                base['_focalplane_manifest'] = ChipManifest(file_name,
+                                                            base['_focalplane_config_hash'])
+                base['_focalplane_skip'] = config.get('skip', False)
+            if self.isChipDone(base):
+                logger.info('Chip %d of exposure %d is already done according to the manifest',
+                            chip_num, exp_num)
+                config['skip'] = True
+            else:
+                config['skip'] = base['_focalplane_skip']
+
         # This sets up the RNG seeds.
         OutputBuilder.setup(self, config, base, file_num, logger)
 
+    def getCounterNObjects(self, base, exp_num):
+        """Get the number of objects in the given exposure when using seed_mode = counter.
+
+        The original image.nobjects specification is evaluated using an rng that is seeded
+        from just the first seed and exp_num, so this doesn't require evaluating nobjects for
+        any other exposures.
+
+        @param base             The base configuration dict.
+        @param exp_num          The exposure number.
+
+        @returns the number of objects
+        """
+        rng = galsim.BaseDeviate(CounterSeed(base['_focalplane_first_seed'], 4, exp_num))
+        base['exp_num_rng'] = base['rng'] = rng
+        field = { 'nobjects' : copy.deepcopy(base['_focalplane_nobjects']) }
+        return galsim.config.ParseValue(field, 'nobjects', base, int)[0]
+
+    def isChipDone(self, base):
+        """Check whether the current chip was already finished according to the manifest.
+
+        @param base             The base configuration dict.
+
+        @returns True if the chip is done, False otherwise
+        """
+        manifest = base.get('_focalplane_manifest', None)
+        return manifest is not None and manifest.isDone(base['exp_num'], base['chip_num'])
+
+    def writeFile(self, data, file_name, config, base, logger):
+        """Write the data to a file.
+
+        @param data             The data to write.
+        @param file_name        The file_name to write to.
+        @param config           The configuration dict for the output field.
+        @param base             The base configuration dict.
+        @param logger           If given, a logger object to log progress.
+        """
+        with ProfileStage(base, 'write'):
+            OutputBuilder.writeFile(self, data, file_name, config, base, logger)
+        base['_focalplane_file_name'] = file_name
+
+    def writeExtraOutputs(self, config, data, logger):
+        """Write any extra output items, and then add the chip to the manifest if using one.
+
+        Note: config here is the base configuration dict.
+
+        @param config           The base configuration dict.
+        @param data             The data to write.
+        @param logger           If given, a logger object to log progress.
+        """
+        # The exposure_truth file is the same for all the chips in an exposure, but we need to
+        # add each chip's rows to it, so don't let GalSim skip it as already written.
+        config.get('extra_last_file', {}).pop('exposure_truth', None)
+        OutputBuilder.writeExtraOutputs(self, config, data, logger)
+        if '_focalplane_manifest' in config:
+            config['_focalplane_manifest'].addChip(config['exp_num'], config['chip_num'],
+                                                   config['_focalplane_file_name'])
+
     def getNFiles(self, config, base):
         """Returns the number of files to be built.
 
@@ -162,9 +288,10 @@ class FocalPlaneBuilder(OutputBuilder):
 
         exp_num = base['exp_num']
         chip_num = base['chip_num']
-        first_chip_num = base['chip_num']
         req = { 'nchips' : int, }
-        opt = { 'nexp' : int, }
+        opt = { 'nexp' : int, 'scene_cache' : bool, 'scene_border' : float,
+                'wcs_cache_size' : int, 'edge_samples' : int, 'manifest' : str,
+                'seed_mode' : str }
         ignore += [ 'file_name', 'dir' ]
         kwargs = galsim.config.GetAllParams(config, base, req=req, opt=opt, ignore=ignore)[0]
         nexp = kwargs.get('nexp',1)
@@ -174,95 +301,348 @@ class FocalPlaneBuilder(OutputBuilder):
         # Additional setup only for the first time we get to this particular exp_num.
         if base.get('_focalplane_expnum_setup',None) != exp_num:
             logger.info('First file in the exposure.  Do some additional setup.')
-            base['_focalplane_expnum_setup'] = exp_num
-
-            # Get the celestial coordinates of all the chip corners
-            corners = []
-            for chip_num in range(nchips):
-                base['chip_num'] = chip_num
-                wcs = galsim.config.wcs.BuildWCS(base['image'],'wcs', base, logger)
-                if not wcs.isCelestial():
-                    raise ValueError("FocalPlane requires a CelestialWCS")
-                xsize = galsim.config.ParseValue(base['image'],'xsize', base, int)[0]
-                ysize = galsim.config.ParseValue(base['image'],'ysize', base, int)[0]
-
-                im_pos1 = galsim.PositionD(0,0)
-                im_pos2 = galsim.PositionD(0,ysize)
-                im_pos3 = galsim.PositionD(xsize,0)
-                im_pos4 = galsim.PositionD(xsize,ysize)
-                corners.append(wcs.toWorld(im_pos1))
-                corners.append(wcs.toWorld(im_pos2))
-                corners.append(wcs.toWorld(im_pos3))
-                corners.append(wcs.toWorld(im_pos4))
-                logger.debug("corners of chip %d = %s",chip_num, [c.rad for c in corners[-4:]])
-
-            chip_num = base['chip_num'] = first_chip_num
-
-            # Calculate the pointing as the center (mean) of all the position in corners
-            x_list, y_list, z_list = zip(*[p.get_xyz() for p in corners])
-            pointing_x = np.mean(x_list)
-            pointing_y = np.mean(y_list)
-            pointing_z = np.mean(z_list)
-            pointing = galsim.CelestialCoord.from_xyz(pointing_x, pointing_y, pointing_z)
-            logger.info("Calculated center of focal plane to be %s",pointing)
-
-            # Also calculate the min/max ra and dec
-            ra_list = [p.ra.wrap(pointing.ra) / galsim.degrees for p in corners]
-            dec_list = [p.dec / galsim.degrees for p in corners]
-            fov_minra = np.min(ra_list)
-            fov_maxra = np.max(ra_list)
-            fov_mindec = np.min(dec_list)
-            fov_maxdec = np.max(dec_list)
-            logger.info("RA range = %.2f - %.2f deg", fov_minra, fov_maxra)
-            logger.info("Dec range = %.2f - %.2f deg", fov_mindec, fov_maxdec)
-
-            # bounds is the bounds in the tangent plane
-            proj_list = [ pointing.project(p, projection='gnomonic') for p in corners]
-            # Convert Angle tuples into PositionD in arcsec
-            proj_list = [ galsim.PositionD(p[0]/galsim.arcsec, p[1]/galsim.arcsec)
-                            for p in proj_list ]
-            bounds = galsim.BoundsD()
-            for proj in proj_list: bounds += proj
-            logger.info("Bounds in tangent plane = %s (arcsec)",bounds)
-
-            # Write these values into the dict in eval_variables, so they can be used in Eval's.
-            base['eval_variables']['aworld_center_ra'] = pointing.ra
-            base['eval_variables']['aworld_center_dec'] = pointing.dec
-            base['eval_variables']['afov_minra'] = fov_minra * galsim.degrees
-            base['eval_variables']['afov_maxra'] = fov_maxra * galsim.degrees
-            base['eval_variables']['afov_mindec'] = fov_mindec * galsim.degrees
-            base['eval_variables']['afov_maxdec'] = fov_maxdec * galsim.degrees
-            base['eval_variables']['ifirst_image_num'] = image_num
-            base['eval_variables']['ffocal_xmin'] = bounds.xmin
-            base['eval_variables']['ffocal_xmax'] = bounds.xmax
-            base['eval_variables']['ffocal_ymin'] = bounds.ymin
-            base['eval_variables']['ffocal_ymax'] = bounds.ymax
-            rmax = np.max([proj.x**2 + proj.y**2 for proj in proj_list])**0.5
-            logger.info("Max radius from center of focal plane = %.0f arcsec",rmax)
-            base['eval_variables']['ffocal_rmax'] = rmax
-            base['eval_variables']['xworld_center'] = pointing
-            base['world_center'] = pointing
-            base['eval_variables']['ffocal_r'] = {
-                'type' : 'Eval',
-                'str' : "math.sqrt(pos.x**2 + pos.y**2)",
-                'ppos' : { 'type' : 'Eval',
-                           'str' : "world_center.project(world_pos)",
-                           'cworld_pos' : "@image.world_pos"
-                         }
-            }
+            with ProfileStage(base, 'exposure_setup'):
+                self.setupExposure(config, base, image_num, nchips, logger)
+
+        with ProfileStage(base, 'meta_params'):
+            self.setupMetaParams(base)
+
+        if kwargs.get('scene_cache', False):
+            with ProfileStage(base, 'scene'):
+                self.setupScene(config, base, kwargs.get('scene_border', 60), logger)
+
+        # Use the cached wcs for this chip, rather than building it again.
+        self.setCurrentWCS(base, self.getChipGeometry(base, chip_num, logger).wcs)
+
+        # Now we run the base class BuildImages, which just builds a single image.
+        ignore += ['nexp', 'nchips', 'scene_cache', 'scene_border', 'wcs_cache_size',
+                   'edge_samples', 'manifest', 'seed_mode']
+        with ProfileStage(base, 'images'):
+            images = OutputBuilder.buildImages(self, config, base, file_num, image_num, obj_num,
+                                               ignore, logger)
+        return images
+
+    def setupExposure(self, config, base, image_num, nchips, logger):
+        """Do the setup that only needs to happen once per exposure.
+
+        This calculates the pointing and the extent of the full focal plane from the wcs of
+        each chip and writes the results into base['eval_variables'].  Everything that is
+        calculated here is also saved in base['_focalplane_exposure'], so it can be passed to
+        other processes building the same exposure.  cf. getExposureState.
+
+        @param config           The configuration dict for the output field.
+        @param base             The base configuration dict.
+        @param image_num        The current image_num.
+        @param nchips           The number of chips in the exposure.
+        @param logger           If given, a logger object to log progress.
+        """
+        exp_num = base['exp_num']
+        base['_focalplane_expnum_setup'] = exp_num
+
+        # Get the outlines of all the chips and calculate the focal plane geometry from them.
+        chip_keys = [ self.getChipKey(base, chip_num) for chip_num in range(nchips) ]
+        chip_geometry = [ self.getChipGeometry(base, chip_num, logger)
+                          for chip_num in range(nchips) ]
+        geom = FocalPlaneGeometry(chip_geometry)
+        pointing = geom.pointing
+        logger.info("Calculated center of focal plane to be %s",pointing)
+        logger.info("RA range = %.2f - %.2f deg", geom.fov_minra, geom.fov_maxra)
+        logger.info("Dec range = %.2f - %.2f deg", geom.fov_mindec, geom.fov_maxdec)
+        logger.info("Bounds in tangent plane = %s (arcsec)",geom.bounds)
+        logger.info("Max radius from center of focal plane = %.0f arcsec",geom.rmax)
+
+        # These values go into the dict in eval_variables, so they can be used in Eval's.
+        eval_variables = {}
+        eval_variables['aworld_center_ra'] = pointing.ra
+        eval_variables['aworld_center_dec'] = pointing.dec
+        eval_variables['afov_minra'] = geom.fov_minra * galsim.degrees
+        eval_variables['afov_maxra'] = geom.fov_maxra * galsim.degrees
+        eval_variables['afov_mindec'] = geom.fov_mindec * galsim.degrees
+        eval_variables['afov_maxdec'] = geom.fov_maxdec * galsim.degrees
+        eval_variables['ifirst_image_num'] = image_num
+        eval_variables['ffocal_xmin'] = geom.bounds.xmin
+        eval_variables['ffocal_xmax'] = geom.bounds.xmax
+        eval_variables['ffocal_ymin'] = geom.bounds.ymin
+        eval_variables['ffocal_ymax'] = geom.bounds.ymax
+        eval_variables['ffocal_rmax'] = geom.rmax
+        eval_variables['xfocal_plane'] = geom
+        eval_variables['xworld_center'] = pointing
+        eval_variables['ffocal_r'] = {
+            'type' : 'Eval',
+            'str' : "math.sqrt(pos.x**2 + pos.y**2)",
+            'ppos' : { 'type' : 'Eval',
+                       'str' : "world_center.project(world_pos)",
+                       'cworld_pos' : "@image.world_pos"
+                     }
+        }
+
+        base['_focalplane_exposure'] = {
+            'exp_num' : exp_num,
+            'eval_variables' : eval_variables,
+            'world_center' : pointing,
+            'chip_bounds' : geom.chip_bounds,
+            'chip_geometry' : chip_geometry,
+            'chip_keys' : chip_keys,
+        }
+        base['eval_variables'].update(copy.deepcopy(eval_variables))
+        base['world_center'] = pointing
+        base['_focalplane_chip_bounds'] = geom.chip_bounds
+
+    def getChipGeometry(self, base, chip_num, logger):
+        """Get the ChipGeometry for the given chip in the current exposure.
+
+        This uses the cached one if available.  Otherwise, it builds the wcs for that chip and
+        adds it to the cache.  cf. getChipKey for how the cache is keyed.
+
+        @param base             The base configuration dict.
+        @param chip_num         The chip number.
+        @param logger           If given, a logger object to log progress.
 
-        # Evaluate all the meta parameters and write them into the eval_variables dict.
+        @returns a ChipGeometry instance
+        """
+        cache = base['_focalplane_wcs_cache']
+        key = self.getChipKey(base, chip_num)
+        geom = cache.get(key)
+        if geom is None:
+            orig_chip_num = base['chip_num']
+            base['chip_num'] = chip_num
+            # Build it from the original wcs specification, not the wcs of the current chip.
+            image = dict(base['image'])
+            image.pop('wcs', None)
+            if base['_focalplane_wcs'] is not None:
+                image['wcs'] = base['_focalplane_wcs']
+            with ProfileStage(base, 'wcs'):
+                wcs = galsim.config.wcs.BuildWCS(image, 'wcs', base, logger)
+            xsize = galsim.config.ParseValue(base['image'],'xsize', base, int)[0]
+            ysize = galsim.config.ParseValue(base['image'],'ysize', base, int)[0]
+            base['chip_num'] = orig_chip_num
+            if 'edge_samples' in base['output']:
+                edge_samples = galsim.config.ParseValue(base['output'], 'edge_samples',
+                                                        base, int)[0]
+            else:
+                edge_samples = 2
+            geom = ChipGeometry(wcs, xsize, ysize, edge_samples)
+            cache.put(key, geom)
+        else:
+            logger.debug('Using cached wcs for chip %d',chip_num)
+        return geom
+
+    def getChipKey(self, base, chip_num):
+        """Get the key for the given chip in the cache of chip geometries.
+
+        If the wcs is read from a file (i.e. it has a file_name parameter), then the key is the
+        resolved dir and file_name (and exp for Pixmappy) along with the chip_num, so exposures
+        that use the same wcs files share the cached geometries.  Otherwise, the key is
+        (exp_num, chip_num), so this assumes that the wcs only depends on the exposure and the
+        chip.
+
+        @param base             The base configuration dict.
+        @param chip_num         The chip number.
+
+        @returns the key as a tuple
+        """
+        param = base['_focalplane_wcs']
+        if not isinstance(param, dict) or 'file_name' not in param:
+            return (base['exp_num'], chip_num)
+        orig_chip_num = base['chip_num']
+        base['chip_num'] = chip_num
+        # The values for a different chip may be cached from building the wcs, so clear them.
+        galsim.config.RemoveCurrent(param, keep_safe=True)
+        names = tuple([ galsim.config.ParseValue(param, name, base, str)[0]
+                        for name in ('dir', 'file_name', 'exp') if name in param ])
+        base['chip_num'] = orig_chip_num
+        return names + (chip_num,)
+
+    def setCurrentWCS(self, base, wcs):
+        """Use the given wcs for the current image, so BuildWCS won't rebuild it.
+
+        GalSim uses a wcs object given directly as image.wcs as is.  The original wcs
+        specification is kept in base['_focalplane_wcs'] to build the other chips.
+
+        @param base             The base configuration dict.
+        @param wcs              The wcs to use for the current image.
+        """
+        base['image']['wcs'] = wcs
+
+    def setupMetaParams(self, base):
+        """Evaluate all the meta parameters and write them into the eval_variables dict.
+
+        @param base             The base configuration dict.
+        """
         if 'meta_params' in base:
             for key in base['meta_params']:
                 param = galsim.config.ParseValue(base['meta_params'], key, base, float)[0]
                 base['eval_variables']['f' + key] = param
             galsim.config.RemoveCurrent(base['meta_params'])
 
-        # Now we run the base class BuildImages, which just builds a single image.
-        ignore += ['nexp', 'nchips']
-        images = OutputBuilder.buildImages(self, config, base, file_num, image_num, obj_num,
-                                           ignore, logger)
-        return images
+    def setupScene(self, config, base, scene_border, logger):
+        """Use the exposure-level scene to trivially skip the objects that are well off this chip.
+
+        If necessary, this first generates the positions of all the objects in the exposure
+        and assigns them to the chips they might overlap.  This happens once per exposure,
+        rather than once per chip.  Each chip then trivially skips the objects that aren't in
+        its bucket.  Objects within scene_border (in arcsec) of the chip are built normally, so
+        as long as this is larger than any stamp.skip distance, the output is the same as
+        without the scene cache.
+
+        @param config           The configuration dict for the output field.
+        @param base             The base configuration dict.
+        @param scene_border     The border in arcsec around each chip within which objects
+                                are kept.
+        @param logger           If given, a logger object to log progress.
+        """
+        exp_num = base['exp_num']
+        chip_num = base['chip_num']
+        if base['image'].get('type', 'Single') == 'WideScattered':
+            raise galsim.GalSimConfigValueError(
+                "scene_cache is not compatible with image type WideScattered", 'WideScattered')
+        scene = base.get('_focalplane_scene', None)
+        if scene is None or scene.exp_num != exp_num:
+            base['wcs'] = self.getChipGeometry(base, chip_num, logger).wcs
+            nobjects = galsim.config.ParseValue(base['image'], 'nobjects', base, int)[0]
+            scene = BuildExposureScene(base, exp_num, nobjects, logger)
+            scene.assignChips(base['world_center'], base['_focalplane_chip_bounds'], scene_border)
+            base['_focalplane_scene'] = scene
+        skip = scene.getChipSkip(chip_num)
+        logger.info('%d of %d objects in the exposure are near chip %d',
+                    len(scene.buckets[chip_num]), scene.nobjects, chip_num)
+        scene_skip = {
+            'type' : 'List',
+            'items' : skip
+        }
+        # Keep any quick_skip the user set, rather than replacing it.  This gets called for
+        # every chip, so save the user's original value the first time through.
+        if '_focalplane_user_skip' not in base:
+            base['_focalplane_user_skip'] = base['stamp'].get('quick_skip', None)
+        user_skip = base['_focalplane_user_skip']
+        if user_skip is None:
+            base['stamp']['quick_skip'] = scene_skip
+        else:
+            base['stamp']['quick_skip'] = {
+                'type' : 'Eval',
+                'str' : 'user_skip or scene_skip',
+                'buser_skip' : user_skip,
+                'bscene_skip' : scene_skip
+            }
+
+    def buildExposureState(self, config, base, image_num, obj_num, logger):
+        """Do all of the setup for the current exposure and return it as an exposure state.
+
+        This should be called after the normal file-level setup for the first file in the
+        exposure (i.e. SetupConfigFileNum, setup, and ProcessInput).  In addition to the setup
+        done by setupExposure, this builds the scene if scene_cache is set and runs the
+        image-level input setup (e.g. building the power spectrum grid), so the results can be
+        shared with other processes building chips in the same exposure.
+
+        @param config           The configuration dict for the output field.
+        @param base             The base configuration dict.
+        @param image_num        The image_num of the first chip in the exposure.
+        @param obj_num          The obj_num of the first chip in the exposure.
+        @param logger           If given, a logger object to log progress.
+
+        @returns the exposure state as a dict
+        """
+        nchips = galsim.config.ParseValue(config, 'nchips', base, int)[0]
+        self.setupExposure(config, base, image_num, nchips, logger)
+        self.setupMetaParams(base)
+
+        if 'scene_cache' in config and galsim.config.ParseValue(config, 'scene_cache',
+                                                                base, bool)[0]:
+            if 'scene_border' in config:
+                scene_border = galsim.config.ParseValue(config, 'scene_border', base, float)[0]
+            else:
+                scene_border = 60
+            self.setupScene(config, base, scene_border, logger)
+
+        galsim.config.SetupConfigImageNum(base, image_num, obj_num, logger)
+        image_builder = galsim.config.valid_image_types[base['image']['type']]
+        xsize, ysize = image_builder.setup(base['image'], base, image_num, obj_num,
+                                           galsim.config.image_ignore, logger)
+        galsim.config.SetupConfigImageSize(base, xsize, ysize, logger)
+        galsim.config.SetupInputsForImage(base, logger)
+
+        return self.getExposureState(config, base)
+
+    def getExposureState(self, config, base):
+        """Get everything that was set up for the current exposure in a picklable dict.
+
+        This includes the results of setupExposure, the exposure-level scene if one was
+        built, and any input objects that use exp_num as their index_key.  The returned
+        dict may be given to setExposureState in another process to skip redoing this work.
+
+        @param config           The configuration dict for the output field.
+        @param base             The base configuration dict.
+
+        @returns the exposure state as a dict
+        """
+        exp_num = base['exp_num']
+        state = dict(base['_focalplane_exposure'])
+        if exp_num != state['exp_num']:
+            raise galsim.GalSimError("Exposure %d has not been set up"%exp_num)
+
+        scene = base.get('_focalplane_scene', None)
+        if scene is not None and scene.exp_num == exp_num:
+            state['scene'] = scene
+
+        inputs = {}
+        for key, fields in base.get('input', {}).items():
+            if key not in base.get('_input_objs', {}): continue
+            if not isinstance(fields, list): fields = [ fields ]
+            for num, field in enumerate(fields):
+                current = field.get('current', None)
+                input_obj = base['_input_objs'][key][num]
+                if current is None or input_obj is None or current[4] != 'exp_num':
+                    continue
+                if not current[1] and current[3] != exp_num:
+                    continue
+                # Safe input objects are reused for every exposure, so make a copy to hold
+                # the setup for this exposure.
+                input_obj = copy.deepcopy(input_obj)
+                current = (input_obj, current[1], current[2], exp_num, current[4])
+                inputs[(key,num)] = (input_obj, current, field.get('current_setup_index', None))
+        state['inputs'] = inputs
+        return state
+
+    def setExposureState(self, config, base, state):
+        """Install an exposure state, as returned by getExposureState, in this base config.
+
+        @param config           The configuration dict for the output field.
+        @param base             The base configuration dict.
+        @param state            The exposure state dict.
+        """
+        base['_focalplane_expnum_setup'] = state['exp_num']
+        base['_focalplane_exposure'] = { k : state[k] for k in
+                                         ('exp_num', 'eval_variables', 'world_center',
+                                          'chip_bounds', 'chip_geometry', 'chip_keys') }
+        if '_focalplane_wcs_cache' in base:
+            for key, geom in zip(state['chip_keys'], state['chip_geometry']):
+                base['_focalplane_wcs_cache'].put(key, geom)
+        if 'eval_variables' not in base:
+            base['eval_variables'] = {}
+        base['eval_variables'].update(copy.deepcopy(state['eval_variables']))
+        base['world_center'] = state['world_center']
+        base['_focalplane_chip_bounds'] = state['chip_bounds']
+        if 'scene' in state:
+            base['_focalplane_scene'] = state['scene']
+
+        for (key, num), (input_obj, current, setup_index) in state.get('inputs', {}).items():
+            fields = base['input'][key]
+            field = fields[num] if isinstance(fields, list) else fields
+            if '_input_objs' not in base:
+                base['_input_objs'] = {}
+            if key not in base['_input_objs']:
+                nfields = len(fields) if isinstance(fields, list) else 1
+                base['_input_objs'][key] = [None] * nfields
+            base['_input_objs'][key][num] = input_obj
+            field['current'] = (input_obj,) + tuple(current[1:])
+            loader = galsim.config.valid_input_types[key]
+            if setup_index is None and (type(loader).setupImage is not
+                                        galsim.config.InputLoader.setupImage):
+                # The image-level setup (e.g. the power spectrum grid) was already done for this
+                # exposure, so use index to tell the loader not to redo it for each chip.
+                field['index'] = setup_index = state['exp_num']
+            if setup_index is not None:
+                field['current_setup_index'] = setup_index
 
 galsim.config.process.top_level_fields += ['meta_params']
 galsim.config.output.RegisterOutputType('FocalPlane', FocalPlaneBuilder())
@@ -0,0 +1,132 @@
+#
+# This module defines a manifest of the chips that have been completed in a FocalPlane run.
+#
+# Long FocalPlane runs may be interrupted before they are finished.  If output.manifest is set,
+# then each time a chip is finished, a line is appended to the manifest file recording the
+# exp_num, chip_num, the output file name, its size and checksum, and a hash of the config.
+# When the run is started again, any chips that are listed in the manifest with the same config
+# hash and whose output file is still there with the right size and checksum are skipped.
+
+import galsim
+import hashlib
+import json
+import numpy as np
+import os
+
+# These output parameters don't affect the contents of the output files.
+manifest_ignore = [ 'nproc', 'timeout', 'manifest', 'skip', 'noclobber', 'retry_io' ]
+
+def _PlainValue(value):
+    """Convert a config value into something that json can write the same way every time.
+
+    Objects whose repr is the default one (which includes the memory address) are dropped,
+    since that would give a different hash for every run.
+
+    @param value        The value to convert.
+
+    @returns the plain value, or None if it should be dropped.
+    """
+    if value is None or isinstance(value, (str, bool, int, float)):
+        return value
+    elif isinstance(value, dict):
+        return { str(k):_PlainValue(v) for k,v in value.items() }
+    elif isinstance(value, (list, tuple)):
+        return [ _PlainValue(v) for v in value ]
+    elif isinstance(value, (np.ndarray, np.generic)):
+        return value.tolist()
+    elif type(value).__repr__ is not object.__repr__:
+        return repr(value)
+    else:
+        return None
+
+def ConfigHash(base):
+    """Calculate a hash of the configuration that determines the output files.
+
+    @param base         The base configuration dict.
+
+    @returns the hash as a hex string
+    """
+    fields = {}
+    for key, value in base.items():
+        if key[0] == '_' or not isinstance(value, dict): continue
+        fields[key] = _PlainValue(galsim.config.CleanConfig(value))
+    fields['output'] = { k:v for k,v in fields.get('output',{}).items()
+                         if k not in manifest_ignore }
+    if '_focalplane_wcs' in base and 'image' in fields:
+        # FocalPlane replaces image.wcs with the wcs of each chip, so use the original spec.
+        fields['image']['wcs'] = _PlainValue(galsim.config.CleanConfig(base['_focalplane_wcs']))
+    s = json.dumps(fields, sort_keys=True)
+    return hashlib.sha1(s.encode('utf-8')).hexdigest()
+
+def FileChecksum(file_name):
+    """Calculate the sha1 checksum of a file.
+
+    @param file_name    The name of the file.
+
+    @returns the checksum as a hex string
+    """
+    sha = hashlib.sha1()
+    with open(file_name, 'rb') as fin:
+        for block in iter(lambda: fin.read(1<<20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+class ChipManifest(object):
+    """A record of which chips have been completed.
+
+    @param file_name    The name of the manifest file.  It doesn't need to exist yet.
+    @param config_hash  The hash of the current configuration.  Only records with this hash
+                        count as completed.
+    """
+    def __init__(self, file_name, config_hash):
+        self.file_name = file_name
+        self.config_hash = config_hash
+        self.records = {}
+        if os.path.isfile(file_name):
+            with open(file_name) as fin:
+                for line in fin:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Probably a partial line written when the job was killed.
+                        continue
+                    if record.get('config_hash') == config_hash:
+                        self.records[(record['exp_num'], record['chip_num'])] = record
+
+    def isDone(self, exp_num, chip_num):
+        """Check whether the given chip has already been completed.
+
+        @param exp_num      The exposure number.
+        @param chip_num     The chip number.
+
+        @returns True if the chip is done, False otherwise
+        """
+        record = self.records.get((exp_num, chip_num), None)
+        if record is None:
+            return False
+        file_name = record['file_name']
+        # Check the size first, since that is much faster than reading the whole file.
+        if not os.path.isfile(file_name) or os.path.getsize(file_name) != record['size']:
+            return False
+        return FileChecksum(file_name) == record['checksum']
+
+    def addChip(self, exp_num, chip_num, file_name):
+        """Record that the given chip has been completed.
+
+        @param exp_num      The exposure number.
+        @param chip_num     The chip number.
+        @param file_name    The name of the output file that was written.
+        """
+        record = {
+            'exp_num' : exp_num,
+            'chip_num' : chip_num,
+            'file_name' : file_name,
+            'size' : os.path.getsize(file_name),
+            'checksum' : FileChecksum(file_name),
+            'config_hash' : self.config_hash,
+        }
+        self.records[(exp_num, chip_num)] = record
+        # Write the whole line at once in append mode, so multiple processes can safely
+        # add to the same manifest.
+        with open(self.file_name, 'a') as fout:
+            fout.write(json.dumps(record, sort_keys=True) + '\n')
@@ -0,0 +1,313 @@
+#
+# This module defines a FocalPlane-aware replacement for galsim.config.Process.
+#
+# When running the normal galsim executable with output.nproc > 1, each chip is an independent
+# job, so every process that builds a chip from some exposure has to redo the exposure-level
+# setup (the pointing, the fov_* and focal_* eval variables, the scene if using scene_cache, the
+# power spectrum grid, etc.).  ProcessFocalPlane instead does the exposure setup once per
+# exposure, in whichever worker process first needs it, and saves it for the other workers
+# building chips of that exposure, which then start from the already set up exposure state.
+
+import galsim
+import os
+import pickle
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+
+from .exposure_truth import AddChipTables
+
+# The exposure states that this process has loaded, keyed by exp_num, with the most recently
+# used last.  Only the last _max_exposure_states are kept.
+_exposure_states = OrderedDict()
+_max_exposure_states = 2
+
+# The config to set up the exposures from, as it was before building any chips.  This is set in
+# the main process before starting the workers, which inherit it when they are forked.
+_setup_config = None
+
+def BuildFocalPlaneChip(config, file_num, image_num, obj_num, exp_num, setup, state_dir, nproc,
+                        logger):
+    """Build a single chip, starting from the exposure state for its exposure.
+
+    @param config           The configuration dict.
+    @param file_num         The file_num of this chip.
+    @param image_num        The image_num of this chip.
+    @param obj_num          The first obj_num of this chip.
+    @param exp_num          The exposure number of this chip.
+    @param setup            The kwargs for the first chip in the exposure, which are used to set
+                            up the exposure.
+    @param state_dir        The directory where the exposure states are saved.
+    @param nproc            The number of processes building the chips.
+    @param logger           A logger object to log progress.
+
+    @returns (file_name, t, truth), where file_name and t are as returned by
+             galsim.config.BuildFile, and truth is a list of (file_name, chip_num, table) for
+             any exposure_truth tables, which are written by the main process.
+    """
+    output = config['output']
+    builder = galsim.config.valid_output_types[output['type']]
+    state = GetFocalPlaneState(setup, state_dir, nproc, logger)
+    builder.setExposureState(output, config, state)
+    config['_focalplane_exposure_truth'] = []
+    file_name, t = galsim.config.BuildFile(config, file_num, image_num, obj_num, logger)
+    return file_name, t, config.pop('_focalplane_exposure_truth')
+
+def ProcessFocalPlane(config, logger=None, except_abort=False):
+    """Build all of the chips of all the exposures in a FocalPlane config.
+
+    This is the equivalent of galsim.config.Process for the FocalPlane output type.  The
+    chips are built by output.nproc worker processes, and the exposure setup is only done once
+    per exposure, by the first process that needs it.  The others load the saved state.  The
+    output is identical to what galsim.config.Process would produce.  If output.seed_mode is
+    not given, this uses seed_mode = exposure, so to compare with galsim.config.Process, use
+    that there too.
+
+    The chips of all the exposures are built in a single pass over the worker processes, in
+    order of exposure, so no process waits for the slowest chip of an exposure before moving
+    on, and the exposures are set up in parallel as the processes get to them.  Only the
+    exposures currently being built are kept: each process keeps the last few states it used
+    in memory, and the saved state for an exposure is removed once all its chips are done.
+
+    @param config           The configuration dict.
+    @param logger           If given, a logger object to log progress.
+    @param except_abort     Whether to abort processing when a chip raises an exception (True)
+                            or just report errors and continue on (False). [default: False]
+
+    @returns the final config dict that was used.
+    """
+    logger = galsim.config.LoggerWrapper(logger)
+    t1 = time.time()
+
+    galsim.config.ImportModules(config)
+    galsim.config.ProcessAllTemplates(config, logger)
+
+    output = config.get('output', {})
+    if output.get('type', None) != 'FocalPlane':
+        raise galsim.GalSimConfigValueError(
+            "ProcessFocalPlane requires output.type = FocalPlane", output.get('type', None))
+    builder = galsim.config.valid_output_types['FocalPlane']
+    if 'seed_mode' not in output:
+        # The chips of an exposure are built by different processes, so reseed the exp_num rng
+        # for each exposure.  Otherwise, exp_num values would depend on which chips each
+        # process built before.
+        output['seed_mode'] = 'exposure'
+    elif output['seed_mode'] == 'sequence':
+        logger.warning('With seed_mode = sequence, values with index_key = exp_num depend on '
+                       'which chips each process builds.  Consider seed_mode = exposure.')
+
+    # This follows galsim.config.BuildFiles, but groups the files (chips) by exposure.
+    config['rng'] = object()
+    galsim.config.ProcessInput(config, logger=logger, safe_only=True)
+
+    nfiles = builder.getNFiles(output, config)
+    if nfiles > 1 and 'nproc' in output:
+        nproc = galsim.config.ParseValue(output, 'nproc', config, int)[0]
+        nproc = galsim.config.UpdateNProc(nproc, nfiles, config, logger)
+    else:
+        nproc = 1
+    orig_config = galsim.config.CopyConfig(config)
+
+    if 'timeout' in output:
+        timeout = galsim.config.ParseValue(output, 'timeout', config, float)[0]
+    else:
+        timeout = 3600
+
+    exposures = []  # A list of (exp_num, jobs) with one entry per exposure.
+    image_num = 0
+    obj_num = 0
+    for file_num in range(nfiles):
+        galsim.config.SetupConfigFileNum(config, file_num, image_num, obj_num, logger)
+        builder.setup(output, config, file_num, logger)
+        galsim.config.ProcessInput(config, logger=logger, file_scope_only=True)
+        nobj = galsim.config.GetNObjForFile(config, file_num, image_num, logger=logger,
+                                            approx=True)
+        exp_num = config['exp_num']
+        if builder.isChipDone(config):
+            # Don't bother setting up the exposure if all its chips are already done.
+            logger.warning('Skipping file %d, since it is already done according to the '
+                           'manifest', file_num)
+            image_num += len(nobj)
+            obj_num += sum(nobj)
+            continue
+        if len(exposures) == 0 or exposures[-1][0] != exp_num:
+            exposures.append( (exp_num, []) )
+        kwargs = {
+            'file_num' : file_num,
+            'image_num' : image_num,
+            'obj_num' : obj_num,
+            'exp_num' : exp_num,
+        }
+        file_name = builder.getFilename(output, config, logger)
+        exposures[-1][1].append( (kwargs, file_name) )
+        image_num += len(nobj)
+        obj_num += sum(nobj)
+
+    # The exposure_truth tables for each exposure, keyed by exp_num, and the number of chips in
+    # each exposure that are still being built.  Each exposure's truth files are written once
+    # all of its chips are done.
+    truth_tables = {}
+    nremaining = {}
+
+    def write_truth(exp_num):
+        for file_name, tables in truth_tables.pop(exp_num, {}).items():
+            logger.info('Writing exposure_truth file %s', file_name)
+            AddChipTables(file_name, tables)
+
+    def chip_done(exp_num):
+        nremaining[exp_num] -= 1
+        if nremaining[exp_num] == 0:
+            write_truth(exp_num)
+            state_file = FocalPlaneStateFile(state_dir, exp_num)
+            if os.path.exists(state_file):
+                os.remove(state_file)
+
+    def done_func(logger, proc, k, result, t):
+        file_num, file_name, exp_num = info[k]
+        if result[1] != 0:
+            s0 = '' if proc is None else '%s: '%proc
+            logger.warning(s0 + 'File %d = %s: time = %f sec', file_num, file_name, result[1])
+        for truth_file_name, chip_num, table in result[2]:
+            truth_tables[exp_num].setdefault(truth_file_name, {})[chip_num] = table
+        chip_done(exp_num)
+
+    def except_func(logger, proc, k, e, tr):
+        file_num, file_name, exp_num = info[k]
+        s0 = '' if proc is None else '%s: '%proc
+        logger.error(s0 + 'Exception caught for file %d = %s', file_num, file_name)
+        if except_abort:
+            logger.debug('%s',tr)
+            logger.error('File %s not written.',file_name)
+        else:
+            logger.warning('%s',tr)
+            logger.error('File %s not written! Continuing on...',file_name)
+        chip_done(exp_num)
+
+    global _setup_config
+    _setup_config = orig_config
+    _exposure_states.clear()
+    state_dir = tempfile.mkdtemp(prefix='focal_plane_states_')
+    tasks = []
+    info = []  # A list of (file_num, file_name, exp_num) corresponding to each task.
+    for exp_num, jobs in exposures:
+        truth_tables[exp_num] = {}
+        nremaining[exp_num] = len(jobs)
+        for kwargs, file_name in jobs:
+            kwargs = dict(kwargs, setup=jobs[0][0], state_dir=state_dir, nproc=nproc)
+            tasks.append( [ (kwargs, len(info)) ] )
+            info.append( (kwargs['file_num'], file_name, exp_num) )
+    logger.info('Building %d chips from %d exposures', len(tasks), len(exposures))
+
+    results = []
+    try:
+        if len(tasks) > 0:
+            results = galsim.config.MultiProcess(nproc, galsim.config.CopyConfig(orig_config),
+                                                 BuildFocalPlaneChip, tasks, 'file',
+                                                 logger=logger, timeout=timeout,
+                                                 done_func=done_func, except_func=except_func,
+                                                 except_abort=except_abort)
+    finally:
+        _exposure_states.clear()
+        _setup_config = None
+        shutil.rmtree(state_dir, ignore_errors=True)
+        # If we stopped early, still write the truth for the chips that were finished.
+        for exp_num in list(truth_tables.keys()):
+            write_truth(exp_num)
+    t2 = time.time()
+
+    nfiles_written = sum([ r is not None and r[1] != 0 for r in results ])
+    if nfiles_written == 0:
+        logger.error('No files were written.  All were either skipped or had errors.')
+    else:
+        if nfiles_written > 1 and nproc != 1:
+            logger.warning('Total time for %d files with %d processes = %f sec',
+                           nfiles_written,nproc,t2-t1)
+        logger.warning('Done building files')
+    return orig_config
+
+def FocalPlaneStateFile(state_dir, exp_num):
+    """The name of the file where the exposure state for exp_num is saved.
+
+    @param state_dir        The directory where the exposure states are saved.
+    @param exp_num          The exposure number.
+
+    @returns the file name
+    """
+    return os.path.join(state_dir, 'exp%d.pkl'%exp_num)
+
+def GetFocalPlaneState(setup, state_dir, nproc, logger):
+    """Get the exposure state for an exposure, setting it up if no other process has yet.
+
+    The first process to need an exposure claims it by creating a claim file, does the setup
+    and saves the state in state_dir.  Other processes that need the same exposure wait for the
+    saved state and load it.  If the setup fails, the claim is released, so another process
+    can try again.
+
+    @param setup            The BuildFocalPlaneChip kwargs for the first chip in the exposure.
+    @param state_dir        The directory where the exposure states are saved.
+    @param nproc            The number of processes building the chips.
+    @param logger           A logger object to log progress.
+
+    @returns the exposure state dict
+    """
+    exp_num = setup['exp_num']
+    if exp_num in _exposure_states:
+        _exposure_states.move_to_end(exp_num)
+        return _exposure_states[exp_num]
+
+    state_file = FocalPlaneStateFile(state_dir, exp_num)
+    claim_file = state_file + '.claim'
+    state = None
+    while state is None and not os.path.exists(state_file):
+        try:
+            os.close(os.open(claim_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            # Another process is setting up this exposure.
+            time.sleep(0.01)
+            continue
+        try:
+            state = BuildFocalPlaneState(_setup_config, setup, nproc, logger)
+            # Write to a temporary file and then move it into place, so other processes never
+            # see a partially written file.
+            tmp_file_name = state_file + '.%d.tmp'%os.getpid()
+            with open(tmp_file_name, 'wb') as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file_name, state_file)
+        finally:
+            os.remove(claim_file)
+    if state is None:
+        logger.debug('Loading the state of exposure %d', exp_num)
+        with open(state_file, 'rb') as f:
+            state = pickle.load(f)
+
+    _exposure_states[exp_num] = state
+    while len(_exposure_states) > _max_exposure_states:
+        _exposure_states.popitem(last=False)
+    return state
+
+def BuildFocalPlaneState(config, kwargs, nproc, logger):
+    """Do the exposure setup for the exposure whose first chip is given by kwargs.
+
+    @param config           The configuration dict.
+    @param kwargs           The BuildFocalPlaneChip kwargs for the first chip in the exposure.
+    @param nproc            The number of processes that will be building the chips.
+    @param logger           A logger object to log progress.
+
+    @returns the exposure state dict
+    """
+    config = galsim.config.CopyConfig(config)
+    # Don't let ProcessInput start up an InputManager for this.
+    config['current_nproc'] = nproc
+    output = config['output']
+    builder = galsim.config.valid_output_types[output['type']]
+    file_num = kwargs['file_num']
+    image_num = kwargs['image_num']
+    obj_num = kwargs['obj_num']
+
+    logger.info('Setting up exposure %d', kwargs['exp_num'])
+    galsim.config.SetupConfigFileNum(config, file_num, image_num, obj_num, logger)
+    builder.setup(output, config, file_num, logger)
+    galsim.config.GetNObjForFile(config, file_num, image_num, logger=logger)
+    galsim.config.ProcessInput(config, logger=logger)
+    return builder.buildExposureState(output, config, image_num, obj_num, logger)
@@ -2,6 +2,191 @@
 import galsim
 import numpy as np
 import coord
+import time
+from collections import OrderedDict
+from .profiling import GetProfile
+from .counter_seed import HashUniform
+from .batch_seed import BuildBatchSeeds
+
+def AliasTable(prob):
+    """Build an alias table (Vose's method) for drawing from the discrete probabilities prob.
+
+    Each of the n bins has a probability alias_prob of picking its own index, and otherwise it
+    picks its alias.  So a uniform deviate u picks bin i = int(u*n), and then the fractional
+    part of u*n decides between i and alias[i], which takes the same time for any n.
+
+    @param prob         A numpy array of the probabilities, which should sum to 1.
+
+    @returns alias_prob, alias
+    """
+    n = len(prob)
+    scaled = np.asarray(prob, dtype=float) * n
+    alias_prob = np.ones(n)
+    alias = np.arange(n)
+    small = [ i for i in range(n) if scaled[i] < 1. ]
+    large = [ i for i in range(n) if scaled[i] >= 1. ]
+    while small and large:
+        s = small.pop()
+        l = large.pop()
+        alias_prob[s] = scaled[s]
+        alias[s] = l
+        scaled[l] -= 1. - scaled[s]
+        if scaled[l] < 1.:
+            small.append(l)
+        else:
+            large.append(l)
+    # Anything left is 1 up to rounding errors.
+    return alias_prob, alias
+
+class ObjTypeTable(object):
+    """The object types of a MixedScene and their probabilities, compiled for fast sampling.
+
+    This is made once and cached in the stamp field, rather than summing and walking through
+    the objects dict for every object.
+
+    @param objects      The objects dict, giving the relative probability of each type.
+    """
+    def __init__(self, objects):
+        self.keys = list(objects.keys())
+        self.index = dict( (key, i) for i, key in enumerate(self.keys) )
+
+        # If the user is careful, this will be 1, but if not, renormalize for them.
+        norm = float(sum(objects.values()))
+        prob = np.array([ value / norm for value in objects.values() ])
+
+        self.alias_prob, self.alias = AliasTable(prob)
+
+    def select(self, u):
+        """Select the type index for a single uniform deviate u using the alias table.
+        """
+        n = len(self.keys)
+        nu = u * n
+        i = min(int(nu), n-1)
+        return i if nu - i < self.alias_prob[i] else int(self.alias[i])
+
+    def sample(self, u):
+        """Select the type indices for a numpy array of uniform deviates u using the alias table.
+        """
+        n = len(self.keys)
+        nu = np.asarray(u) * n
+        i = np.minimum(nu.astype(int), n-1)
+        return np.where(nu - i < self.alias_prob[i], i, self.alias[i])
+
+def GetObjTypeTable(config):
+    """Get the ObjTypeTable for the objects in the MixedScene stamp field, making it if needed.
+
+    The table is remade if the objects field is replaced by a different dict, but not if the
+    existing dict is changed in place.
+    """
+    objects = config['objects']
+    cache = config.get('_obj_type_table', None)
+    if cache is None or cache[0] is not objects:
+        cache = (objects, ObjTypeTable(objects))
+        config['_obj_type_table'] = cache
+    return cache[1]
+
+def BuildObjTypes(config, base, obj_num, nobj):
+    """Select the types of nobj objects starting at obj_num all at once.
+
+    Rather than the first random number of each object's rng, this uses a hash of each object's
+    seed, so the type of each object only depends on its own seed.  e.g. with FocalPlane, an
+    object gets the same type on every chip.
+
+    @param config       The stamp field.
+    @param base         The base configuration dict.
+    @param obj_num      The obj_num of the first object.
+    @param nobj         The number of objects.
+
+    @returns a numpy array of the type index of each object
+    """
+    if 'random_seed' not in base.get('image',{}):
+        raise galsim.GalSimConfigError("MixedScene batch_obj_types requires image.random_seed")
+    random_seed = base['image']['random_seed']
+    if isinstance(random_seed, list):
+        seed_config = random_seed
+        seed_key = config.get('rng_num', 0)
+    else:
+        seed_config = base['image']
+        seed_key = 'random_seed'
+
+    # The stamp rngs use a seed_offset of 1 relative to the random_seed value.
+    seeds = BuildBatchSeeds(seed_config, seed_key, base, obj_num, nobj) + 1
+    return GetObjTypeTable(config).sample(HashUniform(seeds))
+
+class PSFImageCache(object):
+    """A least recently used cache of PSF images, used to draw point sources quickly.
+
+    @param max_size     The maximum number of images to keep.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.images = OrderedDict()
+        self.nhits = 0
+        self.nmisses = 0
+
+    def get(self, key):
+        """Get the image for the given key, or None if it isn't in the cache.
+        """
+        image = self.images.get(key, None)
+        if image is None:
+            self.nmisses += 1
+        else:
+            self.nhits += 1
+            self.images.move_to_end(key)
+        return image
+
+    def add(self, key, image):
+        """Add an image to the cache, removing the least recently used one if it is full.
+        """
+        self.images[key] = image
+        while len(self.images) > self.max_size:
+            self.images.popitem(last=False)
+
+def _Quantize(value, tol):
+    # Round to the nearest multiple of tol, returning an int so it can be used in a dict key.
+    return int(np.floor(value / tol + 0.5))
+
+def ShearScene(ra, dec, scene_center, shear):
+    """Shear the positions of many objects at once about the center of the scene.
+
+    This is the same as what MixedScene does for each object when shear_scene is True, but
+    with numpy arrays of positions.
+
+    @param ra           A numpy array of ra values in radians.
+    @param dec          A numpy array of dec values in radians.
+    @param scene_center The center of the scene as a CelestialCoord.
+    @param shear        The shear to apply as a galsim.Shear.
+
+    @returns the sheared ra, dec as numpy arrays in radians
+    """
+    u, v = scene_center.project_rad(ra, dec, projection='gnomonic')
+    mat = shear.getMatrix()
+    u2 = mat[0,0] * u + mat[0,1] * v
+    v2 = mat[1,0] * u + mat[1,1] * v
+    return scene_center.deproject_rad(u2, v2, projection='gnomonic')
+
+def GetSceneShear(base):
+    """Get the shear to apply to the whole scene if it can be done for all the objects at once.
+
+    This is only possible if the stamp type is MixedScene and shear_scene is True for every
+    object, and the shear is the same for every object.  Otherwise, this returns None and
+    MixedScene shears each object's position separately.
+
+    @param base         The base configuration dict.
+
+    @returns the shear as a galsim.Shear or None
+    """
+    stamp = base.get('stamp', {})
+    if stamp.get('type', None) != 'MixedScene' or stamp.get('shear_scene', False) is not True:
+        return None
+    if 'shear' not in stamp:
+        return None
+    try:
+        shear, safe = galsim.config.ParseValue(stamp, 'shear', base, galsim.Shear)
+    except (galsim.GalSimError, KeyError):
+        # e.g. the shear depends on current_obj_type, which isn't set yet.
+        return None
+    return shear if safe else None
 
 class MixedSceneBuilder(galsim.config.StampBuilder):
 
@@ -24,30 +209,37 @@ class MixedSceneBuilder(galsim.config.StampBuilder):
         ud = galsim.UniformDeviate(rng)
         p = ud()  # A random number between 0 and 1.
 
-        # If the user is careful, this will be 1, but if not, renormalize for them.
-        norm = float(sum(objects.values()))
+        table = GetObjTypeTable(config)
+
+        if 'batch_obj_types' in config:
+            batch = galsim.config.ParseValue(config, 'batch_obj_types', base, bool)[0]
+        else:
+            batch = False
 
         if 'obj_type' in config:
             obj_type = galsim.config.ParseValue(config, 'obj_type', base, str)[0]
-            obj_type_index = list(objects.keys()).index(obj_type)
+            obj_type_index = table.index[obj_type]
+        elif batch:
+            # Select the types of all the objects in the image the first time we need one.
+            # Note: p was still drawn above, so the rest of the object's random values are the
+            # same as without batch_obj_types.
+            obj_num = base['obj_num']
+            start = base.get('start_obj_num', obj_num)
+            key = (table, base.get('file_num',0), base.get('image_num',0))
+            cache = config.get('_batch_obj_types', None)
+            if (cache is None or cache[0] != key or
+                    not (cache[1] <= obj_num < cache[1] + len(cache[2]))):
+                nobj = galsim.config.GetNObjForImage(base, base.get('image_num',0))
+                if not (start <= obj_num < start + nobj):
+                    start, nobj = obj_num, 1
+                cache = (key, start, BuildObjTypes(config, base, start, nobj))
+                config['_batch_obj_types'] = cache
+            obj_type_index = int(cache[2][obj_num - cache[1]])
+            obj_type = table.keys[obj_type_index]
         else:
             # Figure out which object field to use
-            obj_type = None  # So we can check that it was set to something.
-            obj_type_index = 0
-            for key, value in objects.items():
-                p1 = value / norm
-                if p < p1:
-                    # Use this object
-                    obj_type = key
-                    break
-                else:
-                    p -= p1
-                    obj_type_index += 1
-            if obj_type is None:
-                # This shouldn't happen, but maybe possible from rounding errors.  Use the last one.
-                obj_type = list(objects.keys())[-1]
-                obj_type_index -= 1
-                logger.error("Error in MixedScene.  Didn't pick an object to use.  Using %s",obj_type)
+            obj_type_index = table.select(p)
+            obj_type = table.keys[obj_type_index]
 
         # Save this in the dict so it can be used by e.g. the truth catalog or to do something
         # different depending on which kind of object we have.
@@ -58,7 +250,8 @@ class MixedSceneBuilder(galsim.config.StampBuilder):
         # Add objects field to the ignore list
         # Also ignore magnify and shear, which we allow here for convenience to act on whichever
         # object ends up being chosen.
-        ignore = ignore + ['objects', 'magnify', 'shear', 'obj_type', 'shear_scene']
+        ignore = ignore + ['objects', 'magnify', 'shear', 'obj_type', 'shear_scene',
+                           'batch_obj_types', 'psf_cache', 'select_draw_method']
 
         stamp_xsize, stamp_ysize, image_pos, world_pos = super(MixedSceneBuilder, self).setup(config,base,xsize,ysize,ignore,logger)
         
@@ -66,6 +259,11 @@ class MixedSceneBuilder(galsim.config.StampBuilder):
             shear_scene = galsim.config.ParseValue(config, 'shear_scene', base, bool)[0]
         else:
             shear_scene = False
+
+        # If the image type already sheared all the positions at once (cf. ShearScene), then
+        # don't do it again here.
+        if config.get('_scene_sheared', None) == base.get('image_num', None):
+            shear_scene = False
         
         # option to shear the full scene.
         if shear_scene:       
@@ -92,25 +290,185 @@ class MixedSceneBuilder(galsim.config.StampBuilder):
 
     def buildProfile(self, config, base, psf, gsparams, logger):
         obj_type = base['current_obj_type']
+        profile = GetProfile(base)
+        if profile is not None:
+            t0 = time.time()
 
         # Make the appropriate object using the obj_type field
         obj = galsim.config.BuildGSObject(base, obj_type, gsparams=gsparams, logger=logger)[0]
-        # Also save this in case useful for some calculation.
+        # Also save these in case useful for some calculation.
         base['current_obj'] = obj
+        base['current_psf'] = psf
 
         # Only shear and magnify are allowed, but this general TransformObject function will
         # work to implement those.
         obj, safe = galsim.config.TransformObject(obj, config, base, logger)
+        if profile is not None:
+            profile.addObject(obj_type, 'build', time.time() - t0)
 
         if psf:
             if obj:
-                return galsim.Convolve(obj,psf)
+                prof = galsim.Convolve(obj,psf)
             else:
-                return psf
+                prof = psf
         else:
             if obj:
-                return obj
+                prof = obj
             else:
-                return None
+                prof = None
+        # GalSim sets this after drawing, but getDrawMethod needs it before then.
+        base['current_prof'] = prof
+        return prof
+
+    def getDrawMethod(self, config, base, logger):
+        """Determine the draw method to use for the current object.
+
+        The select_draw_method field lets each type of object switch from draw_method
+        (e.g. phot) to an FFT method when photon shooting would be too slow.  e.g.
+
+            draw_method: phot
+            select_draw_method:
+                bright_gal:
+                    max_phot_flux: 1.e5   # Brighter objects use fft_method.
+                    max_fft_size: 512     # Unless the FFT image would be larger than this.
+                                          # [default: no maximum]
+                    fft_method: fft       # [default: fft]
+                nearby_gal:
+                    max_phot_flux: 1.e4
+
+        The cost of photon shooting is proportional to the flux, and the cost of an FFT is
+        set by the image size (in pixels) that GalSim would use to draw the profile.  Types not
+        listed just use draw_method.  The method used for each object is saved as
+        base['current_draw_method'], so it can be used in the truth catalog as
+        @current_draw_method.
+        """
+        method = super(MixedSceneBuilder, self).getDrawMethod(config, base, logger)
+        obj_type = base['current_obj_type']
+        prof = base.get('current_prof', None)
+        select = config.get('select_draw_method', {})
+        if obj_type in select and prof is not None:
+            req = { 'max_phot_flux' : float }
+            opt = { 'max_fft_size' : int, 'fft_method' : str }
+            params = galsim.config.GetAllParams(select[obj_type], base, req=req, opt=opt)[0]
+            fft_method = params.get('fft_method', 'fft')
+            if fft_method not in galsim.config.stamp.valid_draw_methods or fft_method == 'phot':
+                raise galsim.GalSimConfigValueError(
+                    "Invalid fft_method for select_draw_method.", fft_method,
+                    [ m for m in galsim.config.stamp.valid_draw_methods if m != 'phot' ])
+            if abs(prof.flux) > params['max_phot_flux']:
+                if 'max_fft_size' in params:
+                    wcs = base['wcs'].local(image_pos=base.get('image_pos',None))
+                    size = prof.getGoodImageSize(wcs.minLinearScale())
+                    if size <= params['max_fft_size']:
+                        method = fft_method
+                else:
+                    method = fft_method
+        logger.debug('obj %d: draw_method = %s', base.get('obj_num',0), method)
+        base['current_draw_method'] = method
+        return method
+
+    def draw(self, prof, image, method, offset, config, base, logger):
+        profile = GetProfile(base)
+        if profile is not None:
+            t0 = time.time()
+        if self.usePSFCache(method, config, base):
+            image = self.drawCachedPSF(prof, image, method, offset, config, base, logger)
+        else:
+            image = super(MixedSceneBuilder, self).draw(prof, image, method, offset, config, base,
+                                                        logger)
+        if profile is not None:
+            profile.addObject(base['current_obj_type'], 'draw', time.time() - t0)
+        return image
+
+    def usePSFCache(self, method, config, base):
+        """Check whether to draw the current object using the psf_cache.
+
+        The psf_cache field specifies a type of object (obj_type) that is a point source, so
+        it looks just like the PSF scaled by its flux.  e.g.
+
+            psf_cache:
+                obj_type: star
+                key: [ '$(@psf.ellip).g1', '$(@psf.ellip).g2', '@psf.fwhm' ]
+                tol: 1.e-3          # The tolerance for the key values. [default: 1.e-3]
+                offset_tol: 0.05    # The tolerance for the sub-pixel offset. [default: 0.05]
+                max_size: 1000      # The maximum number of PSF images to keep. [default: 1000]
+
+        Objects of this type are drawn by scaling a cached image of the PSF.  The images are
+        cached according to the key values (and the local wcs and stamp offset) rounded to the
+        given tolerances, so objects with nearly the same PSF use the same image.  If key is
+        not given, then with the FocalPlane output type, the key is the cell of the focal plane
+        that the object is in, where the cells are cell_size arcsec on a side [default: 60].
+        All the point sources in a cell use the image of the PSF of the first one drawn there.
+        Otherwise, the PSF objects must be exactly equal.
+
+        This isn't used for draw_method = phot (or with a sensor), since then the photons
+        should be shot separately for each object.  Use select_draw_method to draw the point
+        sources with fft if they should use the cache.
+        """
+        if 'psf_cache' not in config: return False
+        if method == 'phot' or base.get('sensor', None) is not None: return False
+        obj_type = galsim.config.ParseValue(config['psf_cache'], 'obj_type', base, str)[0]
+        return (obj_type == base['current_obj_type'] and base['current_psf'] is not None and
+                base['current_obj'] is not None)
+
+    def drawCachedPSF(self, prof, image, method, offset, config, base, logger):
+        """Draw the current object as a scaled image of the PSF, using the psf_cache.
+
+        @param prof         The profile to draw, which should be (object * psf).
+        """
+        cache_config = config['psf_cache']
+        opt = { 'tol' : float, 'offset_tol' : float, 'max_size' : int, 'cell_size' : float }
+        ignore = [ 'obj_type', 'key' ]
+        params = galsim.config.GetAllParams(cache_config, base, opt=opt, ignore=ignore)[0]
+        tol = params.get('tol', 1.e-3)
+        offset_tol = params.get('offset_tol', 0.05)
+
+        cache = cache_config.get('_cache', None)
+        if cache is None:
+            cache = PSFImageCache(params.get('max_size', 1000))
+            cache_config['_cache'] = cache
+
+        psf = base['current_psf']
+        if 'key' in cache_config:
+            keys = cache_config['key']
+            psf_key = tuple([ _Quantize(galsim.config.ParseValue(keys, i, base, float)[0], tol)
+                              for i in range(len(keys)) ])
+        elif '_focalplane_exposure' in base:
+            # The position in the focal plane, relative to the pointing of this exposure.
+            exposure = base['_focalplane_exposure']
+            u, v = exposure['world_center'].project(base['world_pos'])
+            cell_size = params.get('cell_size', 60.)
+            psf_key = (exposure['exp_num'], int(np.floor(u / galsim.arcsec / cell_size)),
+                       int(np.floor(v / galsim.arcsec / cell_size)))
+        else:
+            psf_key = psf
+        wcs = base['wcs'].local(image_pos=base['image_pos'])
+        wcs_key = tuple([ _Quantize(x, tol) for x in wcs.jacobian().getMatrix().ravel() ])
+        offset = offset if offset is not None else galsim.PositionD(0,0)
+        offset_x = _Quantize(offset.x, offset_tol)
+        offset_y = _Quantize(offset.y, offset_tol)
+        shape = image.array.shape if image is not None else None
+        key = (psf_key, wcs_key, offset_x, offset_y, shape)
+
+        psf_image = cache.get(key)
+        if psf_image is None:
+            logger.debug('obj %d: Drawing new PSF image for psf_cache', base.get('obj_num',0))
+            offset = galsim.PositionD(offset_x * offset_tol, offset_y * offset_tol)
+            drawn = galsim.config.DrawBasic(psf.withFlux(1.), image, method, offset,
+                                            config, base, logger)
+            psf_image = drawn.copy()
+            psf_image.added_flux = drawn.added_flux
+            cache.add(key, psf_image)
+
+        # The cached image has unit flux, so scale it by the flux of the full profile, which
+        # includes the flux of the PSF (e.g. from its magnification) and of the object.
+        flux = prof.flux
+        if image is None:
+            image = psf_image * flux
+        else:
+            image.array[:,:] = psf_image.array
+            image *= flux
+        image.added_flux = psf_image.added_flux * flux
+        return image
 
 galsim.config.stamp.RegisterStampType('MixedScene', MixedSceneBuilder())
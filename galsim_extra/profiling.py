@@ -0,0 +1,191 @@
+#
+# This module defines an extra output type called profile, which records how long the various
+# stages of building each output file took.
+#
+# Add a profile field to the output field to turn it on.  e.g.
+#
+#     output:
+#         profile:
+#             file_name:
+#                 type: FormattedStr
+#                 format: "profile_%02d.json"
+#                 items: [ "$file_num" ]
+#
+# Each output file then gets a JSON file with the wall time and the number of objects of each
+# stage.  For memory, the OS only reports the peak RSS of the process so far, so each stage
+# records that at its end (process_peak_rss) and how much the stage raised it
+# (peak_rss_increase).  A stage that stays below an earlier peak shows no increase, even if it
+# used a lot of memory.
+#
+# The FocalPlane output type, the WideScattered image type and the MixedScene stamp type record
+# their own stages (e.g. exposure_setup, wcs, inputs, stamps, noise, write), and MixedScene also
+# records the time spent building and drawing each kind of object.  Stages may be nested, so the
+# times don't necessarily add up to the total.
+#
+# Note: if using image.nproc > 1, the stamps are built in other processes, so the stamp-level
+# timings are not recorded.
+
+import galsim
+import json
+import resource
+import sys
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+def PeakRSS():
+    """Return the peak resident set size of the current process so far in MBytes.
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # This is in bytes on OSX, but kBytes on linux.
+    if sys.platform == 'darwin':
+        return rss / 2.**20
+    else:
+        return rss / 2.**10
+
+class StageProfile(object):
+    """The timings of the stages for building a single output file.
+    """
+    def __init__(self):
+        self.t0 = time.time()
+        self.stages = OrderedDict()
+        self.obj_types = OrderedDict()
+        self._start = {}
+
+    def start(self, name):
+        """Start timing the given stage.
+        """
+        self._start[name] = (time.time(), PeakRSS())
+
+    def stop(self, name, nobj=0):
+        """Stop timing the given stage and add the time to the total for that stage.
+
+        If the stage wasn't started, this doesn't do anything.
+
+        @param name         The name of the stage.
+        @param nobj         The number of objects processed in this stage. [default: 0]
+        """
+        start = self._start.pop(name, None)
+        if start is not None:
+            t0, rss0 = start
+            self.add(name, time.time() - t0, nobj, PeakRSS() - rss0)
+
+    def add(self, name, t, nobj=0, rss_increase=0.):
+        """Add a time to the total for the given stage.
+
+        @param name         The name of the stage.
+        @param t            The time in seconds.
+        @param nobj         The number of objects processed in this stage. [default: 0]
+        @param rss_increase The increase of the peak RSS of the process during this stage in
+                            MBytes. [default: 0]
+        """
+        if name not in self.stages:
+            self.stages[name] = { 'time' : 0., 'calls' : 0, 'nobj' : 0,
+                                  'process_peak_rss' : 0., 'peak_rss_increase' : 0. }
+        stage = self.stages[name]
+        stage['time'] += t
+        stage['calls'] += 1
+        stage['nobj'] += nobj
+        stage['process_peak_rss'] = PeakRSS()
+        stage['peak_rss_increase'] += rss_increase
+
+    @contextmanager
+    def stage(self, name, nobj=0):
+        """A context manager to time the given stage.
+        """
+        t0 = time.time()
+        rss0 = PeakRSS()
+        yield
+        self.add(name, time.time() - t0, nobj, PeakRSS() - rss0)
+
+    def addObject(self, obj_type, step, t):
+        """Add a time for one step (e.g. build or draw) of making an object of the given type.
+
+        @param obj_type     The type of object.
+        @param step         The name of the step.
+        @param t            The time in seconds.
+        """
+        if obj_type not in self.obj_types:
+            self.obj_types[obj_type] = OrderedDict()
+        obj = self.obj_types[obj_type]
+        key = step + '_time'
+        obj[key] = obj.get(key, 0.) + t
+        if step == 'build':
+            obj['count'] = obj.get('count', 0) + 1
+
+    def asdict(self):
+        """Return the profile as a dict.
+        """
+        return OrderedDict([
+            ('total_time', time.time() - self.t0),
+            ('process_peak_rss', PeakRSS()),
+            ('stages', self.stages),
+            ('obj_types', self.obj_types),
+        ])
+
+def GetProfile(base):
+    """Get the current StageProfile, or None if not profiling.
+    """
+    return base.get('_profile', None)
+
+def StartStage(base, name):
+    """Start timing a stage if profiling is turned on.
+
+    @param base         The base configuration dict.
+    @param name         The name of the stage.
+    """
+    profile = GetProfile(base)
+    if profile is not None:
+        profile.start(name)
+
+def StopStage(base, name, nobj=0):
+    """Stop timing a stage if profiling is turned on.
+
+    @param base         The base configuration dict.
+    @param name         The name of the stage.
+    @param nobj         The number of objects processed in this stage. [default: 0]
+    """
+    profile = GetProfile(base)
+    if profile is not None:
+        profile.stop(name, nobj)
+
+@contextmanager
+def ProfileStage(base, name, nobj=0):
+    """A context manager to time a stage if profiling is turned on.
+
+    @param base         The base configuration dict.
+    @param name         The name of the stage.
+    @param nobj         The number of objects processed in this stage. [default: 0]
+    """
+    profile = GetProfile(base)
+    if profile is None:
+        yield
+    else:
+        with profile.stage(name, nobj):
+            yield
+
+class ProfileBuilder(galsim.config.ExtraOutputBuilder):
+    """Build a profile of the time taken by each stage of building each output file.
+    """
+    def initialize(self, data, scratch, config, base, logger):
+        super(ProfileBuilder, self).initialize(data, scratch, config, base, logger)
+        base['_profile'] = StageProfile()
+
+    def finalize(self, config, base, main_data, logger):
+        profile = OrderedDict()
+        for key in [ 'file_num', 'exp_num', 'chip_num' ]:
+            if key in base:
+                profile[key] = base[key]
+        if '_focalplane_file_name' in base:
+            profile['file_name'] = base['_focalplane_file_name']
+        profile.update(base['_profile'].asdict())
+        return profile
+
+    def writeFile(self, file_name, config, base, logger):
+        with open(file_name, 'w') as fout:
+            json.dump(self.final_data, fout, indent=2)
+
+    def writeHdu(self, config, base, logger):
+        raise galsim.GalSimConfigError("The profile output can only be written to a file.")
+
+galsim.config.RegisterExtraOutput('profile', ProfileBuilder())
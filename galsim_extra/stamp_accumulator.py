@@ -0,0 +1,114 @@
+#
+# This module adds a list of postage stamps into a full image, optionally using several threads.
+#
+# The image is split into square tiles, and each thread adds all the stamps (or the parts of
+# stamps) that overlap one tile at a time.  The tiles don't overlap, so no locks are needed.
+# Within each tile, the stamps are added in their original order, so every pixel gets the same
+# sum in the same order as adding the stamps one at a time.  i.e. the result is identical
+# regardless of the number of threads or the tile size.
+#
+# This works directly with the numpy arrays, rather than with galsim Image and Bounds objects,
+# which also saves a lot of overhead when there are many small stamps.  numpy releases the GIL
+# while adding the arrays, so the threads help most when the stamps are large.
+
+import galsim
+import logging
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+def AccumulateStamps(image, stamps, current_vars, noise_image=None, nthreads=1, tile_size=512,
+                     logger=None):
+    """Add the stamps into the image.
+
+    If any stamp has a non-zero current variance, its variance is also added into noise_image
+    over the stamp's bounds, so the noise can be flattened later.  If noise_image is None, it is
+    made as needed.
+
+    @param image        The full image onto which the stamps should be added.
+    @param stamps       A list of the postage stamps.  None means the object was skipped.
+    @param current_vars A list of the current variance in each postage stamp.
+    @param noise_image  An image of the current variance in each pixel so far, or None.
+                        [default: None]
+    @param nthreads     The number of threads to use. [default: 1]
+    @param tile_size    The size in pixels of the tiles that the image is split into when
+                        using more than one thread. [default: 512]
+    @param logger       If given, a logger object to log progress. [default: None]
+
+    @returns noise_image, which is None if none of the stamps had any variance
+    """
+    logger = galsim.config.LoggerWrapper(logger)
+    bounds = image.bounds
+
+    # First figure out the overlap of each stamp with the image.  These are (k, xmin, xmax,
+    # ymin, ymax) in image coordinates, with xmax, ymax one past the end, like python slices.
+    # Note: This uses plain ints rather than galsim.BoundsI, which is much faster.
+    debug = logger.getEffectiveLevel() <= logging.DEBUG
+    overlaps = []
+    for k, stamp in enumerate(stamps):
+        # This is our signal that the object was skipped.
+        if stamp is None: continue
+        if current_vars[k] > 0 and noise_image is None:
+            noise_image = galsim.Image(bounds=bounds, dtype=image.dtype)
+        x1 = max(stamp.xmin, bounds.xmin)
+        x2 = min(stamp.xmax, bounds.xmax) + 1
+        y1 = max(stamp.ymin, bounds.ymin)
+        y2 = min(stamp.ymax, bounds.ymax) + 1
+        if debug:
+            logger.debug('full bounds = %s',str(bounds))
+            logger.debug('stamp bounds = %s',str(stamp.bounds))
+            logger.debug('Overlap = %s',str(stamp.bounds & bounds))
+        if x1 < x2 and y1 < y2:
+            overlaps.append( (k, x1, x2, y1, y2) )
+        else:
+            logger.info(
+                "Object centered at (%d,%d) is entirely off the main image, "
+                "whose bounds are (%d,%d,%d,%d)."%(
+                    stamp.center.x, stamp.center.y,
+                    bounds.xmin, bounds.xmax, bounds.ymin, bounds.ymax))
+
+    def add_region(overlaps, xmin, xmax, ymin, ymax):
+        # Add the parts of the given stamps that are within xmin <= x < xmax, ymin <= y < ymax.
+        for k, x1, x2, y1, y2 in overlaps:
+            x1 = max(x1, xmin)
+            x2 = min(x2, xmax)
+            y1 = max(y1, ymin)
+            y2 = min(y2, ymax)
+            if x1 >= x2 or y1 >= y2: continue
+            stamp = stamps[k]
+            # Note: numpy arrays are indexed as y,x
+            # This does the sum at the higher precision if the stamp is double precision and
+            # the image single, the same as image[b] += stamp[b].
+            ar = image.array[y1-bounds.ymin:y2-bounds.ymin, x1-bounds.xmin:x2-bounds.xmin]
+            np.add(ar, stamp.array[y1-stamp.ymin:y2-stamp.ymin, x1-stamp.xmin:x2-stamp.xmin],
+                   out=ar, casting='unsafe')
+            if current_vars[k] > 0:
+                ar = noise_image.array[y1-bounds.ymin:y2-bounds.ymin,
+                                       x1-bounds.xmin:x2-bounds.xmin]
+                np.add(ar, current_vars[k], out=ar, casting='unsafe')
+
+    if nthreads <= 1:
+        add_region(overlaps, bounds.xmin, bounds.xmax+1, bounds.ymin, bounds.ymax+1)
+        return noise_image
+
+    # Make a list of the stamps that overlap each tile, keeping them in the original order.
+    ntx = (bounds.xmax - bounds.xmin) // tile_size + 1
+    nty = (bounds.ymax - bounds.ymin) // tile_size + 1
+    tile_overlaps = [ [] for t in range(ntx * nty) ]
+    for overlap in overlaps:
+        k, x1, x2, y1, y2 = overlap
+        for ty in range((y1-bounds.ymin) // tile_size, (y2-1-bounds.ymin) // tile_size + 1):
+            for tx in range((x1-bounds.xmin) // tile_size, (x2-1-bounds.xmin) // tile_size + 1):
+                tile_overlaps[ty * ntx + tx].append(overlap)
+
+    def add_tile(t):
+        tx = t % ntx
+        ty = t // ntx
+        xmin = bounds.xmin + tx * tile_size
+        ymin = bounds.ymin + ty * tile_size
+        add_region(tile_overlaps[t], xmin, xmin + tile_size, ymin, ymin + tile_size)
+
+    with ThreadPoolExecutor(max_workers=nthreads) as executor:
+        # Use list to make sure any exceptions in the threads are raised here.
+        list(executor.map(add_tile, [ t for t in range(ntx * nty) if tile_overlaps[t] ]))
+
+    return noise_image
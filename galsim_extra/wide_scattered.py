@@ -6,18 +6,29 @@
 import galsim
 import coord
 import numpy as np
+import os
+from .profiling import ProfileStage, StartStage, StopStage
+from .batch_world_pos import valid_batch_world_pos, BuildBatchWorldPos
+from .stamp_accumulator import AccumulateStamps
+from .mixed_scene import ShearScene, GetSceneShear
 
 class WideScatteredBuilder(galsim.config.image_scattered.ScatteredImageBuilder):
 
     def setup(self, config, base, image_num, obj_num, ignore, logger):
-        ignore = ignore + ['border']
-        return super(WideScatteredBuilder, self).setup(config, base, image_num, obj_num, ignore, logger)
+        ignore = ignore + ['border', 'object_border', 'prefilter', 'chunk_size',
+                          'accumulate_nthreads', 'accumulate_tile_size']
+        xsize, ysize = super(WideScatteredBuilder, self).setup(config, base, image_num, obj_num,
+                                                               ignore, logger)
+        # The inputs (e.g. the power spectrum grid) are set up between here and buildImage.
+        StartStage(base, 'inputs')
+        return xsize, ysize
 
     def buildImage(self, config, base, image_num, obj_num, logger):
         # Copy the Scattered buildImage function, but with changes to skip building stamps that
         # are clearly not in the image.
 
         #print('start buildImage')
+        StopStage(base, 'inputs')
         xsize = base['image_xsize']
         ysize = base['image_ysize']
         wcs = base['wcs']
@@ -43,6 +54,26 @@ class WideScatteredBuilder(galsim.config.image_scattered.ScatteredImageBuilder):
         else:
             border = 60  # default = 1 arcmin
 
+        # Alternatively, object_border gives a separate border for each object, e.g. based on
+        # its size.  This is evaluated for each object, using that object's rng.
+        if 'object_border' in config and 'border' in config:
+            raise galsim.GalSimConfigError(
+                "Only one of border and object_border may be given for WideScattered")
+
+        # How to test whether an object is within the border of the image.
+        #   sky     Test against the chip polygon on the sky, with straight (great circle) edges
+        #           between the corners. [default]
+        #   pixel   Convert the positions to image coordinates with the wcs and test against the
+        #           image bounds.  This is exact even if the wcs has distortions, so the edges
+        #           are curved on the sky.
+        if 'prefilter' in config:
+            prefilter = galsim.config.ParseValue(config, 'prefilter', base, str)[0]
+            if prefilter not in ('sky', 'pixel'):
+                raise galsim.GalSimConfigValueError("Invalid image.prefilter", prefilter,
+                                                    ('sky', 'pixel'))
+        else:
+            prefilter = 'sky'
+
         # Note: I'm hard-coding this to celestial coordinates.  So just raise an exception if
         # someone does this with a EuclideanWCS
         assert wcs.isCelestial()
@@ -56,6 +87,8 @@ class WideScatteredBuilder(galsim.config.image_scattered.ScatteredImageBuilder):
         lr = wcs.toWorld(galsim.PositionD(image.xmax, image.ymin))  # lower-right
         ur = wcs.toWorld(galsim.PositionD(image.xmax, image.ymax))  # upper-right
         cen = wcs.toWorld(image.true_center)
+        # The chip corners in order around the perimeter, before adding any border.
+        chip_corners = (ll, ul, ur, lr)
         #print('ll = ',ll)
         #print('ul = ',ul)
         #print('lr = ',lr)
@@ -109,39 +142,54 @@ class WideScatteredBuilder(galsim.config.image_scattered.ScatteredImageBuilder):
         logger.debug('obj %d: seed = %d',obj_num,seed)
 
         # Figure out which ones are actually worth building stamps for:
-        skip = np.ones(self.nobjects, dtype=bool)
-        stamp_world_pos = []  # Keep track of the world_pos values.
-        #print('config = ',galsim.config.CleanConfig(config))
-        for k in range(self.nobjects):
-            base['obj_num'] = obj_num + k
-            pos = galsim.config.ParseWorldPos(config, 'world_pos', base, logger)
-            #wrap the ra using the same center as we did
-            #for the chip corners, and use this wrapped versions
-            #when testing whether it lands in the chip below.
-            pos_wrapped = coord.CelestialCoord(
-                ra=pos.ra.wrap(center=cen.ra),
-                dec=pos.dec)
-            stamp_world_pos.append(pos)
-            #print('pos = ',pos.ra.deg,pos.dec.deg)
-
-            # Trivial check first.
-            if pos_wrapped.ra.deg < min_ra: continue
-            if pos_wrapped.ra.deg > max_ra: continue
-            if pos_wrapped.dec.deg < min_dec: continue
-            if pos_wrapped.dec.deg > max_dec: continue
-            #print('passed trivial checks')
-
-            # Now a more careful check if it is really in the polygon.
-            # Check if it is on the same side of all four (directed) edges.
-            # Note: The WCS may or may not include a flip, so we don't know whether these
-            # should all the left or right.
-            lefts = [self._leftside(pos_wrapped, p1, p2) for p1,p2 in edges]
-            #print('lefts = ',lefts)
-            if len(set(lefts)) == 2: continue
-            #print('all left or all right')
-
-            # OK.  This one is close enough to generate the stamp.
-            skip[k] = False
+        StartStage(base, 'positions')
+        base['obj_num'] = obj_num
+        if config['world_pos'].get('type', None) in valid_batch_world_pos:
+            # Then we can generate all the positions at once.
+            ra, dec = BuildBatchWorldPos(config['world_pos'], base, self.nobjects)
+            stamp_world_pos = [ coord.CelestialCoord(r * coord.radians, d * coord.radians)
+                                for r, d in zip(ra, dec) ]
+        else:
+            stamp_world_pos = []  # Keep track of the world_pos values.
+            for k in range(self.nobjects):
+                base['obj_num'] = obj_num + k
+                stamp_world_pos.append(
+                        galsim.config.ParseWorldPos(config, 'world_pos', base, logger))
+            ra = np.array([ pos.ra.rad for pos in stamp_world_pos ])
+            dec = np.array([ pos.dec.rad for pos in stamp_world_pos ])
+
+        # If MixedScene would shear the whole scene by the same shear for every object, do that
+        # here for all the positions at once.  Then the objects are also tested for being on
+        # the image at their sheared positions.
+        base['stamp'].pop('_scene_sheared', None)
+        scene_shear = GetSceneShear(base)
+        if scene_shear is not None:
+            ra, dec = ShearScene(ra, dec, base['world_center'], scene_shear)
+            stamp_world_pos = [ coord.CelestialCoord(r * coord.radians, d * coord.radians)
+                                for r, d in zip(ra, dec) ]
+            base['stamp']['_scene_sheared'] = image_num
+        if 'object_border' in config:
+            # Unlike world_pos, evaluate this with each object's own rng, the same one the stamp
+            # builder will use for it, so random values don't depend on the other objects in
+            # the image.  This costs an rng setup per object, so only do it for object_border.
+            object_border = np.empty(self.nobjects)
+            for k in range(self.nobjects):
+                galsim.config.SetupConfigObjNum(base, obj_num + k, logger)
+                stamp_builder = galsim.config.valid_stamp_types[base['stamp']['type']]
+                stamp_builder.setupRNG(base['stamp'], base, logger)
+                object_border[k] = galsim.config.ParseValue(config, 'object_border', base,
+                                                            float)[0]
+        else:
+            object_border = border
+        if prefilter == 'pixel':
+            dist = self._pixel_distance(ra, dec, wcs, image.bounds, cen, chip_corners)
+            skip = ~(dist <= object_border * coord.arcsec.value)
+        elif 'object_border' in config:
+            dist = self._distance(ra, dec, chip_corners)
+            skip = dist > object_border * coord.arcsec.value
+        else:
+            skip = ~self._inside(ra, dec, cen, edges, min_ra, max_ra, min_dec, max_dec)
+        StopStage(base, 'positions', self.nobjects)
 
         # Write the stamp-level world_pos to just read off values from the list.
         base['stamp']['world_pos'] = {
@@ -157,44 +205,162 @@ class WideScatteredBuilder(galsim.config.image_scattered.ScatteredImageBuilder):
         #print('stamp.world_pos = ',stamp_world_pos)
         #print('quick_skip = ',skip)
 
-        # The rest of this just copies from the normal Scattered buildImage function
-        stamps, current_vars = galsim.config.stamp.BuildStamps(
-                self.nobjects, base, logger=logger, obj_num=obj_num, do_noise=False)
+        # Build the stamps in chunks of at most chunk_size stamps (not counting the skipped
+        # objects), adding each chunk into the image before building the next one.  This keeps
+        # the memory from growing with the number of objects.  The default is all at once.
+        if 'chunk_size' in config:
+            chunk_size = galsim.config.ParseValue(config, 'chunk_size', base, int)[0]
+            if chunk_size < 1:
+                raise galsim.GalSimConfigValueError(
+                    "image.chunk_size must be >= 1", chunk_size)
+        else:
+            chunk_size = max(self.nobjects, 1)
+        built = np.where(~skip)[0]
+        starts = [0] + [ int(k) for k in built[chunk_size::chunk_size] ]
+        ends = starts[1:] + [self.nobjects]
+
+        # The stamps can be added into the image using several threads, each of which adds the
+        # stamps in a separate tile of the image.  nthreads <= 0 means use all the cpus.
+        if 'accumulate_nthreads' in config:
+            nthreads = galsim.config.ParseValue(config, 'accumulate_nthreads', base, int)[0]
+            if nthreads <= 0:
+                nthreads = os.cpu_count()
+        else:
+            nthreads = 1
+        if 'accumulate_tile_size' in config:
+            tile_size = galsim.config.ParseValue(config, 'accumulate_tile_size', base, int)[0]
+            if tile_size < 1:
+                raise galsim.GalSimConfigValueError(
+                    "image.accumulate_tile_size must be >= 1", tile_size)
+        else:
+            tile_size = 512
+
+        # Rather than keeping all the stamps to flatten the noise variance at the end, keep track
+        # of the current variance in each pixel as we go.  This is only made if some stamp
+        # actually has a non-zero variance.
+        noise_image = None
+
+        for start, end in zip(starts, ends):
+            # The rest of this just copies from the normal Scattered buildImage function
+            with ProfileStage(base, 'stamps', int(np.sum(~skip[start:end]))):
+                stamps, current_vars = galsim.config.stamp.BuildStamps(
+                        end-start, base, logger=logger, obj_num=obj_num+start, do_noise=False)
+
+            StartStage(base, 'accumulate')
+            noise_image = AccumulateStamps(image, stamps, current_vars, noise_image,
+                                           nthreads, tile_size, logger)
+            StopStage(base, 'accumulate', sum([ stamp is not None for stamp in stamps ]))
+            # Let these go before building the next chunk.
+            del stamps, current_vars
 
         base['index_key'] = 'image_num'
 
-        for stamp in stamps:
-            # This is our signal that the object was skipped.
-            if stamp is None: continue
-            bounds = stamp.bounds & image.bounds
-            logger.debug('image %d: full bounds = %s',image_num,str(image.bounds))
-            logger.debug('image %d: stamp bounds = %s',image_num,str(stamp.bounds))
-            logger.debug('image %d: Overlap = %s',image_num,str(bounds))
-            if bounds.isDefined():
-                image[bounds] += stamp[bounds]
-            else:
-                logger.info(
-                    "Object centered at (%d,%d) is entirely off the main image, "
-                    "whose bounds are (%d,%d,%d,%d)."%(
-                        stamp.center.x, stamp.center.y,
-                        image.bounds.xmin, image.bounds.xmax,
-                        image.bounds.ymin, image.bounds.ymax))
-
-        # Bring the image so far up to a flat noise variance
-        current_var = galsim.config.FlattenNoiseVariance(
-                base, image, stamps, current_vars, logger)
+        # Bring the image so far up to a flat noise variance.
+        # This is equivalent to galsim.config.FlattenNoiseVariance, but using noise_image.
+        current_var = 0
+        if noise_image is not None:
+            current_var = np.max(noise_image.array)
+            logger.debug('image %d: maximum noise varance in any pixel is %f',
+                         image_num, current_var)
+            noise_image = current_var - noise_image
+            image.addNoise(galsim.VariableGaussianNoise(base['image_num_rng'], noise_image))
 
         return image, current_var
 
+    def addNoise(self, image, config, base, image_num, obj_num, current_var, logger):
+        with ProfileStage(base, 'noise'):
+            super(WideScatteredBuilder, self).addNoise(image, config, base, image_num, obj_num,
+                                                       current_var, logger)
+
     @staticmethod
-    def _leftside(pos, p1, p2):
-        # Check if pos is to the left of the directed edge from p1 to p2.
-        # i.e. whether (p1 x p2) . pos is positive.
-        # This is calculated efficiently by the _triple method of CelestialCoord
-        pos._set_aux()
-        p1._set_aux()
-        p2._set_aux()
-        return pos._triple(p2,p1)
+    def _inside(ra, dec, cen, edges, min_ra, max_ra, min_dec, max_dec):
+        # Check which positions (given as numpy arrays of ra, dec in radians) are inside the
+        # polygon given by the (directed) edges.
+        # Wrap the ra using the same center as we did for the chip corners.
+        ra_wrapped = ra - np.floor((ra - cen.ra.rad + np.pi) / (2.*np.pi)) * 2.*np.pi
+
+        # Trivial check first.
+        inside = ((ra_wrapped >= min_ra * coord.degrees.value) &
+                  (ra_wrapped <= max_ra * coord.degrees.value) &
+                  (dec >= min_dec * coord.degrees.value) &
+                  (dec <= max_dec * coord.degrees.value))
+
+        # Now a more careful check if it is really in the polygon.
+        # Check if it is on the same side of all four (directed) edges.  The side is given by
+        # the sign of the triple product (p1 x p2) . pos.
+        # Note: The WCS may or may not include a flip, so we don't know whether these
+        # should all the left or right.
+        index = np.where(inside)[0]
+        cosdec = np.cos(dec[index])
+        xyz = np.array([cosdec * np.cos(ra[index]), cosdec * np.sin(ra[index]),
+                        np.sin(dec[index])])
+        sides = np.array([ np.dot(np.cross(p1.get_xyz(), p2.get_xyz()), xyz)
+                           for p1, p2 in edges ])
+        inside[index] = np.all(sides > 0, axis=0) | np.all(sides < 0, axis=0)
+        return inside
+
+    @staticmethod
+    def _distance(ra, dec, corners):
+        # Find the angular distance (in radians) of each position (given as numpy arrays of
+        # ra, dec in radians) from the polygon with the given corners.  This is 0 for positions
+        # inside the polygon.
+        cosdec = np.cos(dec)
+        xyz = np.array([cosdec * np.cos(ra), cosdec * np.sin(ra), np.sin(dec)])
+        corners = [ np.array(c.get_xyz()) for c in corners ]
+        dist = np.full(len(ra), np.inf)
+        sides = []
+        for p1, p2 in zip(corners, corners[1:] + corners[:1]):
+            n = np.cross(p1, p2)
+            n /= np.sqrt(np.sum(n**2))
+            side = np.dot(n, xyz)
+            sides.append(side)
+            # If the closest point on the great circle is between p1 and p2, then the distance
+            # to this edge is the distance to the great circle.  Otherwise, it is the distance
+            # to the nearer corner.
+            between = (np.dot(np.cross(n, p1), xyz) >= 0) & (np.dot(np.cross(p2, n), xyz) >= 0)
+            chord = np.minimum(np.sqrt(np.sum((xyz - p1[:,None])**2, axis=0)),
+                               np.sqrt(np.sum((xyz - p2[:,None])**2, axis=0)))
+            d = np.where(between, np.abs(np.arcsin(np.clip(side, -1, 1))),
+                         2. * np.arcsin(np.clip(chord/2., 0, 1)))
+            dist = np.minimum(dist, d)
+        # Same test as in _inside for whether it is in the polygon.
+        sides = np.array(sides)
+        inside = np.all(sides > 0, axis=0) | np.all(sides < 0, axis=0)
+        dist[inside] = 0.
+        return dist
+
+    @staticmethod
+    def _pixel_distance(ra, dec, wcs, bounds, cen, corners):
+        # Find the distance (in radians) of each position (given as numpy arrays of ra, dec in
+        # radians) from the edge of the image, using the wcs to convert them all to image
+        # coordinates at once.  This is 0 for positions on the image.
+        # The distance in pixels is converted to an angle using the smallest pixel scale at the
+        # center, so it is a slight underestimate where the pixels are larger.
+
+        # The projection is only valid near the image (e.g. a TAN projection maps points on the
+        # far side of the sky onto the image plane too).  So only convert points within 2x
+        # the radius of the image, and for the others, use a lower bound on the distance.
+        # The corners are at the centers of the corner pixels, and the edges may bulge a bit
+        # with distortion, so be generous with the radius.
+        rmax = 1.5 * max([ cen.distanceTo(c).rad for c in corners ])
+        cosdec = np.cos(dec)
+        xyz = np.array([cosdec * np.cos(ra), cosdec * np.sin(ra), np.sin(dec)])
+        chord = np.sqrt(np.sum((xyz - np.array(cen.get_xyz())[:,None])**2, axis=0))
+        theta = 2. * np.arcsin(np.clip(chord/2., 0, 1))
+        dist = theta - rmax
+        near = np.where(theta < 2. * rmax)[0]
+
+        # radecToxy passes the whole arrays to the wcs's _xy method, which is vectorized for
+        # the celestial wcs types, including GSFitsWCS (TPV etc.) and pixmappy's GalSimWCS (whose
+        # _xy projects the arrays and solves for the pixel positions with PixelMap.toPix).  So
+        # there is no need for a separate batched path for each wcs type here.
+        x, y = wcs.radecToxy(ra[near], dec[near], units=coord.radians)
+        # The edges of the image are half a pixel outside the centers of the edge pixels.
+        dx = np.maximum(np.maximum(bounds.xmin - 0.5 - x, x - bounds.xmax - 0.5), 0.)
+        dy = np.maximum(np.maximum(bounds.ymin - 0.5 - y, y - bounds.ymax - 0.5), 0.)
+        scale = wcs.local(bounds.true_center).minLinearScale() * coord.arcsec.value
+        dist[near] = np.sqrt(dx**2 + dy**2) * scale
+        return dist
 
     def add_border(self, pos, center, border):
         """Extend the great circle from ``center`` -> ``pos`` by and additional angle ``border``.
@@ -76,7 +76,246 @@ def test_truth():
     np.testing.assert_array_equal(truth_data_0, truth_data_1)
 
 
+def test_block_size():
+    """Check that block_size draws the same distribution as the normal sampling, and that the
+    values only depend on the seed.
+    """
+    from galsim_extra.cosmos_sampler import CosmosSampler
+    params = BASE_CONFIG['input']['cosmos_sampler']
+    sampler = CosmosSampler(block_size=100, **params)
+    data1 = sampler.sample(galsim.BaseDeviate(1234), size=50000)
+    data2 = sampler.sample_block(1234, 50000)
+    assert data2.shape == (50000, 2)
+    assert np.all((data2[:,0] > 0.15) & (data2[:,0] < 1.) &
+                  (data2[:,1] > 2.5) & (data2[:,1] < 100))
+    np.testing.assert_allclose(np.mean(data2, axis=0), np.mean(data1, axis=0), rtol=0.02)
+    np.testing.assert_allclose(np.std(data2, axis=0), np.std(data1, axis=0), rtol=0.05)
+
+    # The values don't depend on the order of the seeds or which blocks are cached.
+    seeds = list(range(1000, 2000, 7))
+    values1 = [ sampler.get_sample(seed) for seed in seeds ]
+    sampler2 = CosmosSampler(block_size=100, **params)
+    values2 = [ sampler2.get_sample(seed) for seed in seeds[::-1] ][::-1]
+    np.testing.assert_array_equal(values1, values2)
+
+    # Now use it in a config, with multiple processes.
+    config = {
+        'modules' : [ 'galsim_extra' ],
+        'gal' : { 'type' : 'Exponential',
+                  'half_light_radius' : { 'type' : 'CosmosR50' },
+                  'flux' : { 'type' : 'CosmosFlux' } },
+        'psf' : { 'type' : 'Gaussian', 'fwhm' : 0.7 },
+        'image' : { 'type' : 'Scattered', 'size' : 64, 'nobjects' : 20,
+                    'pixel_scale' : 0.26, 'random_seed' : 1234 },
+        'input' : { 'cosmos_sampler' : dict(params, block_size=16) },
+        'output' : { 'nfiles' : 2,
+                     'file_name' : '$"output/cosmos_block_%d.fits"%file_num',
+                     'truth' : { 'file_name' : '$"output/cosmos_block_truth_%d.dat"%file_num',
+                                 'columns' : { 'hlr' : 'gal.half_light_radius',
+                                               'flux' : 'gal.flux' } } },
+    }
+    galsim.config.Process(galsim.config.CopyConfig(config))
+    truth1 = [ np.loadtxt('output/cosmos_block_truth_%d.dat'%i) for i in range(2) ]
+    config['output']['nproc'] = 2
+    galsim.config.Process(galsim.config.CopyConfig(config))
+    truth2 = [ np.loadtxt('output/cosmos_block_truth_%d.dat'%i) for i in range(2) ]
+    np.testing.assert_array_equal(truth1, truth2)
+    hlr = np.concatenate([ t[:,0] for t in truth1 ])
+    assert np.all((hlr > 0.15) & (hlr < 1.))
+    assert len(np.unique(hlr)) == len(hlr)
+
+    # With CounterSeed seeds (e.g. FocalPlane with seed_mode = counter), the seeds are hashes,
+    # so the blocks use the obj_index counter instead.  Consecutive objects then share a block,
+    # and the same object gets the same values on every chip of the exposure.
+    from galsim_extra.cosmos_sampler import _ObjCounter
+    sampler = CosmosSampler(block_size=100, **params)
+    base = {
+        'image' : {
+            'nobjects' : 300,
+            'random_seed' : [
+                { 'type' : 'CounterSeed', 'first' : 1234, 'stream' : 0,
+                  'keys' : ['exp_num', 'chip_num', 'obj_index'] },
+                { 'type' : 'CounterSeed', 'first' : 1234, 'stream' : 1,
+                  'keys' : ['exp_num', 'obj_index'] },
+            ],
+        },
+        'exp_num' : 3,
+        'exp_start_obj_num' : 900,
+    }
+    values = []
+    for chip_num in range(2):
+        base['chip_num'] = chip_num
+        chip_values = []
+        for obj_num in range(900 + chip_num * 300, 900 + chip_num * 300 + 150):
+            base['obj_num'] = obj_num
+            counter, key = _ObjCounter({ 'rng_num' : 1 }, base)
+            assert counter == obj_num - 900 - chip_num * 300
+            assert key == (1234, 1, 3)
+            chip_values.append(sampler.get_sample(counter, key))
+        values.append(chip_values)
+    np.testing.assert_array_equal(values[0], values[1])
+    assert len(sampler._blocks) == 2
+
+
+def test_cache_dir():
+    """Check that the KDE data read from the cache_dir gives the same values as without it.
+    """
+    from galsim_extra.cosmos_sampler import CosmosSampler
+    import shutil
+    cache_dir = os.path.join('output', 'cosmos_cache')
+    if os.path.isdir(cache_dir):
+        shutil.rmtree(cache_dir)
+    params = BASE_CONFIG['input']['cosmos_sampler']
+    sampler1 = CosmosSampler(**params)
+    sampler2 = CosmosSampler(cache_dir=cache_dir, **params)
+    files = os.listdir(cache_dir)
+    assert len(files) == 2
+    sampler3 = CosmosSampler(cache_dir=cache_dir, **params)
+    assert isinstance(sampler3.kde.dataset, np.memmap)
+    assert os.listdir(cache_dir) == files
+    for sampler in [sampler2, sampler3]:
+        np.testing.assert_array_equal(sampler.kde.dataset, sampler1.kde.dataset)
+        np.testing.assert_array_equal(sampler.kde.covariance, sampler1.kde.covariance)
+        np.testing.assert_array_equal(sampler.sample(galsim.BaseDeviate(1234), size=100),
+                                      sampler1.sample(galsim.BaseDeviate(1234), size=100))
+
+    # A different kde_factor uses a different cache file.
+    sampler4 = CosmosSampler(cache_dir=cache_dir, kde_factor=0.02, **params)
+    assert len(os.listdir(cache_dir)) == 4
+    assert not np.array_equal(sampler4.kde.covariance, sampler1.kde.covariance)
+
+    # The cache is keyed on the catalog's path, size and modification time, not its contents.
+    cat_file = os.path.join('output', 'cosmos_cache_cat.dat')
+    with open(cat_file, 'w') as f:
+        f.write('test')
+    sampler4._catalog_file_name = lambda: cat_file
+    key1 = sampler4._cache_key()
+    assert sampler4._cache_key() == key1
+    os.utime(cat_file, ns=(0, 10**9))
+    key2 = sampler4._cache_key()
+    assert key2 != key1
+    with open(cat_file, 'w') as f:
+        f.write('more')
+    os.utime(cat_file, ns=(0, 10**9))
+    assert sampler4._cache_key() == key2
+
+
+def test_share():
+    """Check that a shared CosmosSampler can be pickled cheaply and is used by the workers.
+    """
+    import pickle
+    from galsim_extra.cosmos_sampler import CosmosSampler
+    params = BASE_CONFIG['input']['cosmos_sampler']
+    sampler1 = CosmosSampler(block_size=50, **params)
+    nbytes1 = len(pickle.dumps(sampler1))
+    sampler1.share()
+    nbytes2 = len(pickle.dumps(sampler1))
+    print('pickle sizes = ',nbytes1,nbytes2)
+    assert nbytes2 < 1000 < nbytes1
+    sampler2 = pickle.loads(pickle.dumps(sampler1))
+    assert np.shares_memory(sampler2.kde.dataset, sampler1.kde.dataset)
+    np.testing.assert_array_equal(sampler2.get_sample(1234), sampler1.get_sample(1234))
+    np.testing.assert_array_equal(sampler2.sample(galsim.BaseDeviate(1234), size=10),
+                                  sampler1.sample(galsim.BaseDeviate(1234), size=10))
+
+    # With nproc > 1, the sampler is built once in the main process and shared.
+    config = {
+        'modules' : [ 'galsim_extra' ],
+        'gal' : { 'type' : 'Exponential',
+                  'half_light_radius' : { 'type' : 'CosmosR50' },
+                  'flux' : { 'type' : 'CosmosFlux' } },
+        'psf' : { 'type' : 'Gaussian', 'fwhm' : 0.7 },
+        'image' : { 'type' : 'Scattered', 'size' : 64, 'nobjects' : 20,
+                    'pixel_scale' : 0.26, 'random_seed' : 1234 },
+        'input' : { 'cosmos_sampler' : params },
+        'output' : { 'nfiles' : 3,
+                     'file_name' : '$"output/cosmos_share_%d.fits"%file_num',
+                     'truth' : { 'file_name' : '$"output/cosmos_share_truth_%d.dat"%file_num',
+                                 'columns' : { 'hlr' : 'gal.half_light_radius',
+                                               'flux' : 'gal.flux' } } },
+    }
+    galsim.config.Process(galsim.config.CopyConfig(config))
+    truth1 = [ np.loadtxt('output/cosmos_share_truth_%d.dat'%i) for i in range(3) ]
+    config['output']['nproc'] = 2
+    config2 = galsim.config.Process(galsim.config.CopyConfig(config))
+    truth2 = [ np.loadtxt('output/cosmos_share_truth_%d.dat'%i) for i in range(3) ]
+    np.testing.assert_array_equal(truth1, truth2)
+    sampler = config2['input']['cosmos_sampler']['current'][0]
+    assert isinstance(sampler, CosmosSampler)
+    assert sampler._share_key is not None
+
+
+def test_truncate():
+    """Check that truncate draws the same distribution as rejecting the draws out of range.
+    """
+    from galsim_extra.cosmos_sampler import CosmosSampler
+    for params in [ BASE_CONFIG['input']['cosmos_sampler'],
+                    { 'min_r50' : 0.8, 'max_r50' : 0.9, 'min_flux' : 30, 'max_flux' : 40 } ]:
+        sampler1 = CosmosSampler(**params)
+        sampler2 = CosmosSampler(truncate=True, **params)
+        assert sampler1.acceptance_rate is None
+
+        # The acceptance rate is the fraction of the untruncated KDE within the ranges.
+        r = sampler1.resample(1000000, np.random.RandomState(1234)).T
+        accept = np.mean((r[:,0] > params['min_r50']) & (r[:,0] < params['max_r50']) &
+                         (r[:,1] > params['min_flux']) & (r[:,1] < params['max_flux']))
+        print('acceptance rate = ',sampler2.acceptance_rate, accept)
+        np.testing.assert_allclose(sampler2.acceptance_rate, accept, rtol=0.05)
+
+        data1 = sampler1.sample(galsim.BaseDeviate(1234), size=50000)
+        data2 = sampler2.sample(galsim.BaseDeviate(1234), size=50000)
+        assert np.all((data2[:,0] > params['min_r50']) & (data2[:,0] < params['max_r50']) &
+                      (data2[:,1] > params['min_flux']) & (data2[:,1] < params['max_flux']))
+        np.testing.assert_allclose(np.mean(data2, axis=0), np.mean(data1, axis=0), rtol=0.02)
+        np.testing.assert_allclose(np.std(data2, axis=0), np.std(data1, axis=0), rtol=0.05)
+
+        # sample_block and single values also use it.
+        data3 = sampler2.sample_block(1234, 50000)
+        np.testing.assert_allclose(np.mean(data3, axis=0), np.mean(data1, axis=0), rtol=0.02)
+        r50, flux = sampler2.sample(galsim.BaseDeviate(1234))
+        assert params['min_r50'] < r50 < params['max_r50']
+
+    with np.testing.assert_raises(galsim.GalSimValueError):
+        CosmosSampler(min_r50=3, max_r50=4, truncate=True)
+
+
+def test_grid():
+    """Check that engine = grid draws nearly the same distribution as the KDE.
+    """
+    from galsim_extra.cosmos_sampler import CosmosSampler, BenchmarkGrid
+    params = BASE_CONFIG['input']['cosmos_sampler']
+    results = BenchmarkGrid(nsample=200000, **params)
+    print('grid benchmark: ',results)
+    np.testing.assert_array_less(np.abs(results['mean_error']), 0.01)
+    np.testing.assert_array_less(np.abs(results['std_error']), 0.02)
+    assert abs(results['corr_error']) < 0.02
+    assert results['ks_r50'] < 0.01
+    assert results['ks_flux'] < 0.01
+
+    # The accuracy gets worse for a coarse grid.
+    results8 = BenchmarkGrid(nsample=200000, grid_size=8, **params)
+    print('grid_size = 8: ',results8)
+    assert results8['ks_r50'] > 2 * results['ks_r50']
+
+    sampler = CosmosSampler(engine='grid', **params)
+    assert 0 < sampler.acceptance_rate < 1
+    data = sampler.sample(galsim.BaseDeviate(1234), size=10000)
+    assert np.all((data[:,0] > 0.15) & (data[:,0] < 1.) &
+                  (data[:,1] > 2.5) & (data[:,1] < 100))
+    r50, flux = sampler.sample(galsim.BaseDeviate(1234))
+    assert 0.15 < r50 < 1.
+
+    with np.testing.assert_raises(galsim.GalSimValueError):
+        CosmosSampler(engine='invalid')
+    with np.testing.assert_raises(galsim.GalSimRangeError):
+        CosmosSampler(engine='grid', grid_size=1)
+
+
 if __name__ == "__main__":
     test_nproc()
     test_truth()
-
+    test_block_size()
+    test_cache_dir()
+    test_share()
+    test_truncate()
+    test_grid()
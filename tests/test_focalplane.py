@@ -3,6 +3,8 @@ import galsim
 import logging
 import numpy as np
 import os, sys
+import fitsio
+import galsim_extra
 
 def test_truth():
     """This test addressed Issue 10, where Niall found that the truth catalog wasn't being
@@ -68,5 +70,581 @@ def test_truth():
         # Note, shear_g2 is always 0, so don't include that one.
         assert not np.all(exp_data_list[0][0][key][:n] == exp_data_list[1][0][key][:n])
 
+def test_exposure_seed_mode():
+    """Check that output.seed_mode = exposure gives the same exp_num values on every chip.
+    """
+    config = galsim.config.ReadConfig('focal_quick.yaml')[0]
+    logger = logging.getLogger('test_exposure_seed_mode')
+    logger.addHandler(logging.StreamHandler(sys.stdout))
+    if __name__ == '__main__':
+        logger.setLevel(logging.DEBUG)
+
+    del config['image']['sky_level']
+    del config['image']['noise']
+    config['image']['wcs']['ra'] = '19.3 hours'
+    config['image']['wcs']['dec'] = '-33.1 degrees'
+    config['output']['seed_mode'] = 'exposure'
+    config['output']['truth']['file_name']['format'] = "expseed_truth_%s_%02d.dat"
+    galsim.config.Process(config, logger=logger, except_abort=True)
+
+    for exp in range(2):
+        truth_files = [ 'expseed_truth_DECam_exp%d_%02d.dat'%(exp+1,chip+1) for chip in range(2) ]
+        data_list = [ np.genfromtxt(os.path.join('output',truth_file), names=True, dtype=None,
+                                    encoding='ascii')
+                      for truth_file in truth_files ]
+        # The power spectrum is the same for all chips in an exposure, so the PSF shape from
+        # the PowerSpectrumShear should match too.
+        np.testing.assert_equal(data_list[0]['psf_e1'], data_list[1]['psf_e1'])
+        np.testing.assert_equal(data_list[0]['psf_e2'], data_list[1]['psf_e2'])
+
+        # But the PSF size is not the same, since fwhm_central is drawn for each file.
+        assert not np.any(data_list[0]['psf_fwhm'] == data_list[1]['psf_fwhm'])
+
+def test_scene_cache():
+    """Check that using output.scene_cache gives identical results to the normal processing.
+    """
+    config = galsim.config.ReadConfig('focal_quick.yaml')[0]
+    logger = logging.getLogger('test_scene_cache')
+    logger.addHandler(logging.StreamHandler(sys.stdout))
+    if __name__ == '__main__':
+        logger.setLevel(logging.DEBUG)
+
+    config['image']['nobjects']['mean'] = 40
+    del config['image']['sky_level']  # These are the slowest bits, so remove them to
+    del config['image']['noise']      # speed up the test.
+    config['output']['file_name']['format'] = "scene1_%s_%02d.fits.fz"
+    config['output']['truth']['file_name']['format'] = "scene_truth1_%s_%02d.dat"
+
+    config1 = galsim.config.CopyConfig(config)
+    galsim.config.Process(config1, logger=logger, except_abort=True)
+
+    config['output']['scene_cache'] = True
+    config['output']['file_name']['format'] = "scene2_%s_%02d.fits.fz"
+    config['output']['truth']['file_name']['format'] = "scene_truth2_%s_%02d.dat"
+    galsim.config.Process(config, logger=logger, except_abort=True)
+
+    for exp in range(2):
+        for chip in range(2):
+            tag = 'DECam_exp%d_%02d'%(exp+1,chip+1)
+            im1 = galsim.fits.read(os.path.join('output','scene1_%s.fits.fz'%tag))
+            im2 = galsim.fits.read(os.path.join('output','scene2_%s.fits.fz'%tag))
+            np.testing.assert_array_equal(im1.array, im2.array)
+            cat1 = galsim.Catalog(os.path.join('output','scene_truth1_%s.dat'%tag))
+            cat2 = galsim.Catalog(os.path.join('output','scene_truth2_%s.dat'%tag))
+            assert cat1.nobjects == cat2.nobjects
+            np.testing.assert_array_equal(cat1.data, cat2.data)
+
+def test_scene_cache_quick_skip():
+    """Check that output.scene_cache keeps a quick_skip set by the user.
+    """
+    config = galsim.config.ReadConfig('focal_quick.yaml')[0]
+    logger = logging.getLogger('test_scene_cache_quick_skip')
+    logger.addHandler(logging.StreamHandler(sys.stdout))
+    if __name__ == '__main__':
+        logger.setLevel(logging.DEBUG)
+
+    config['image']['nobjects']['mean'] = 40
+    del config['image']['sky_level']
+    del config['image']['noise']
+    config['stamp']['quick_skip'] = '$obj_num % 3 == 0'
+    config['output']['file_name']['format'] = "skip1_%s_%02d.fits.fz"
+    config['output']['truth']['file_name']['format'] = "skip_truth1_%s_%02d.dat"
+
+    config1 = galsim.config.CopyConfig(config)
+    galsim.config.Process(config1, logger=logger, except_abort=True)
+
+    config['output']['scene_cache'] = True
+    config['output']['file_name']['format'] = "skip2_%s_%02d.fits.fz"
+    config['output']['truth']['file_name']['format'] = "skip_truth2_%s_%02d.dat"
+    galsim.config.Process(config, logger=logger, except_abort=True)
+
+    for exp in range(2):
+        for chip in range(2):
+            tag = 'DECam_exp%d_%02d'%(exp+1,chip+1)
+            im1 = galsim.fits.read(os.path.join('output','skip1_%s.fits.fz'%tag))
+            im2 = galsim.fits.read(os.path.join('output','skip2_%s.fits.fz'%tag))
+            np.testing.assert_array_equal(im1.array, im2.array)
+            cat1 = galsim.Catalog(os.path.join('output','skip_truth1_%s.dat'%tag))
+            cat2 = galsim.Catalog(os.path.join('output','skip_truth2_%s.dat'%tag))
+            assert cat1.nobjects == cat2.nobjects
+            np.testing.assert_array_equal(cat1.data, cat2.data)
+            num = np.array([cat2.getInt(i, 0) for i in range(cat2.nobjects)])
+            assert np.all(num % 3 != 0)
+
+def test_process_focal_plane():
+    """Check that ProcessFocalPlane gives identical results to the normal processing.
+    """
+    logger = logging.getLogger('test_process_focal_plane')
+    logger.addHandler(logging.StreamHandler(sys.stdout))
+    if __name__ == '__main__':
+        logger.setLevel(logging.DEBUG)
+
+    def read_config(tag):
+        # CopyConfig shares the custom fields like nearby_gal between copies, so read the
+        # config fresh for each run to keep the two runs independent.
+        config = galsim.config.ReadConfig('focal_quick.yaml')[0]
+        del config['image']['sky_level']
+        del config['image']['noise']
+        config['output']['file_name']['format'] = "pool%s_%%s_%%02d.fits.fz"%tag
+        config['output']['truth']['file_name']['format'] = "pool_truth%s_%%s_%%02d.dat"%tag
+        return config
+
+    # ProcessFocalPlane uses seed_mode = exposure by default, so use that here too.
+    config1 = read_config('1')
+    config1['output']['seed_mode'] = 'exposure'
+    galsim.config.Process(config1, logger=logger, except_abort=True)
+
+    config = read_config('2')
+    config['output']['nproc'] = 2
+    config['output']['scene_cache'] = True
+    galsim_extra.focal_plane_process.ProcessFocalPlane(config, logger=logger, except_abort=True)
+
+    for exp in range(2):
+        for chip in range(2):
+            tag = 'DECam_exp%d_%02d'%(exp+1,chip+1)
+            im1 = galsim.fits.read(os.path.join('output','pool1_%s.fits.fz'%tag))
+            im2 = galsim.fits.read(os.path.join('output','pool2_%s.fits.fz'%tag))
+            np.testing.assert_array_equal(im1.array, im2.array)
+            cat1 = galsim.Catalog(os.path.join('output','pool_truth1_%s.dat'%tag))
+            cat2 = galsim.Catalog(os.path.join('output','pool_truth2_%s.dat'%tag))
+            np.testing.assert_array_equal(cat1.data, cat2.data)
+
+def test_chip_geometry_cache():
+    """Check the LRU behavior of the ChipGeometryCache.
+    """
+    from galsim_extra.chip_geometry import ChipGeometry, ChipGeometryCache
+    cache = ChipGeometryCache(2)
+    geoms = []
+    for chip_num in range(3):
+        wcs = galsim.TanWCS(galsim.AffineTransform(0.26, 0, 0, 0.26),
+                            galsim.CelestialCoord(chip_num * galsim.arcmin, 0 * galsim.degrees))
+        geoms.append(ChipGeometry(wcs, 2048, 4096))
+    assert len(geoms[0].corners) == 4
+    np.testing.assert_almost_equal(geoms[0].corners[3].distanceTo(geoms[0].corners[0]).deg,
+                                   (2048**2 + 4096**2)**0.5 * 0.26 / 3600, decimal=5)
+
+    cache.put((0,0), geoms[0])
+    cache.put((0,1), geoms[1])
+    assert cache.get((0,0)) is geoms[0]
+    # Now (0,1) is the least recently used, so it should be the one that gets removed.
+    cache.put((0,2), geoms[2])
+    assert len(cache) == 2
+    assert (0,1) not in cache
+    assert cache.get((0,0)) is geoms[0]
+    assert cache.get((0,2)) is geoms[2]
+    assert cache.get((0,1)) is None
+
+def test_chip_geometry_key():
+    """Check that the chip geometry cache is keyed on the wcs file name when there is one.
+    """
+    logger = logging.getLogger('test_chip_geometry_key')
+    logger.addHandler(logging.StreamHandler(sys.stdout))
+    if __name__ == '__main__':
+        logger.setLevel(logging.DEBUG)
+
+    # Both exposures read the same wcs files, one per chip.
+    for chip in range(2):
+        world_origin = galsim.CelestialCoord(19.3 * galsim.hours + chip * 10.8 * galsim.arcmin,
+                                             -33.1 * galsim.degrees)
+        wcs = galsim.TanWCS(galsim.AffineTransform(0.26, 0, 0, 0.26), world_origin)
+        galsim.Image(16, 16, wcs=wcs).write(os.path.join('output', 'wcs_chip%02d.fits'%(chip+1)))
+
+    config = galsim.config.ReadConfig('focal_quick.yaml')[0]
+    del config['image']['sky_level']
+    del config['image']['noise']
+    del config['output']['truth']
+    config['image']['wcs'] = {
+        'type' : 'Fits',
+        'dir' : 'output',
+        'file_name' : '$"wcs_chip%02d.fits"%(chip_num+1)',
+    }
+    config['output']['file_name']['format'] = "wcskey_%s_%02d.fits.fz"
+    # Process works on copies of the config, which share the cache if it is already there.
+    cache = galsim_extra.chip_geometry.ChipGeometryCache(4)
+    config['_focalplane_wcs_cache'] = cache
+    galsim.config.Process(config, logger=logger, except_abort=True)
+
+    # Both exposures used the same two geometries.
+    assert len(cache) == 2
+    assert ('output', 'wcs_chip01.fits', 0) in cache
+    assert ('output', 'wcs_chip02.fits', 1) in cache
+    for exp in range(2):
+        for chip in range(2):
+            tag = 'DECam_exp%d_%02d'%(exp+1,chip+1)
+            im = galsim.fits.read(os.path.join('output','wcskey_%s.fits.fz'%tag))
+            assert im.wcs.toWorld(galsim.PositionD(1,1)) == \
+                    cache.get(('output', 'wcs_chip%02d.fits'%(chip+1), chip)).wcs.toWorld(
+                            galsim.PositionD(1,1))
+
+def test_focal_plane_geometry():
+    """Check the vectorized FocalPlaneGeometry against doing the calculation one corner at a time.
+    """
+    from galsim_extra.chip_geometry import ChipGeometry, FocalPlaneGeometry
+    # A 2x3 grid of chips near ra=0, so the ra wrapping matters.
+    center = galsim.CelestialCoord(359.9 * galsim.degrees, -60 * galsim.degrees)
+    chips = []
+    for i in range(2):
+        for j in range(3):
+            world_origin = center.deproject((i-1) * 0.3 * galsim.degrees,
+                                            (j-1.5) * 0.6 * galsim.degrees)
+            wcs = galsim.TanWCS(galsim.AffineTransform(0.26, 0, 0, 0.26), world_origin)
+            chips.append(ChipGeometry(wcs, 2048, 4096))
+    geom = FocalPlaneGeometry(chips)
+
+    corners = [ c for chip in chips for c in chip.corners ]
+    xyz = np.array([ c.get_xyz() for c in corners ])
+    pointing = galsim.CelestialCoord.from_xyz(*np.mean(xyz, axis=0))
+    np.testing.assert_almost_equal(geom.pointing.ra.rad, pointing.ra.rad, decimal=12)
+    np.testing.assert_almost_equal(geom.pointing.dec.rad, pointing.dec.rad, decimal=12)
+
+    ra = [ c.ra.wrap(pointing.ra) / galsim.degrees for c in corners ]
+    dec = [ c.dec / galsim.degrees for c in corners ]
+    np.testing.assert_almost_equal(geom.fov_minra, np.min(ra), decimal=10)
+    np.testing.assert_almost_equal(geom.fov_maxra, np.max(ra), decimal=10)
+    np.testing.assert_almost_equal(geom.fov_mindec, np.min(dec), decimal=10)
+    np.testing.assert_almost_equal(geom.fov_maxdec, np.max(dec), decimal=10)
+
+    proj = [ pointing.project(c, projection='gnomonic') for c in corners ]
+    u = np.array([ p[0] / galsim.arcsec for p in proj ])
+    v = np.array([ p[1] / galsim.arcsec for p in proj ])
+    np.testing.assert_almost_equal(geom.bounds.xmin, np.min(u), decimal=6)
+    np.testing.assert_almost_equal(geom.bounds.xmax, np.max(u), decimal=6)
+    np.testing.assert_almost_equal(geom.bounds.ymin, np.min(v), decimal=6)
+    np.testing.assert_almost_equal(geom.bounds.ymax, np.max(v), decimal=6)
+    np.testing.assert_almost_equal(geom.rmax, np.max(u**2 + v**2)**0.5, decimal=6)
+    np.testing.assert_almost_equal(geom.chip_bounds[:,0], u.reshape(6,4).min(axis=1), decimal=6)
+    np.testing.assert_almost_equal(geom.chip_bounds[:,3], v.reshape(6,4).max(axis=1), decimal=6)
+
+    np.testing.assert_almost_equal(geom.focal_r(corners[5]), (u[5]**2 + v[5]**2)**0.5, decimal=6)
+    pos = geom.focal_pos(corners[5])
+    np.testing.assert_almost_equal((pos.x, pos.y), (u[5], v[5]), decimal=6)
+
+    # Sampling more points along the edges can only make the bounds larger.  (Here, the edges are
+    # straight lines in the tangent plane, so they should be the same up to rounding errors.)
+    chips2 = [ ChipGeometry(c.wcs, c.xsize, c.ysize, edge_samples=20) for c in chips ]
+    geom2 = FocalPlaneGeometry(chips2)
+    assert geom2.pointing == geom.pointing
+    assert geom2.bounds.includes(geom.bounds)
+    np.testing.assert_array_less(geom2.chip_bounds[:,0], geom.chip_bounds[:,0] + 1.e-8)
+    np.testing.assert_array_less(geom.chip_bounds[:,1], geom2.chip_bounds[:,1] + 1.e-8)
+
+def test_find_chip():
+    """Check FocalPlaneGeometry.find_chip against checking each chip's wcs directly.
+    """
+    from galsim_extra.chip_geometry import ChipGeometry, FocalPlaneGeometry
+    # A 3x3 grid of rotated chips with gaps between them.
+    center = galsim.CelestialCoord(359.9 * galsim.degrees, -60 * galsim.degrees)
+    chips = []
+    for i in range(3):
+        for j in range(3):
+            world_origin = center.deproject((i-1) * 0.16 * galsim.degrees,
+                                            (j-1) * 0.3 * galsim.degrees)
+            theta = (5 * (i+j)) * galsim.degrees
+            s, c = theta.sincos()
+            jac = galsim.AffineTransform(0.26*c, -0.26*s, 0.26*s, 0.26*c,
+                                         galsim.PositionD(1024,2048))
+            wcs = galsim.TanWCS(jac, world_origin)
+            chips.append(ChipGeometry(wcs, 2048, 4096))
+    geom = FocalPlaneGeometry(chips)
+    assert len(geom.chip_polygons) == 9
+    assert geom.chip_polygons[0].shape == (4, 2)
+
+    # Random positions covering the whole focal plane, plus some more beyond the edges.
+    ud = galsim.UniformDeviate(1234)
+    n = 20000
+    u = np.empty(n)
+    v = np.empty(n)
+    ud.generate(u)
+    ud.generate(v)
+    b = geom.bounds
+    u = b.xmin - 100 + u * (b.xmax - b.xmin + 200)
+    v = b.ymin - 100 + v * (b.ymax - b.ymin + 200)
+    ra, dec = geom.pointing.deproject_rad(u * galsim.arcsec.value, v * galsim.arcsec.value,
+                                          projection='gnomonic')
+    chip_num = geom.find_chip_radec(ra, dec)
+
+    # Some of the chips overlap a bit.  find_chip should give the first one in that case.
+    on_chip = np.zeros((9, n), dtype=bool)
+    for k, chip in enumerate(chips):
+        x, y = chip.wcs.toImage(ra, dec, units=galsim.radians)
+        on_chip[k] = (x > 0) & (x < 2048) & (y > 0) & (y < 4096)
+    assert np.any(np.sum(on_chip, axis=0) > 1)
+    expected = np.where(np.any(on_chip, axis=0), np.argmax(on_chip, axis=0), -1)
+    assert 0.3 < np.mean(expected >= 0) < 0.9
+    # Positions within a tiny fraction of a pixel of an edge might reasonably go either way.
+    assert np.sum(chip_num != expected) <= 2
+    np.testing.assert_array_equal(geom.find_chip(u, v), chip_num)
+
+    # The scalar version for use in Eval items.
+    k = np.where(expected == 4)[0][0]
+    pos = galsim.CelestialCoord(ra[k] * galsim.radians, dec[k] * galsim.radians)
+    assert geom.chip_num(pos) == 4
+    assert geom.chip_num(center.deproject(10 * galsim.degrees, 0 * galsim.degrees)) == -1
+
+    # More samples along the edges gives the same answer for these straight-edged chips.
+    chips2 = [ ChipGeometry(c.wcs, c.xsize, c.ysize, edge_samples=5) for c in chips ]
+    geom2 = FocalPlaneGeometry(chips2)
+    assert geom2.chip_polygons[0].shape == (16, 2)
+    assert np.sum(geom2.find_chip_radec(ra, dec) != expected) <= 2
+
+def test_manifest():
+    """Check that output.manifest lets a run skip the chips that are already done.
+    """
+    logger = logging.getLogger('test_manifest')
+    logger.addHandler(logging.StreamHandler(sys.stdout))
+    if __name__ == '__main__':
+        logger.setLevel(logging.DEBUG)
+
+    def read_config():
+        # Each run should start from the config as read from the file, as it would be when
+        # rerunning an interrupted job.
+        config = galsim.config.ReadConfig('focal_quick.yaml')[0]
+        del config['image']['sky_level']
+        del config['image']['noise']
+        config['output']['file_name']['format'] = "manifest_%s_%02d.fits.fz"
+        config['output']['truth']['file_name']['format'] = "manifest_truth_%s_%02d.dat"
+        config['output']['manifest'] = 'manifest.txt'
+        # Rebuilding a single chip only matches the full run when the exp_num rng doesn't
+        # depend on the chips that were built before it.
+        config['output']['seed_mode'] = 'exposure'
+        return config
+
+    manifest_file = os.path.join('output','manifest.txt')
+    if os.path.exists(manifest_file):
+        os.remove(manifest_file)
+
+    galsim.config.Process(read_config(), logger=logger, except_abort=True)
+    with open(manifest_file) as fin:
+        assert len(fin.readlines()) == 4
+
+    # Pretend the run was interrupted before finishing the first chip of the second exposure.
+    file_names = [ os.path.join('output', 'manifest_DECam_exp%d_%02d.fits.fz'%(exp+1,chip+1))
+                   for exp in range(2) for chip in range(2) ]
+    im2 = galsim.fits.read(file_names[2])
+    os.remove(file_names[2])
+    mtimes = [ os.path.getmtime(f) for f in file_names if os.path.exists(f) ]
+
+    galsim.config.Process(read_config(), logger=logger, except_abort=True)
+    with open(manifest_file) as fin:
+        assert len(fin.readlines()) == 5
+    # The missing chip is rebuilt exactly as before, and the others are not touched.
+    np.testing.assert_array_equal(galsim.fits.read(file_names[2]).array, im2.array)
+    assert mtimes == [ os.path.getmtime(f) for k,f in enumerate(file_names) if k != 2 ]
+
+    # ProcessFocalPlane also respects the manifest.
+    galsim_extra.focal_plane_process.ProcessFocalPlane(read_config(), logger=logger,
+                                                       except_abort=True)
+    with open(manifest_file) as fin:
+        assert len(fin.readlines()) == 5
+
+    # A chip whose file was changed, but still has the same size, is rebuilt.
+    im0 = galsim.fits.read(file_names[0])
+    with open(file_names[0], 'r+b') as f:
+        f.seek(-100, os.SEEK_END)
+        b = f.read(1)
+        f.seek(-100, os.SEEK_END)
+        f.write(bytes([b[0] ^ 0xff]))
+    galsim.config.Process(read_config(), logger=logger, except_abort=True)
+    with open(manifest_file) as fin:
+        assert len(fin.readlines()) == 6
+    np.testing.assert_array_equal(galsim.fits.read(file_names[0]).array, im0.array)
+
+    # Objects without a proper repr don't change the hash from one run to the next.
+    from galsim_extra.focal_plane_manifest import ConfigHash
+    config1 = read_config()
+    config2 = read_config()
+    config1['image']['extra'] = object()
+    config2['image']['extra'] = object()
+    assert ConfigHash(config1) == ConfigHash(config2)
+
+    # A different config hash means nothing in the manifest counts as done.
+    config = read_config()
+    config['image']['xsize'] = 2000
+    galsim.config.Process(config, logger=logger, except_abort=True)
+    with open(manifest_file) as fin:
+        assert len(fin.readlines()) == 10
+
+def test_counter_seed():
+    """Check that output.seed_mode = counter lets a single chip be built on its own.
+    """
+    logger = logging.getLogger('test_counter_seed')
+    logger.addHandler(logging.StreamHandler(sys.stdout))
+    if __name__ == '__main__':
+        logger.setLevel(logging.DEBUG)
+
+    def read_config(prefix):
+        config = galsim.config.ReadConfig('focal_quick.yaml')[0]
+        del config['image']['sky_level']
+        # Put all the chips on top of each other, so they have the same objects.
+        config['image']['wcs']['ra'] = '19.3 hours'
+        config['output']['seed_mode'] = 'counter'
+        config['output']['file_name']['format'] = prefix + "_%s_%02d.fits.fz"
+        config['output']['truth']['file_name']['format'] = prefix + "_truth_%s_%02d.dat"
+        return config
+
+    # The seeds are reproducible and don't depend on each other.
+    seed = galsim_extra.counter_seed.CounterSeed
+    assert seed(1234, 0, 3, 7) == seed(1234, 0, 3, 7)
+    seeds = [ seed(1234, stream, exp_num, k) for stream in range(3) for exp_num in range(10)
+              for k in range(100) ]
+    assert len(set(seeds)) == len(seeds)
+
+    # All chips in an exposure see the same objects.
+    galsim.config.Process(read_config('counter1'), logger=logger, except_abort=True)
+    for exp in range(2):
+        tag = 'DECam_exp%d'%(exp+1)
+        cat1 = galsim.Catalog(os.path.join('output','counter1_truth_%s_01.dat'%tag))
+        cat2 = galsim.Catalog(os.path.join('output','counter1_truth_%s_02.dat'%tag))
+        assert cat1.nobjects == cat2.nobjects
+        np.testing.assert_array_equal(cat1.data[:,1:5], cat2.data[:,1:5])
+
+    # Build just the last chip, without building (or counting the objects in) any of the
+    # others.  Everything should be the same except the obj_num values.
+    config = read_config('counter2')
+    galsim.config.ImportModules(config)
+    galsim.config.ProcessAllTemplates(config, logger)
+    galsim.config.BuildFile(config, file_num=3, image_num=0, obj_num=0, logger=logger)
+    tag = 'DECam_exp2_02'
+    im1 = galsim.fits.read(os.path.join('output','counter1_%s.fits.fz'%tag))
+    im2 = galsim.fits.read(os.path.join('output','counter2_%s.fits.fz'%tag))
+    np.testing.assert_array_equal(im1.array, im2.array)
+    cat1 = galsim.Catalog(os.path.join('output','counter1_truth_%s.dat'%tag))
+    cat2 = galsim.Catalog(os.path.join('output','counter2_truth_%s.dat'%tag))
+    np.testing.assert_array_equal(cat1.data[:,1:], cat2.data[:,1:])
+    assert not np.all(cat1.data[:,0] == cat2.data[:,0])
+
+    config = read_config('counter3')
+    config['output']['seed_mode'] = 'invalid'
+    with np.testing.assert_raises(galsim.GalSimConfigValueError):
+        galsim.config.Process(config, logger=logger)
+
+def test_exposure_truth():
+    """Check that output.exposure_truth writes one truth catalog per exposure.
+    """
+    logger = logging.getLogger('test_exposure_truth')
+    logger.addHandler(logging.StreamHandler(sys.stdout))
+    if __name__ == '__main__':
+        logger.setLevel(logging.DEBUG)
+
+    config = galsim.config.ReadConfig('focal_quick.yaml')[0]
+    del config['image']['sky_level']
+    del config['image']['noise']
+    config['output']['file_name']['format'] = "exptruth_%s_%02d.fits.fz"
+    config['output']['truth']['file_name']['format'] = "exptruth_truth_%s_%02d.dat"
+    columns = ['num', 'x', 'y', 'ra', 'dec', 'obj_type', 'flux']
+    config['output']['exposure_truth'] = {
+        'file_name' : {
+            'type' : 'FormattedStr',
+            'format' : "exptruth_%s.fits",
+            'items' : [ { 'type' : 'Catalog', 'col' : 1, 'index_key' : 'exp_num' } ],
+        },
+        'columns' : { key : config['output']['truth']['columns'][key] for key in columns },
+    }
+    for exp in range(2):
+        file_name = os.path.join('output', 'exptruth_DECam_exp%d.fits'%(exp+1))
+        if os.path.exists(file_name):
+            os.remove(file_name)
+
+    def check():
+        for exp in range(2):
+            file_name = os.path.join('output', 'exptruth_DECam_exp%d.fits'%(exp+1))
+            data = fitsio.read(file_name)
+            assert data.dtype.names == tuple(['chip_num'] + columns)
+            ntot = 0
+            for chip in range(2):
+                cat = galsim.Catalog(os.path.join(
+                        'output', 'exptruth_truth_DECam_exp%d_%02d.dat'%(exp+1,chip+1)))
+                chip_data = data[data['chip_num'] == chip]
+                assert len(chip_data) == cat.nobjects
+                np.testing.assert_array_equal(chip_data['num'], cat.data[:,0].astype(int))
+                np.testing.assert_allclose(chip_data['x'], cat.data[:,1].astype(float))
+                np.testing.assert_array_equal(chip_data['obj_type'].astype(str), cat.data[:,8])
+                ntot += cat.nobjects
+            assert len(data) == ntot
+            # The lock file is removed when each update is done.
+            assert not os.path.exists(file_name + '.lock')
+
+    galsim.config.Process(galsim.config.CopyConfig(config), logger=logger, except_abort=True)
+    check()
+
+    # Rerunning replaces the rows for each chip rather than adding more.
+    # Also check that it works when the chips are built by different processes.
+    config['output']['nproc'] = 2
+    galsim_extra.focal_plane_process.ProcessFocalPlane(config, logger=logger, except_abort=True)
+    check()
+
+    # A later chip can have longer strings than the ones already in the file.
+    from galsim_extra.exposure_truth import AddChipTables, MakeChipTable
+    file_name = os.path.join('output', 'exptruth_strlen.fits')
+    if os.path.exists(file_name):
+        os.remove(file_name)
+    for chip_num, obj_type in enumerate(['star', 'faint_gal', 'bright_gal']):
+        data = np.array([ (chip_num, obj_type) ],
+                        dtype=[ ('num', int), ('obj_type', 'U%d'%len(obj_type)) ])
+        AddChipTables(file_name, { chip_num : MakeChipTable(data, chip_num) })
+    data = fitsio.read(file_name)
+    np.testing.assert_array_equal(data['obj_type'].astype(str), ['star', 'faint_gal', 'bright_gal'])
+
+def test_exposure_truth_empty_chip():
+    """Check that output.exposure_truth works when the first chip has no objects.
+    """
+    logger = logging.getLogger('test_exposure_truth_empty_chip')
+    logger.addHandler(logging.StreamHandler(sys.stdout))
+    if __name__ == '__main__':
+        logger.setLevel(logging.DEBUG)
+
+    config = galsim.config.ReadConfig('focal_quick.yaml')[0]
+    del config['image']['sky_level']
+    del config['image']['noise']
+    del config['output']['truth']
+    config['output']['file_name']['format'] = "exptruth_empty_%s_%02d.fits.fz"
+    config['stamp']['skip'] = '$chip_num == 0'
+    config['output']['exposure_truth'] = {
+        'file_name' : {
+            'type' : 'FormattedStr',
+            'format' : "exptruth_empty_%s.fits",
+            'items' : [ { 'type' : 'Catalog', 'col' : 1, 'index_key' : 'exp_num' } ],
+        },
+        'columns' : { 'num' : 'obj_num', 'x' : '$image_pos.x', 'name' : '$"gal%d"%obj_num' },
+    }
+
+    def check():
+        for exp in range(2):
+            file_name = os.path.join('output', 'exptruth_empty_DECam_exp%d.fits'%(exp+1))
+            data = fitsio.read(file_name)
+            assert data.dtype.names == ('chip_num', 'num', 'x', 'name')
+            assert data.dtype['num'].kind == 'i'
+            assert data.dtype['name'].kind in 'SU'
+            assert len(data) > 0
+            assert np.all(data['chip_num'] == 1)
+            np.testing.assert_array_equal(data['name'].astype(str),
+                                          [ 'gal%d'%n for n in data['num'] ])
+
+    for exp in range(2):
+        file_name = os.path.join('output', 'exptruth_empty_DECam_exp%d.fits'%(exp+1))
+        if os.path.exists(file_name):
+            os.remove(file_name)
+    galsim.config.Process(galsim.config.CopyConfig(config), logger=logger, except_abort=True)
+    check()
+
+    for exp in range(2):
+        file_name = os.path.join('output', 'exptruth_empty_DECam_exp%d.fits'%(exp+1))
+        os.remove(file_name)
+    config['output']['nproc'] = 2
+    galsim_extra.focal_plane_process.ProcessFocalPlane(config, logger=logger, except_abort=True)
+    check()
+
 if __name__ == '__main__':
     test_truth()
+    test_exposure_seed_mode()
+    test_scene_cache()
+    test_scene_cache_quick_skip()
+    test_process_focal_plane()
+    test_chip_geometry_cache()
+    test_chip_geometry_key()
+    test_focal_plane_geometry()
+    test_find_chip()
+    test_manifest()
+    test_counter_seed()
+    test_exposure_truth()
+    test_exposure_truth_empty_chip()
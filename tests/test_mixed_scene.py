@@ -229,6 +229,246 @@ def test_mixed_scene_flat():
     assert np.isclose(sheared_pos.y, mom2.moments_centroid.y, atol=1.e-3)
 
 
+def test_obj_types():
+    # Check the selection of the object types.
+    from galsim_extra.mixed_scene import ObjTypeTable
+    from galsim_extra.counter_seed import HashUniform
+
+    objects = { 'star' : 0.2, 'bright_gal' : 0.05, 'faint_gal' : 0.7, 'nearby_gal' : 0.001 }
+    table = ObjTypeTable(objects)
+    norm = sum(objects.values())
+
+    # select looks up a single value in the same alias table as sample.
+    ud = galsim.UniformDeviate(1234)
+    u = np.empty(1000)
+    ud.generate(u)
+    np.testing.assert_array_equal([ table.select(x) for x in u ], table.sample(u))
+
+    # The alias table should sample the types with the right probabilities.
+    u = np.empty(1000000)
+    ud.generate(u)
+    counts = np.bincount(table.sample(u), minlength=4)
+    print('counts = ',counts)
+    for i, value in enumerate(objects.values()):
+        np.testing.assert_allclose(counts[i] / len(u), value / norm, atol=1.e-3)
+
+    # With batch_obj_types, the types of all the objects in the image are selected at once
+    # from a hash of each object's seed.
+    config = yaml.safe_load(CONFIG_FLAT)
+    config['stamp']['objects'] = { 'star' : 0.3, 'gal' : 0.7 }
+    config['stamp']['batch_obj_types'] = True
+    config['image']['nobjects'] = 50
+    config['image']['image_pos'] = {
+        'type' : 'XY',
+        'x' : { 'type' : 'Random', 'min' : 1, 'max' : 320 },
+        'y' : { 'type' : 'Random', 'min' : 1, 'max' : 320 },
+    }
+    config['output'] = {
+        'dir' : 'output',
+        'file_name' : 'batch_obj_types.fits',
+        'truth' : {
+            'file_name' : 'batch_obj_types_truth.dat',
+            'columns' : { 'num' : 'obj_num', 'obj_type' : '@current_obj_type' },
+        }
+    }
+    galsim.config.Process(config)
+    cat = galsim.Catalog('output/batch_obj_types_truth.dat')
+    # The object seeds are 1 more than the Sequence that random_seed turns into.
+    seeds = galsim.BaseDeviate(42).raw() + 1 + cat.data[:,0].astype(int)
+    table = ObjTypeTable(config['stamp']['objects'])
+    expected = np.array(table.keys)[table.sample(HashUniform(seeds))]
+    print('obj_types = ',cat.data[:,1])
+    np.testing.assert_array_equal(cat.data[:,1], expected)
+    assert 'star' in expected and 'gal' in expected
+
+
+def test_batch_seeds():
+    # Check that the seeds calculated for all the objects at once match parsing them one at
+    # a time.
+    from galsim_extra.batch_seed import BuildBatchSeeds
+
+    base = {
+        'image' : { 'nobjects' : 7 },
+        'obj_num' : 0,
+        'start_obj_num' : 30,
+        'exp_start_obj_num' : 16,
+        'exp_num' : 2,
+        'chip_num' : 2,
+        'image_num' : 4,
+        'index_key' : 'obj_num',
+    }
+    random_seed = [
+        { 'type' : 'Sequence', 'first' : 1234, 'index_key' : 'obj_num' },
+        { 'type' : 'Sequence', 'first' : 1234, 'step' : 3, 'repeat' : 2, 'nitems' : 5 },
+        { 'type' : 'Sequence', 'first' : 1234, 'index_key' : 'image_num' },
+        { 'type' : 'ExposureSeed', 'first' : 1234 },
+        { 'type' : 'ExposureSeed', 'first' : 1234, 'all_exposures' : True },
+        { 'type' : 'CounterSeed', 'first' : 1234, 'stream' : 1,
+          'keys' : [ 'exp_num', 'chip_num', 'obj_index' ] },
+        { 'type' : 'Eval', 'str' : '1234 + obj_num**2' },
+    ]
+    for i in range(len(random_seed)):
+        seeds = BuildBatchSeeds(random_seed, i, base, 30, 7)
+        expected = []
+        for k in range(7):
+            base['obj_num'] = 30 + k
+            expected.append(galsim.config.ParseValue(random_seed, i, base, int)[0])
+        print(random_seed[i]['type'], seeds, expected)
+        np.testing.assert_array_equal(seeds, expected)
+
+
+def test_psf_cache():
+    # Check that drawing stars from a cache of PSF images matches drawing them normally.
+    config = yaml.safe_load(CONFIG_FLAT)
+    config['stamp']['objects'] = { 'star' : 0.7, 'gal' : 0.3 }
+    config['stamp']['draw_method'] = 'auto'
+    config['star'] = { 'type' : 'DeltaFunction',
+                       'flux' : { 'type' : 'Random', 'min' : 1.e3, 'max' : 1.e5 } }
+    config['psf']['ellip'] = { 'type' : 'G1G2', 'g1' : 0.05, 'g2' : -0.03 }
+    config['image']['nobjects'] = 100
+    # First use positions at the pixel centers, so the offsets are all 0.
+    config['image']['image_pos'] = {
+        'type' : 'XY',
+        'x' : { 'type' : 'Eval', 'str' : 'int(xf)',
+                'fxf' : { 'type' : 'Random', 'min' : 10, 'max' : 310 } },
+        'y' : { 'type' : 'Eval', 'str' : 'int(yf)',
+                'fyf' : { 'type' : 'Random', 'min' : 10, 'max' : 310 } },
+    }
+    im1 = galsim.config.BuildImage(galsim.config.CopyConfig(config))
+
+    config2 = galsim.config.CopyConfig(config)
+    config2['stamp']['psf_cache'] = { 'obj_type' : 'star' }
+    im2 = galsim.config.BuildImage(config2)
+    cache = config2['stamp']['psf_cache']['_cache']
+    print('nhits = ',cache.nhits,'nmisses = ',cache.nmisses)
+    # The PSF is the same everywhere, so there is only one image.
+    assert cache.nmisses == 1
+    assert cache.nhits > 50
+    np.testing.assert_allclose(im2.array, im1.array, rtol=1.e-5, atol=1.e-5 * np.max(im1.array))
+
+    # Now random positions, with the PSF depending on position.  The offsets are rounded to
+    # offset_tol, so the images are only approximately the same.
+    config['image']['image_pos'] = {
+        'type' : 'XY',
+        'x' : { 'type' : 'Random', 'min' : 10, 'max' : 310 },
+        'y' : { 'type' : 'Random', 'min' : 10, 'max' : 310 },
+    }
+    config['psf']['fwhm'] = '$0.7 + 0.1 * int(image_pos.x / 160)'
+    im1 = galsim.config.BuildImage(galsim.config.CopyConfig(config))
+
+    config2 = galsim.config.CopyConfig(config)
+    config2['stamp']['psf_cache'] = {
+        'obj_type' : 'star', 'key' : [ '@psf.fwhm' ], 'offset_tol' : 0.2, 'max_size' : 20
+    }
+    im2 = galsim.config.BuildImage(config2)
+    cache = config2['stamp']['psf_cache']['_cache']
+    print('nhits = ',cache.nhits,'nmisses = ',cache.nmisses)
+    assert cache.nhits > 0
+    assert len(cache.images) <= 20
+    # Each star is moved by at most 0.1 pixels, so the total flux is the same, but the
+    # pixel values are a bit different.
+    np.testing.assert_allclose(im2.array.sum(), im1.array.sum(), rtol=1.e-4)
+    np.testing.assert_allclose(im2.array, im1.array, atol=0.2 * np.max(im1.array))
+    assert not np.allclose(im2.array, im1.array, atol=1.e-5 * np.max(im1.array))
+
+    # With draw_method = phot, the cache isn't used.
+    config2 = galsim.config.CopyConfig(config)
+    config2['stamp']['draw_method'] = 'phot'
+    config2['stamp']['psf_cache'] = { 'obj_type' : 'star', 'key' : [ '@psf.fwhm' ] }
+    galsim.config.BuildImage(config2)
+    assert '_cache' not in config2['stamp']['psf_cache']
+
+
+def test_psf_cache_focal_plane():
+    # With FocalPlane, the default psf_cache key is the cell of the focal plane.
+    config = galsim.config.ReadConfig('focal_quick.yaml')[0]
+    del config['image']['sky_level']
+    del config['image']['noise']
+    del config['output']['truth']
+    config['image']['nobjects'] = 300
+    config['stamp']['objects'] = { 'star' : 1. }
+    # The cache isn't used with phot, so draw the stars with fft.
+    config['stamp']['select_draw_method'] = { 'star' : { 'max_phot_flux' : 0 } }
+    config1 = galsim.config.CopyConfig(config)
+    config1['output']['file_name']['format'] = "psfcache1_%s_%02d.fits.fz"
+    galsim.config.BuildFile(config1, 0)
+
+    config2 = galsim.config.CopyConfig(config)
+    config2['output']['file_name']['format'] = "psfcache2_%s_%02d.fits.fz"
+    config2['stamp']['psf_cache'] = { 'obj_type' : 'star', 'cell_size' : 600, 'offset_tol' : 0.2 }
+    galsim.config.BuildFile(config2, 0)
+    cache = config2['stamp']['psf_cache']['_cache']
+    print('nhits = ',cache.nhits,'nmisses = ',cache.nmisses)
+    assert cache.nhits > 0
+    # The keys start with (exp_num, i, j) for the cell.
+    for key in cache.images:
+        assert key[0][0] == 0
+        assert len(key[0]) == 3
+
+    # The PSF varies a bit within each cell and the offsets are rounded, so the pixel values
+    # are a bit different, but the total flux is the same.
+    im1 = galsim.fits.read('output/psfcache1_DECam_exp1_01.fits.fz')
+    im2 = galsim.fits.read('output/psfcache2_DECam_exp1_01.fits.fz')
+    np.testing.assert_allclose(im2.array.sum(), im1.array.sum(), rtol=1.e-4)
+    np.testing.assert_allclose(im2.array, im1.array, atol=0.1 * np.max(im1.array))
+
+
+def test_select_draw_method():
+    # Check that bright galaxies switch to fft, and that the choice is recorded.
+    config = yaml.safe_load(CONFIG_FLAT)
+    config['stamp']['objects'] = { 'star' : 0.3, 'gal' : 0.7 }
+    config['stamp']['draw_method'] = 'phot'
+    config['gal']['flux'] = { 'type' : 'Random', 'min' : 100, 'max' : 1.e4 }
+    config['star']['flux'] = 1.e4
+    config['image']['nobjects'] = 50
+    config['image']['image_pos'] = {
+        'type' : 'XY',
+        'x' : { 'type' : 'Random', 'min' : 10, 'max' : 310 },
+        'y' : { 'type' : 'Random', 'min' : 10, 'max' : 310 },
+    }
+    config['stamp']['select_draw_method'] = { 'gal' : { 'max_phot_flux' : 3000 } }
+    config['output'] = {
+        'dir' : 'output',
+        'file_name' : 'select_draw_method.fits',
+        'truth' : {
+            'file_name' : 'select_draw_method_truth.fits',
+            'columns' : {
+                'obj_type' : '@current_obj_type',
+                'flux' : '$float((@current_obj).flux)',
+                'draw_method' : '@current_draw_method',
+            }
+        }
+    }
+    galsim.config.Process(galsim.config.CopyConfig(config), except_abort=True)
+    truth = galsim.Catalog('output/select_draw_method_truth.fits').data
+    gal = truth['obj_type'] == 'gal'
+    bright = gal & (truth['flux'] > 3000)
+    assert 0 < np.sum(bright) < np.sum(gal) < len(truth)
+    np.testing.assert_array_equal(truth['draw_method'][bright], 'fft')
+    np.testing.assert_array_equal(truth['draw_method'][~bright], 'phot')
+
+    # With a small max_fft_size, the bright galaxies are too big to use fft.
+    config['stamp']['select_draw_method']['gal']['max_fft_size'] = 16
+    config['stamp']['select_draw_method']['gal']['fft_method'] = 'no_pixel'
+    galsim.config.Process(galsim.config.CopyConfig(config), except_abort=True)
+    truth = galsim.Catalog('output/select_draw_method_truth.fits').data
+    np.testing.assert_array_equal(truth['draw_method'], 'phot')
+
+    config['stamp']['select_draw_method']['gal']['max_fft_size'] = 1024
+    galsim.config.Process(galsim.config.CopyConfig(config), except_abort=True)
+    truth = galsim.Catalog('output/select_draw_method_truth.fits').data
+    np.testing.assert_array_equal(truth['draw_method'][bright], 'no_pixel')
+
+    config['stamp']['select_draw_method']['gal']['fft_method'] = 'phot'
+    with np.testing.assert_raises(galsim.GalSimConfigError):
+        galsim.config.Process(galsim.config.CopyConfig(config), except_abort=True)
+
+
 if __name__ == '__main__':
     test_mixed_scene()
     test_mixed_scene_flat()
+    test_obj_types()
+    test_batch_seeds()
+    test_psf_cache()
+    test_psf_cache_focal_plane()
+    test_select_draw_method()
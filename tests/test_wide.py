@@ -3,6 +3,7 @@ import galsim
 import logging
 import numpy as np
 import os, sys, time
+import json
 
 def test_wide():
 
@@ -118,6 +119,479 @@ def test_wide_nonrandom():
             np.testing.assert_equal(cat1.data, cat2.data)
 
 
+def test_profile():
+    # Check that output.profile records the stages of the FocalPlane, WideScattered and
+    # MixedScene builders without changing the output.
+    config = galsim.config.ReadConfig('focal_quick.yaml')[0]
+    config['image']['type'] = 'WideScattered'
+    del config['image']['sky_level']
+    config['output']['file_name']['format'] = "wideprof1_%s_%02d.fits.fz"
+    config['output']['truth']['file_name']['format'] = "wideproftruth1_%s_%02d.dat"
+
+    logger = logging.getLogger('test_profile')
+    logger.addHandler(logging.StreamHandler(sys.stdout))
+    if __name__ == '__main__':
+        logger.setLevel(logging.DEBUG)
+
+    config1 = galsim.config.CopyConfig(config)
+    galsim.config.Process(config1, logger=logger, except_abort=True)
+
+    config['output']['file_name']['format'] = "wideprof2_%s_%02d.fits.fz"
+    config['output']['truth']['file_name']['format'] = "wideproftruth2_%s_%02d.dat"
+    config['output']['profile'] = {
+        'file_name' : {
+            'type' : 'FormattedStr',
+            'format' : "wideprof2_%s_%02d.json",
+            'items' : [ { 'type' : 'Catalog', 'col' : 1, 'index_key' : 'exp_num' },
+                        "$chip_num + 1" ],
+        }
+    }
+    galsim.config.Process(config, logger=logger, except_abort=True)
+
+    for i in range(1,3):
+        for j in range(1,3):
+            im1 = galsim.fits.read('output/wideprof1_DECam_exp%d_%02d.fits.fz'%(i,j))
+            im2 = galsim.fits.read('output/wideprof2_DECam_exp%d_%02d.fits.fz'%(i,j))
+            np.testing.assert_equal(im1.array, im2.array)
+
+            with open('output/wideprof2_DECam_exp%d_%02d.json'%(i,j)) as fin:
+                profile = json.load(fin)
+            assert profile['exp_num'] == i-1
+            assert profile['chip_num'] == j-1
+            assert profile['file_name'] == 'output/wideprof2_DECam_exp%d_%02d.fits.fz'%(i,j)
+            stages = profile['stages']
+            for stage in ['meta_params', 'images', 'inputs', 'positions', 'stamps',
+                          'accumulate', 'noise', 'write']:
+                assert stage in stages
+                assert stages[stage]['time'] >= 0.
+                assert stages[stage]['calls'] == 1
+                assert stages[stage]['process_peak_rss'] > 0.
+                assert 0. <= stages[stage]['peak_rss_increase'] <= profile['process_peak_rss']
+            # The exposure setup (including building the wcs of each chip) is only done for
+            # the first chip in each exposure.
+            if j == 1:
+                assert stages['exposure_setup']['calls'] == 1
+                assert stages['wcs']['calls'] == 2
+            else:
+                assert 'exposure_setup' not in stages
+                assert 'wcs' not in stages
+            assert stages['positions']['nobj'] >= stages['stamps']['nobj']
+            cat = galsim.Catalog('output/wideproftruth2_DECam_exp%d_%02d.dat'%(i,j))
+            obj_types = profile['obj_types']
+            # Some objects are skipped after being built, so they aren't in the truth catalog.
+            nbuilt = sum([ t['count'] for t in obj_types.values() ])
+            assert cat.nobjects <= nbuilt <= stages['stamps']['nobj']
+            assert stages['accumulate']['nobj'] == cat.nobjects
+            assert profile['total_time'] >= stages['images']['time']
+
+
+def test_inside():
+    # Check the vectorized test of which positions are inside the border around the chip
+    # against doing the triple products one position at a time.
+    import coord
+    from galsim_extra.wide_scattered import WideScatteredBuilder
+
+    # A slightly sheared and rotated wcs near ra = 0, so the ra wrapping matters.
+    jac = galsim.AffineTransform(0.2, 0.05, -0.04, 0.26, galsim.PositionD(1024,2048))
+    wcs = galsim.TanWCS(jac, galsim.CelestialCoord(0.01*galsim.degrees, -30*galsim.degrees))
+    image = galsim.ImageF(2048, 4096)
+    cen = wcs.toWorld(image.true_center)
+    corners = [ wcs.toWorld(galsim.PositionD(x,y))
+                for x,y in [(1,1), (1,4096), (2048,4096), (2048,1)] ]
+    corners = [ c.greatCirclePoint(cen, -60 * coord.arcsec) for c in corners ]
+    corners = [ coord.CelestialCoord(c.ra.wrap(cen.ra), c.dec) for c in corners ]
+    edges = list(zip(corners, corners[1:] + corners[:1]))
+    min_ra = min([ c.ra.deg for c in corners ])
+    max_ra = max([ c.ra.deg for c in corners ])
+    min_dec = min([ c.dec.deg for c in corners ])
+    max_dec = max([ c.dec.deg for c in corners ])
+
+    ud = galsim.UniformDeviate(1234)
+    world_pos = [ coord.CelestialCoord((0.01 + 0.6 * (ud()-0.5)) * coord.degrees,
+                                       (-30 + 0.6 * (ud()-0.5)) * coord.degrees)
+                  for k in range(3000) ]
+    ra = np.array([ pos.ra.rad for pos in world_pos ])
+    dec = np.array([ pos.dec.rad for pos in world_pos ])
+    inside = WideScatteredBuilder._inside(ra, dec, cen, edges, min_ra, max_ra, min_dec, max_dec)
+    print('ninside = ',np.sum(inside))
+    assert 0 < np.sum(inside) < len(world_pos)
+
+    for c in corners:
+        c._set_aux()
+    for k, pos in enumerate(world_pos):
+        pos._set_aux()
+        sides = [ np.sign(pos._triple(p2,p1)) for p1,p2 in edges ]
+        assert inside[k] == (len(set(sides)) == 1)
+
+def check_catalog_radec(tag, logger, setup=None, wide_setup=None, rtol=0.):
+    """Run focal_quick.yaml with the positions read from a catalog, once with Scattered and
+    once with WideScattered, and check that the images and truth catalogs are the same.
+
+    The catalog has 300 random positions around the field in columns 0 and 1, and a random
+    value between 60 and 120 (e.g. an object_border in arcsec) in column 2.
+
+    @param tag          A tag to use in the names of the catalog and the output files.
+    @param logger       A logger to use for the runs.
+    @param setup        An optional function to make further changes to the config of both
+                        runs.
+    @param wide_setup   An optional function to make further changes to the config of the
+                        WideScattered run.
+    @param rtol         The relative tolerance for the float truth columns. [default: 0]
+
+    @returns the config used for the WideScattered run (before processing it).
+    """
+    nobj = 300
+    ud = galsim.UniformDeviate(1234)
+    cat_ra = np.empty(nobj)
+    cat_dec = np.empty(nobj)
+    cat_extra = np.empty(nobj)
+    ud.generate(cat_ra)
+    ud.generate(cat_dec)
+    ud.generate(cat_extra)
+    cat_ra = cat_ra * 2 + 19.3 * 15. - 1
+    cat_dec = cat_dec * 2 - 33.1 - 1
+    cat_extra = cat_extra * 60 + 60
+    cat_file = 'output/%s_radec.dat'%tag
+    np.savetxt(cat_file, np.column_stack((cat_ra, cat_dec, cat_extra)))
+
+    def get_config(run):
+        config = galsim.config.ReadConfig('focal_quick.yaml')[0]
+        config['output']['file_name']['format'] = "wide%s%d_%%s_%%02d.fits.fz"%(tag,run)
+        config['output']['truth']['file_name']['format'] = "wide%s%dtruth_%%s_%%02d.fits"%(tag,run)
+        config['input']['catalog'] = [ config['input']['catalog'], { 'file_name' : cat_file } ]
+        config['output']['file_name']['items'][0]['num'] = 0
+        config['output']['truth']['file_name']['items'][0]['num'] = 0
+        config['image']['world_pos'] = {
+            'type' : 'CatalogRADec', 'ra_col' : '0', 'dec_col' : '1', 'num' : 1,
+        }
+        config['image']['nobjects'] = nobj
+        del config['image']['sky_level']
+        del config['image']['noise']
+        if run == 2:
+            config['image']['type'] = 'WideScattered'
+            config['output']['truth']['columns']['ra'] = "$(@stamp.world_pos).ra.deg"
+            config['output']['truth']['columns']['dec'] = "$(@stamp.world_pos).dec.deg"
+        if setup is not None:
+            setup(config)
+        if run == 2 and wide_setup is not None:
+            wide_setup(config)
+        return config
+
+    galsim.config.Process(get_config(1), logger=logger, except_abort=True)
+    config = get_config(2)
+    galsim.config.Process(galsim.config.CopyConfig(config), logger=logger, except_abort=True)
+
+    for i in range(1,3):
+        for j in range(1,3):
+            im1 = galsim.fits.read('output/wide%s1_DECam_exp%d_%02d.fits.fz'%(tag,i,j))
+            im2 = galsim.fits.read('output/wide%s2_DECam_exp%d_%02d.fits.fz'%(tag,i,j))
+            np.testing.assert_equal(im1.array, im2.array)
+            cat1 = galsim.Catalog('output/wide%s1truth_DECam_exp%d_%02d.fits'%(tag,i,j))
+            cat2 = galsim.Catalog('output/wide%s2truth_DECam_exp%d_%02d.fits'%(tag,i,j))
+            assert cat1.nobjects == cat2.nobjects
+            assert cat1.nobjects > 0
+            for name in cat1.names:
+                if cat1.data[name].dtype.kind == 'f':
+                    np.testing.assert_allclose(cat1.data[name], cat2.data[name], rtol=rtol)
+                else:
+                    np.testing.assert_equal(cat1.data[name], cat2.data[name])
+    return config
+
+def test_batch_world_pos():
+    # Check that the batched world_pos types give the same positions as generating them one
+    # at a time.
+    from galsim_extra.batch_world_pos import BuildBatchWorldPos
+
+    config = {
+        'world_pos' : {
+            'type' : 'UniformRADec',
+            'min_ra' : '19 hours', 'max_ra' : '19.5 hours',
+            'min_dec' : '-34 degrees', 'max_dec' : '-32 degrees',
+        },
+        'obj_num' : 0,
+    }
+    config['rng'] = galsim.BaseDeviate(1234)
+    ra, dec = BuildBatchWorldPos(config['world_pos'], config, 500)
+    assert np.all((ra >= 19 * galsim.hours.value) & (ra <= 19.5 * galsim.hours.value))
+    assert np.all((dec >= -34 * galsim.degrees.value) & (dec <= -32 * galsim.degrees.value))
+    config['rng'] = galsim.BaseDeviate(1234)
+    for k in range(500):
+        config['obj_num'] = k
+        pos = galsim.config.ParseValue(config, 'world_pos', config, galsim.CelestialCoord)[0]
+        np.testing.assert_almost_equal(pos.ra.rad, ra[k], decimal=12)
+        np.testing.assert_almost_equal(pos.dec.rad, dec[k], decimal=12)
+
+    # Uniform on the sky means sin(dec) is uniform.
+    sindec = (np.sin(dec) - np.sin(-34 * galsim.degrees.value)) / (
+            np.sin(-32 * galsim.degrees.value) - np.sin(-34 * galsim.degrees.value))
+    np.testing.assert_allclose(np.mean(sindec), 0.5, atol=0.05)
+
+    # CatalogRADec reads the positions from a catalog.  Check that WideScattered, which reads
+    # them all at once, matches Scattered, which reads them one at a time.
+    logger = logging.getLogger('test_batch_world_pos')
+    logger.addHandler(logging.StreamHandler(sys.stdout))
+    if __name__ == '__main__':
+        logger.setLevel(logging.DEBUG)
+    check_catalog_radec('batch', logger)
+
+def test_chunk_size():
+    # Check that building the stamps in chunks, adding each chunk to the image before building
+    # the next one, gives the same images and truth catalogs as building them all at once.
+    # Also add the stamps with several threads, which should also not change anything.
+    def get_config(tag):
+        config = galsim.config.ReadConfig('focal_quick.yaml')[0]
+        config['image']['type'] = 'WideScattered'
+        config['image']['nobjects'] = 100
+        del config['image']['sky_level']
+        config['output']['file_name']['format'] = tag + "_%s_%02d.fits.fz"
+        config['output']['truth']['file_name']['format'] = tag + "truth_%s_%02d.dat"
+        config['output']['truth']['columns']['ra'] = "$(@stamp.world_pos).ra.deg"
+        config['output']['truth']['columns']['dec'] = "$(@stamp.world_pos).dec.deg"
+        return config
+
+    logger = logging.getLogger('test_chunk_size')
+    logger.addHandler(logging.StreamHandler(sys.stdout))
+    if __name__ == '__main__':
+        logger.setLevel(logging.DEBUG)
+
+    config = get_config('widechunk1')
+    galsim.config.Process(config, logger=logger, except_abort=True)
+
+    config = get_config('widechunk2')
+    config['image']['chunk_size'] = 3
+    config['image']['accumulate_nthreads'] = 4
+    config['image']['accumulate_tile_size'] = 200
+    galsim.config.Process(config, logger=logger, except_abort=True)
+
+    for i in range(1,3):
+        for j in range(1,3):
+            im1 = galsim.fits.read('output/widechunk1_DECam_exp%d_%02d.fits.fz'%(i,j))
+            im2 = galsim.fits.read('output/widechunk2_DECam_exp%d_%02d.fits.fz'%(i,j))
+            np.testing.assert_equal(im1.array, im2.array)
+            cat1 = galsim.Catalog('output/widechunk1truth_DECam_exp%d_%02d.dat'%(i,j))
+            cat2 = galsim.Catalog('output/widechunk2truth_DECam_exp%d_%02d.dat'%(i,j))
+            assert cat1.nobjects == cat2.nobjects
+            np.testing.assert_equal(cat1.data, cat2.data)
+
+    config = get_config('widechunk3')
+    config['image']['chunk_size'] = 0
+    with np.testing.assert_raises(galsim.GalSimConfigValueError):
+        galsim.config.Process(config, logger=logger, except_abort=True)
+
+def test_object_border():
+    # Check the distance of positions from the chip polygon, which is used for object_border,
+    # against a brute force calculation.
+    import coord
+    from galsim_extra.wide_scattered import WideScatteredBuilder
+
+    jac = galsim.AffineTransform(0.2, 0.05, -0.04, 0.26, galsim.PositionD(1024,2048))
+    wcs = galsim.TanWCS(jac, galsim.CelestialCoord(0.01*galsim.degrees, -30*galsim.degrees))
+    corners = [ wcs.toWorld(galsim.PositionD(x,y))
+                for x,y in [(1,1), (1,4096), (2048,4096), (2048,1)] ]
+    ud = galsim.UniformDeviate(1234)
+    world_pos = [ coord.CelestialCoord((0.01 + 0.6 * (ud()-0.5)) * coord.degrees,
+                                       (-30 + 0.6 * (ud()-0.5)) * coord.degrees)
+                  for k in range(300) ]
+    ra = np.array([ pos.ra.rad for pos in world_pos ])
+    dec = np.array([ pos.dec.rad for pos in world_pos ])
+    dist = WideScatteredBuilder._distance(ra, dec, corners)
+
+    # Points along the edges of the chip, spaced by about 0.1 arcsec.
+    edge_pts = []
+    for p1, p2 in zip(corners, corners[1:] + corners[:1]):
+        n = int(p1.distanceTo(p2) / coord.arcsec * 10)
+        edge_pts += [ p1.greatCirclePoint(p2, p1.distanceTo(p2) * t)
+                      for t in np.linspace(0, 1, n) ]
+    edge_xyz = np.array([ p.get_xyz() for p in edge_pts ])
+    inside = WideScatteredBuilder._inside(
+            ra, dec, wcs.toWorld(galsim.PositionD(1024.5,2048.5)),
+            list(zip(corners, corners[1:] + corners[:1])), -360, 360, -90, 90)
+    for k, pos in enumerate(world_pos):
+        if inside[k]:
+            assert dist[k] == 0.
+        else:
+            d = np.min(np.sqrt(np.sum((edge_xyz - np.array(pos.get_xyz()))**2, axis=1)))
+            np.testing.assert_allclose(dist[k] / coord.arcsec.value, d / coord.arcsec.value,
+                                       atol=0.1)
+    assert 0 < np.sum(inside) < len(world_pos)
+
+    # Run WideScattered with a border for each object read from the catalog along with the
+    # positions.  The images should match Scattered.
+    logger = logging.getLogger('test_object_border')
+    logger.addHandler(logging.StreamHandler(sys.stdout))
+    if __name__ == '__main__':
+        logger.setLevel(logging.DEBUG)
+    def wide_setup(config):
+        config['image']['object_border'] = { 'type' : 'Catalog', 'col' : 2, 'num' : 1 }
+    config = check_catalog_radec('border', logger, wide_setup=wide_setup)
+
+    # A random border is drawn from each object's own rng, which is reset again when its stamp
+    # is built, so it doesn't change the objects either.
+    def random_setup(config):
+        config['image']['object_border'] = { 'type' : 'Random', 'min' : 60, 'max' : 120 }
+    check_catalog_radec('randborder', logger, wide_setup=random_setup)
+
+    config['image']['border'] = 60
+    with np.testing.assert_raises(galsim.GalSimConfigError):
+        galsim.config.Process(config, logger=logger, except_abort=True)
+
+def test_pixel_prefilter():
+    # Check the pixel-space distance from the image used by prefilter = pixel against
+    # converting the positions one at a time.
+    import coord
+    from galsim_extra.wide_scattered import WideScatteredBuilder
+
+    # A TPV wcs with a lot of distortion, so the edges of the image are curved on the sky.
+    header = galsim.FitsHeader()
+    for key, value in [ ('CTYPE1', 'RA---TPV'), ('CTYPE2', 'DEC--TPV'),
+                        ('CRVAL1', 0.01), ('CRVAL2', -30.), ('CRPIX1', 1024.), ('CRPIX2', 2048.),
+                        ('CD1_1', -7.3e-5), ('CD1_2', 1.e-6), ('CD2_1', 1.e-6), ('CD2_2', 7.3e-5),
+                        ('PV1_1', 1.), ('PV1_7', 50.), ('PV2_1', 1.), ('PV2_9', -40.) ]:
+        header[key] = value
+    wcs = galsim.GSFitsWCS(header=header)
+    image = galsim.ImageF(2048, 4096, wcs=wcs)
+    cen = wcs.toWorld(image.true_center)
+    corners = [ wcs.toWorld(galsim.PositionD(x,y))
+                for x,y in [(1,1), (1,4096), (2048,4096), (2048,1)] ]
+
+    ud = galsim.UniformDeviate(1234)
+    world_pos = [ coord.CelestialCoord((0.01 + 0.6 * (ud()-0.5)) * coord.degrees,
+                                       (-30 + 0.6 * (ud()-0.5)) * coord.degrees)
+                  for k in range(2000) ]
+    # Add a few points on the far side of the sky, which the TAN projection would map onto
+    # the image.
+    world_pos += [ coord.CelestialCoord(pos.ra + 180 * coord.degrees, -pos.dec)
+                   for pos in world_pos[:20] ]
+    ra = np.array([ pos.ra.rad for pos in world_pos ])
+    dec = np.array([ pos.dec.rad for pos in world_pos ])
+    dist = WideScatteredBuilder._pixel_distance(ra, dec, wcs, image.bounds, cen, corners)
+    sky_dist = WideScatteredBuilder._distance(ra, dec, corners)
+
+    scale = wcs.local(image.true_center).minLinearScale()
+    for k, pos in enumerate(world_pos):
+        if k >= 2000:
+            assert dist[k] > 170 * coord.degrees.value
+            continue
+        image_pos = wcs.toImage(pos)
+        dx = max(image.xmin - 0.5 - image_pos.x, image_pos.x - image.xmax - 0.5, 0.)
+        dy = max(image.ymin - 0.5 - image_pos.y, image_pos.y - image.ymax - 0.5, 0.)
+        d = np.sqrt(dx**2 + dy**2) * scale
+        np.testing.assert_allclose(dist[k] / coord.arcsec.value, d, rtol=1.e-6, atol=1.e-6)
+    # Some of the positions on the image are outside the polygon with straight edges.
+    print('on image = ',np.sum(dist == 0),'in polygon = ',np.sum(sky_dist == 0))
+    assert np.any((dist == 0) & (sky_dist > 0))
+
+    # Run WideScattered with prefilter = pixel.  The images should match Scattered.
+    logger = logging.getLogger('test_pixel_prefilter')
+    logger.addHandler(logging.StreamHandler(sys.stdout))
+    if __name__ == '__main__':
+        logger.setLevel(logging.DEBUG)
+    def wide_setup(config):
+        config['image']['prefilter'] = 'pixel'
+    config = check_catalog_radec('pixel', logger, wide_setup=wide_setup)
+
+    config['image']['prefilter'] = 'invalid'
+    with np.testing.assert_raises(galsim.GalSimConfigValueError):
+        galsim.config.Process(config, logger=logger, except_abort=True)
+
+def test_accumulate():
+    # Check that adding the stamps in tiles with several threads gives exactly the same image as
+    # adding them one at a time.
+    from galsim_extra.stamp_accumulator import AccumulateStamps
+
+    ud = galsim.UniformDeviate(1234)
+    image = galsim.ImageF(galsim.BoundsI(1, 700, 1, 900))
+    stamps = []
+    current_vars = []
+    for k in range(400):
+        # Some of these are partially or entirely off the image.
+        x = int(ud() * 800) - 50
+        y = int(ud() * 1000) - 50
+        size = int(ud() * 80) + 1
+        dtype = np.float64 if k % 2 == 0 else np.float32
+        stamp = galsim.Image(galsim.BoundsI(x, x+size, y, y+size), dtype=dtype)
+        stamp.array[:,:] = np.array([ ud() for i in range(stamp.array.size) ]).reshape(
+                stamp.array.shape)
+        stamps.append(stamp)
+        current_vars.append(0.1 * (k % 3))
+    stamps[7] = None  # A skipped object
+
+    image1 = image.copy()
+    noise_image1 = galsim.ImageF(image.bounds)
+    for stamp, var in zip(stamps, current_vars):
+        if stamp is None: continue
+        b = stamp.bounds & image.bounds
+        if b.isDefined():
+            image1[b] += stamp[b]
+            noise_image1[b] += var
+
+    for nthreads, tile_size in [ (1, 512), (4, 512), (4, 100), (3, 7) ]:
+        image2 = image.copy()
+        noise_image2 = AccumulateStamps(image2, stamps, current_vars, nthreads=nthreads,
+                                        tile_size=tile_size)
+        np.testing.assert_equal(image2.array, image1.array)
+        np.testing.assert_equal(noise_image2.array, noise_image1.array)
+
+    # If no stamps have any variance, the noise image isn't made.
+    image2 = image.copy()
+    noise_image2 = AccumulateStamps(image2, stamps, [0.] * len(stamps), nthreads=4)
+    assert noise_image2 is None
+
+def test_shear_scene():
+    # Check that WideScattered shears all the positions at once when the stamp is MixedScene
+    # with a constant shear_scene and shear.  The images should match Scattered, where each
+    # object's position is sheared separately.
+    import coord
+    from galsim_extra.mixed_scene import ShearScene, GetSceneShear
+
+    center = coord.CelestialCoord(289.5 * coord.degrees, -33.1 * coord.degrees)
+    shear = galsim.Shear(g1=0.05, g2=-0.03)
+    ud = galsim.UniformDeviate(1234)
+    ra = np.empty(100)
+    dec = np.empty(100)
+    ud.generate(ra)
+    ud.generate(dec)
+    ra = np.radians(289.5 + 2 * (ra - 0.5))
+    dec = np.radians(-33.1 + 2 * (dec - 0.5))
+    ra2, dec2 = ShearScene(ra, dec, center, shear)
+    for k in range(len(ra)):
+        u, v = center.project(coord.CelestialCoord(ra[k] * coord.radians, dec[k] * coord.radians),
+                              projection='gnomonic')
+        pos = galsim.PositionD(u.rad, v.rad).shear(shear)
+        pos2 = center.deproject(pos.x * coord.radians, pos.y * coord.radians,
+                                projection='gnomonic')
+        np.testing.assert_allclose([ra2[k], dec2[k]], [pos2.ra.rad, pos2.dec.rad],
+                                   rtol=0, atol=1.e-14)
+
+    logger = logging.getLogger('test_shear_scene')
+    logger.addHandler(logging.StreamHandler(sys.stdout))
+    if __name__ == '__main__':
+        logger.setLevel(logging.DEBUG)
+    def setup(config):
+        config['output']['truth']['columns']['ra'] = "$world_pos.ra.deg"
+        config['output']['truth']['columns']['dec'] = "$world_pos.dec.deg"
+        config['stamp']['shear'] = { 'type' : 'G1G2', 'g1' : 0.05, 'g2' : -0.03 }
+        config['stamp']['shear_scene'] = True
+    config = check_catalog_radec('shear', logger, setup=setup, rtol=1.e-10)
+    # The WideScattered run used the batch version.
+    assert GetSceneShear(config) == galsim.Shear(g1=0.05, g2=-0.03)
+
+    # If the shear depends on the object type, it falls back to shearing each object separately.
+    config = galsim.config.ReadConfig('focal_quick.yaml')[0]
+    config['stamp']['shear_scene'] = True
+    assert GetSceneShear(config) is None
+    config['stamp']['shear_scene'] = "$@current_obj_type == 'bright_gal'"
+    config['stamp']['shear'] = { 'type' : 'G1G2', 'g1' : 0.05, 'g2' : -0.03 }
+    assert GetSceneShear(config) is None
+
 if __name__ == '__main__':
     test_wide()
     test_wide_nonrandom()
+    test_profile()
+    test_inside()
+    test_batch_world_pos()
+    test_chunk_size()
+    test_object_border()
+    test_pixel_prefilter()
+    test_accumulate()
+    test_shear_scene()